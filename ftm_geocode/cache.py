@@ -1,26 +1,331 @@
+import base64
+import zlib
+from datetime import datetime, timedelta
 from functools import cache
+from typing import TYPE_CHECKING, Any, Generator, Iterable
 
+import orjson
 from anystore.store import BaseStore, get_store
+from normality import collapse_spaces
+from pydantic import BaseModel
 
 from ftm_geocode.logging import get_logger
+from ftm_geocode.metrics import timed, timer
 from ftm_geocode.settings import Settings
-from ftm_geocode.util import make_address_id
+from ftm_geocode.util import LRUCache, make_address_id, ordered_map
+
+if TYPE_CHECKING:
+    from ftm_geocode.model import GeocodingResult
 
 log = get_logger(__name__)
 settings = Settings()
 
+RESULT_PREFIX = "addr-"
+MISS_NAMESPACE = "misses"
+RAW_CODEC = "geocoder_raw_codec"
+
+HotKey = tuple[str, str | None]
+
+
+class CacheStats(BaseModel):
+    hits: int
+    misses: int
+    size: int
+    hit_rate: float
 
+
+# in-process cache of already validated results for recurring address lines
+_hot: LRUCache[HotKey, "GeocodingResult"] = LRUCache(settings.cache_hot_size)
+
+
+@timed("cache_key")
 def make_cache_key(value, **kwargs) -> str | None:
     if kwargs.get("use_cache") is False:
         return
     return make_address_id(value, **kwargs)
 
 
-@cache
-def get_cache() -> BaseStore:
+def _get_msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        raise ImportError(
+            "Please install `ftm-geocode[compression]` for msgpack cache serialization"
+        )
+    return msgpack
+
+
+def _get_zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "Please install `ftm-geocode[compression]` for zstd cache compression"
+        )
+    return zstandard
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return _get_zstd().ZstdCompressor().compress(data)
+    if codec == "zlib":
+        return zlib.compress(data)
+    raise ValueError(f"Invalid compression: `{codec}`")
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return _get_zstd().ZstdDecompressor().decompress(data)
+    if codec == "zlib":
+        return zlib.decompress(data)
+    raise ValueError(f"Invalid compression: `{codec}`")
+
+
+@timed("serialize")
+def dump_result(result: "GeocodingResult") -> bytes:
+    """
+    Serialize a geocoding result for the cache according to the
+    `cache_serialization`, `cache_compression` and `cache_raw_fields` settings
+    """
+    data = result.model_dump(mode="json")
+    # loaded results always have a (maybe empty) dict
+    raw = data["geocoder_raw"] = data.get("geocoder_raw") or {}
+    if raw and settings.cache_raw_fields is not None:
+        raw = {k: v for k, v in raw.items() if k in settings.cache_raw_fields}
+        data["geocoder_raw"] = raw
+    msgpack = settings.cache_serialization == "msgpack"
+    if raw and settings.cache_compression:
+        packed = compress(orjson.dumps(raw), settings.cache_compression)
+        data["geocoder_raw"] = packed if msgpack else base64.b64encode(packed).decode()
+        data[RAW_CODEC] = settings.cache_compression
+    if msgpack:
+        return _get_msgpack().packb(data)
+    return orjson.dumps(data)
+
+
+def load_result_data(value: bytes | str | None) -> dict[str, Any] | None:
+    """
+    Deserialize the data of a cached geocoding result without validating it
+    into a model, regardless of the current serialization settings (plain json
+    entries are always readable)
+    """
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = value.encode()
+    if value[:1] == b"{":
+        data: dict[str, Any] = orjson.loads(value)
+    else:
+        data = _get_msgpack().unpackb(value)
+    codec = data.pop(RAW_CODEC, None)
+    if codec is not None:
+        raw = data["geocoder_raw"]
+        if isinstance(raw, str):
+            raw = base64.b64decode(raw)
+        data["geocoder_raw"] = orjson.loads(decompress(raw, codec))
+    return data
+
+
+@timed("deserialize")
+def load_result(value: bytes | str | None) -> "GeocodingResult | None":
+    """
+    Deserialize a geocoding result from the cache, regardless of the current
+    serialization settings (plain json entries are always readable)
+    """
     from ftm_geocode.model import GeocodingResult
 
+    data = load_result_data(value)
+    if data is not None:
+        return GeocodingResult(**data)
+
+
+@cache
+def get_cache() -> BaseStore:
     kwargs = settings.cache.model_dump()
-    kwargs["model"] = GeocodingResult
+    kwargs["serialization_mode"] = "raw"
+    kwargs["serialization_func"] = dump_result
+    kwargs["deserialization_func"] = load_result
     kwargs["store_none_values"] = False
+    kwargs["raise_on_nonexist"] = False
     return get_store(**kwargs)
+
+
+def make_hot_key(value: str, country: str | None = None) -> HotKey:
+    return collapse_spaces(value) or "", country or None
+
+
+def get_hot(value: str, country: str | None = None) -> "GeocodingResult | None":
+    """
+    Get a result from the in-process cache by the raw address line and country
+    (without normalization, key computation or store lookup)
+    """
+    result = _hot.get(make_hot_key(value, country))
+    if result is not None:
+        return result.model_copy()
+
+
+def put_hot(value: str, country: str | None, result: "GeocodingResult") -> None:
+    _hot.put(make_hot_key(value, country), result)
+
+
+def get_hot_cache_stats() -> CacheStats:
+    return CacheStats(
+        hits=_hot.hits, misses=_hot.misses, size=len(_hot), hit_rate=_hot.hit_rate
+    )
+
+
+def get_many(keys: Iterable[str]) -> dict[str, "GeocodingResult"]:
+    """
+    Bulk lookup of cached geocoding results, the store is queried concurrently
+    by `settings.cache_workers` threads. Missing keys are omitted.
+    """
+    cache = get_cache()
+    keys = list(dict.fromkeys(keys))
+
+    def _get(key: str) -> "GeocodingResult | None":
+        return cache.get(key, raise_on_nonexist=False)
+
+    with timer("cache_read_many"):
+        results = list(ordered_map(_get, keys, settings.cache_workers))
+    return {k: r for k, r in zip(keys, results) if r is not None}
+
+
+def put_many(results: dict[str, "GeocodingResult"]) -> None:
+    """
+    Bulk write of geocoding results by their keys, the store is written to
+    concurrently by `settings.cache_workers` threads.
+    """
+    cache = get_cache()
+
+    def _put(item: tuple[str, "GeocodingResult"]) -> None:
+        cache.put(*item)
+
+    with timer("cache_write_many"):
+        for _ in ordered_map(_put, results.items(), settings.cache_workers):
+            pass
+
+
+@cache
+def get_raw_cache() -> BaseStore:
+    """
+    Get a raw store (bytes values) sharing the backend (and connection) of the
+    results cache
+    """
+    store = get_cache().model_copy()
+    store.serialization_func = None
+    store.deserialization_func = None
+    return store
+
+
+@cache
+def get_namespace_cache(namespace: str) -> BaseStore:
+    """
+    Get a raw store on the same backend as the results cache for auxiliary
+    data, its keys are prefixed with the namespace to not collide with
+    geocoding results
+    """
+    store = get_raw_cache().model_copy()
+    store.key_prefix = "/".join(p for p in (store.key_prefix, namespace) if p)
+    return store
+
+
+def get_shard(key: str, shards: int) -> int:
+    """
+    Assign a cache key to one of `shards` shards by the prefix of its hash
+    """
+    try:
+        return int(key.rsplit("-", 1)[-1][:8], 16) % shards
+    except ValueError:
+        return zlib.crc32(key.encode()) % shards
+
+
+def iterate_result_keys() -> Generator[str, None, None]:
+    """
+    Iterate through the keys of all cached geocoding results (skipping
+    auxiliary data)
+    """
+    for key in get_raw_cache().iterate_keys():
+        if key.startswith(RESULT_PREFIX):
+            yield key
+
+
+def get_shard_keys(shards: int) -> dict[int, list[str]]:
+    """
+    Partition the keys of all cached geocoding results into `shards` shards
+    with one scan over the store
+    """
+    keys: dict[int, list[str]] = {shard: [] for shard in range(shards)}
+    for key in iterate_result_keys():
+        keys[get_shard(key, shards)].append(key)
+    return keys
+
+
+def iterate_results(
+    keys: Iterable[str] | None = None,
+) -> Generator["GeocodingResult", None, None]:
+    """
+    Iterate through all cached geocoding results (skipping auxiliary data),
+    optionally only the ones of the given keys
+    """
+    cache = get_cache()
+    for key in iterate_result_keys() if keys is None else keys:
+        result = cache.get(key, raise_on_nonexist=False)
+        if result is not None:
+            yield result
+
+
+def iterate_result_data(
+    keys: Iterable[str] | None = None,
+) -> Generator[dict[str, Any], None, None]:
+    """
+    Iterate through the data of all cached geocoding results without
+    validating it into models (see `load_result_data`), optionally only the
+    ones of the given keys
+    """
+    store = get_raw_cache()
+    for key in iterate_result_keys() if keys is None else keys:
+        data = load_result_data(store.get(key, raise_on_nonexist=False))
+        if data is not None:
+            yield data
+
+
+def iterate_raw_results() -> Generator[tuple[str, bytes], None, None]:
+    """
+    Iterate through the keys and serialized values of all cached geocoding
+    results (skipping auxiliary data)
+    """
+    store = get_raw_cache()
+    for key in store.iterate_keys():
+        if key.startswith(RESULT_PREFIX):
+            value = store.get(key)
+            if value:
+                yield key, value
+
+
+def make_miss_key(geocoder: str, key: str) -> str:
+    return f"{geocoder}/{key}"
+
+
+def put_miss(geocoder: str, key: str) -> None:
+    """
+    Record that the geocoder found no match for the address with this cache key
+    """
+    if settings.cache_miss_ttl:
+        store = get_namespace_cache(MISS_NAMESPACE)
+        store.put(make_miss_key(geocoder, key), datetime.now().isoformat().encode())
+
+
+def is_miss(geocoder: str, key: str) -> bool:
+    """
+    Check if the geocoder found no match for the address with this cache key
+    within the last `settings.cache_miss_ttl` seconds
+    """
+    if not settings.cache_miss_ttl:
+        return False
+    store = get_namespace_cache(MISS_NAMESPACE)
+    value = store.get(make_miss_key(geocoder, key))
+    if value is None:
+        return False
+    value = value.decode() if isinstance(value, bytes) else value
+    ts = datetime.fromisoformat(value)
+    return datetime.now() - ts < timedelta(seconds=settings.cache_miss_ttl)
@@ -1,46 +1,90 @@
 from enum import StrEnum
-from typing import Optional
+from itertools import chain
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Callable, Iterable, Iterator, Optional
 
 import typer
 from anystore.cli import ErrorHandler
-from anystore.io import (
-    FORMAT_CSV,
-    FORMAT_JSON,
-    ModelWriter,
-    Writer,
-    smart_stream_models,
-)
+from anystore.io import FORMAT_CSV, FORMAT_JSON
 from ftmq.io import smart_read_proxies, smart_write_proxies
+from ftmq.util import make_proxy
 from rich.console import Console
+from rich.table import Table
 from typing_extensions import Annotated
 
-from ftm_geocode import __version__, logic
-from ftm_geocode.cache import get_cache
-from ftm_geocode.geocode import GEOCODERS, geocode_line, geocode_proxy
-from ftm_geocode.io import FORMAT_FTM, LatLonRow, PostalRow
+from ftm_geocode import __version__, logic, maintenance, metrics
+from ftm_geocode.cache import get_cache, get_hot_cache_stats
+from ftm_geocode.export import export_results, merge_parts, write_cached
+from ftm_geocode.geocode import (
+    GEOCODERS,
+    AddressDeduplicator,
+    geocode_lines,
+    geocode_proxies,
+    registry,
+)
+from ftm_geocode.io import (
+    FORMAT_ARROW,
+    FORMAT_FTM,
+    FORMAT_PARQUET,
+    LatLonRow,
+    PostalRow,
+    add_nuts_columns,
+    get_writer,
+    is_columnar,
+    iter_record_batches,
+    stream_models,
+)
 from ftm_geocode.logging import configure_logging, get_logger
-from ftm_geocode.model import POSTAL_KEYS, GeocodingResult, get_address
-from ftm_geocode.nuts import get_nuts, get_proxy_nuts
+from ftm_geocode.model import (
+    POSTAL_KEYS,
+    GeocodingResult,
+    apply_nuts_batch,
+)
+from ftm_geocode.nuts import (
+    Nuts3,
+    ProxyNuts,
+    compile_nuts,
+    get_nuts_batch,
+    get_nuts_cache_stats,
+    get_proxy_nuts,
+)
+from ftm_geocode.reverse import (
+    ReverseResult,
+    build_index,
+    reverse_geocode_many,
+    reverse_geocode_proxy,
+)
 from ftm_geocode.settings import Settings
+from ftm_geocode.util import T, chunked, parse_duration, process_map
 
 settings = Settings()
 cli = typer.Typer(no_args_is_help=True)
 cli_cache = typer.Typer()
 cli.add_typer(cli_cache, name="cache")
+cli_nuts = typer.Typer()
+cli.add_typer(cli_nuts, name="nuts")
 console = Console(stderr=True)
 
 log = get_logger(__name__)
 
+# result fields not included in csv / json output of `ftmgeo reverse`
+REVERSE_EXCLUDE = {"cache_key", "lon", "lat", "geocoder_raw", "components"}
+
 
 class Formats(StrEnum):
     ftm = FORMAT_FTM
     json = FORMAT_JSON
     csv = FORMAT_CSV
+    parquet = FORMAT_PARQUET
+    arrow = FORMAT_ARROW
 
 
 class IOFormats(StrEnum):
     json = FORMAT_JSON
     csv = FORMAT_CSV
+    parquet = FORMAT_PARQUET
+    arrow = FORMAT_ARROW
 
 
 class Opts:
@@ -50,6 +94,55 @@ class Opts:
     IOFORMATS = typer.Option(Formats.json)
     GEOCODERS = typer.Option(settings.geocoders, "--geocoders", "-g")
     APPLY_NUTS = typer.Option(False, help="Add EU nuts codes")
+    PROCESSES = typer.Option(
+        1, "--processes", "-p", help="Number of processes for libpostal parsing"
+    )
+    OLDER_THAN = typer.Option(..., help='Age, e.g. "90d", "12h" or seconds')
+    UNDATED = typer.Option(False, help="Include results without timestamp")
+    DRY_RUN = typer.Option(False, help="Only report, don't change the cache")
+    STATS = typer.Option(
+        False, "--stats", help="Report per-stage timings and counters at the end"
+    )
+    NUTS_CHUNK_SIZE = typer.Option(
+        settings.nuts_chunk_size, help="Number of coordinates per nuts lookup batch"
+    )
+
+
+def map_postal(
+    func: Callable[[PostalRow], T], rows: Iterable[PostalRow], processes: int
+) -> Iterator[T]:
+    # libpostal parsing is cpu bound, so optionally fan out to processes. Load
+    # libpostal before forking, so that the workers share its model data.
+    if processes > 1:
+        logic.warmup()
+    return process_map(
+        func,
+        rows,
+        processes,
+        chunk_size=settings.postal_chunk_size,
+        initializer=logic.warmup,
+    )
+
+
+def print_stats() -> None:
+    report = metrics.get_report()
+    columns = ("stage", "calls", "seconds", "mean ms", "max ms")
+    table = Table(*columns, title="Stages")
+    for stage in sorted(report.stages, key=lambda s: -s.seconds):
+        labels = ",".join(stage.labels.values())
+        table.add_row(
+            f"{stage.name} {labels}".strip(),
+            str(stage.calls),
+            f"{stage.seconds:.3f}",
+            f"{stage.seconds / stage.calls * 1000:.3f}",
+            f"{stage.max * 1000:.3f}",
+        )
+    console.print(table)
+    table = Table("counter", "labels", "value", title="Counters")
+    for counter in report.counters:
+        labels = ",".join(f"{k}={v}" for k, v in counter.labels.items())
+        table.add_row(counter.name, labels, f"{counter.value:g}")
+    console.print(table)
 
 
 @cli.callback(invoke_without_command=True)
@@ -75,10 +168,11 @@ def format_line(
     input_format: IOFormats = Opts.IOFORMATS,
     output_uri: str = Opts.OUT,
     output_format: IOFormats = Opts.IOFORMATS,
+    processes: int = Opts.PROCESSES,
 ):
     """
-    Get formatted lines via libpostal parsing from csv or json input stream with
-    1 or more fields:
+    Get formatted lines via libpostal parsing from csv, json, parquet or arrow
+    input with 1 or more fields:
         - "original_line": address line
         - "country" (optional): country or iso code - good to know for libpostal
         - "language" (optional): language or iso code - good to know for libpostal
@@ -90,10 +184,11 @@ def format_line(
     with ErrorHandler():
         if not settings.libpostal:
             raise Exception("Please install and activate libpostal")
-        with ModelWriter(output_uri, output_format=output_format) as writer:
-            for row in smart_stream_models(input_uri, PostalRow, input_format):
-                row = logic.format_line(row)
-                writer.write(row)
+        rows = stream_models(input_uri, PostalRow, input_format)
+        writer = get_writer(output_uri, output_format, PostalRow, passthrough=True)
+        with writer:
+            for row in map_postal(logic.format_line, rows, processes):
+                writer.write(row.model_dump(mode="json"))
 
 
 @cli.command()
@@ -102,10 +197,11 @@ def parse_components(
     input_format: IOFormats = Opts.IOFORMATS,
     output_uri: str = Opts.OUT,
     output_format: IOFormats = Opts.IOFORMATS,
+    processes: int = Opts.PROCESSES,
 ):
     """
-    Get components parsed from libpostal from csv or json input stream with 1 or
-    more fields:
+    Get components parsed from libpostal from csv, json, parquet or arrow input
+    with 1 or more fields:
         - "original_line": address line
         - "country" (optional): country or iso code - good to know for libpostal
         - "language" (optional): language or iso code - good to know for libpostal
@@ -117,17 +213,16 @@ def parse_components(
     with ErrorHandler():
         if not settings.libpostal:
             raise Exception("Please install and activate libpostal")
-        rows = smart_stream_models(input_uri, PostalRow, input_format)
+        rows = stream_models(input_uri, PostalRow, input_format)
         row = next(rows)
         keys = row.model_dump().keys()
         fieldnames = list(set(keys) | set(POSTAL_KEYS))
-        with Writer(
-            output_uri, output_format=output_format, fieldnames=fieldnames
-        ) as writer:
-            row = logic.parse_components(row)
-            writer.write(row)
-            for row in rows:
-                row = logic.parse_components(row)
+        rows = chain([row], rows)
+        writer = get_writer(
+            output_uri, output_format, fieldnames=fieldnames, passthrough=True
+        )
+        with writer:
+            for row in map_postal(logic.parse_components, rows, processes):
                 writer.write(row)
 
 
@@ -136,6 +231,7 @@ def map_entities(
     input_uri: str = Opts.IN,
     input_format: IOFormats = Opts.IOFORMATS,
     output_uri: str = Opts.OUT,
+    processes: int = Opts.PROCESSES,
 ):
     """
     Map csv/json input stream to FollowTheMoney Address proxies, requires
@@ -146,16 +242,8 @@ def map_entities(
     with ErrorHandler():
         if not settings.libpostal:
             raise Exception("Please install and activate libpostal")
-        rows = smart_stream_models(input_uri, PostalRow, input_format)
-        addresses = (
-            get_address(
-                r.original_line,
-                country=r.country,
-                language=r.language,
-            )
-            for r in rows
-        )
-        proxies = (a.to_proxy() for a in addresses)
+        rows = stream_models(input_uri, PostalRow, input_format)
+        proxies = map(make_proxy, map_postal(logic.map_entity, rows, processes))
         smart_write_proxies(output_uri, proxies)
 
 
@@ -168,10 +256,20 @@ def geocode(
     geocoders: list[GEOCODERS] = Opts.GEOCODERS,
     use_cache: Annotated[bool, typer.Option(help="Use cache database")] = True,
     cache_only: Annotated[bool, typer.Option(help="Only use cache database")] = False,
+    retry_misses: Annotated[
+        bool, typer.Option(help="Retry addresses that recently had no match")
+    ] = False,
     rewrite_ids: Annotated[
         bool, typer.Option(help="Rewrite `Address` entity ids to canonized id")
     ] = True,
     apply_nuts: Annotated[bool, typer.Option(help="Add EU nuts codes")] = False,
+    workers: Annotated[
+        int, typer.Option(help="Number of concurrent geocoding workers")
+    ] = settings.workers,
+    chunk_size: Annotated[
+        int, typer.Option(help="Number of input rows to lookup in cache at once")
+    ] = settings.geocode_chunk_size,
+    stats: bool = Opts.STATS,
 ):
     """
     Geocode ftm entities or csv input to given output format using different
@@ -187,45 +285,54 @@ def geocode(
         ftmgeo geocode -i s3://my_bucket/entities.ftm.json > entities.geocoded.ftm.json
     """
     with ErrorHandler():
+        if stats:
+            metrics.enable()
+        dedup = AddressDeduplicator()
         if input_format == Formats.ftm:
-            proxies = smart_read_proxies(input_uri)
-            results = (
-                geocode_proxy(
-                    geocoders,
-                    p,
-                    use_cache=use_cache,
-                    cache_only=cache_only,
-                    apply_nuts=apply_nuts,
-                    output_format=output_format,
-                    rewrite_ids=rewrite_ids,
-                )
-                for p in proxies
+            results = geocode_proxies(
+                geocoders,
+                smart_read_proxies(input_uri),
+                use_cache=use_cache,
+                cache_only=cache_only,
+                retry_misses=retry_misses,
+                apply_nuts=apply_nuts,
+                output_format=output_format,
+                rewrite_ids=rewrite_ids,
+                workers=workers,
+                chunk_size=chunk_size,
+                dedup=dedup,
             )
-            results = (p for res in results for p in res)
         else:
-            tasks = smart_stream_models(input_uri, PostalRow, input_format)
-            results = (
-                geocode_line(
-                    geocoders,
-                    t.original_line,
-                    use_cache=use_cache,
-                    cache_only=cache_only,
-                    country=t.country,
-                    apply_nuts=apply_nuts,
-                )
-                for t in tasks
+            results = geocode_lines(
+                geocoders,
+                stream_models(input_uri, PostalRow, input_format),
+                use_cache=use_cache,
+                cache_only=cache_only,
+                retry_misses=retry_misses,
+                apply_nuts=apply_nuts,
+                workers=workers,
+                chunk_size=chunk_size,
+                dedup=dedup,
             )
-        out_format = FORMAT_CSV if output_format == FORMAT_CSV else FORMAT_JSON
-        with Writer(output_uri, output_format=out_format) as writer:
+        out_format = FORMAT_JSON if output_format == FORMAT_FTM else output_format
+        model = None if output_format == FORMAT_FTM else GeocodingResult
+        with registry, get_writer(output_uri, out_format, model) as writer:
             for res in results:
-                if res is not None:
-                    if output_format == FORMAT_FTM:
-                        if input_format != FORMAT_FTM:
-                            res = res.to_proxy()
-                        res = res.to_dict()
-                    else:
-                        res = res.model_dump(mode="json")
-                writer.write(res)
+                with metrics.timer("output"):
+                    if res is not None:
+                        if output_format == FORMAT_FTM:
+                            if input_format != FORMAT_FTM:
+                                res = res.to_proxy()
+                            res = res.to_dict()
+                        else:
+                            res = res.model_dump(mode="json")
+                    elif is_columnar(output_format):
+                        continue
+                    writer.write(res)
+        log.info("Address deduplication", **dedup.get_stats())
+        log.info("In-memory cache", **get_hot_cache_stats().model_dump())
+        if stats:
+            print_stats()
 
 
 @cli.command()
@@ -234,6 +341,8 @@ def apply_nuts(
     input_format: Formats = Opts.FORMATS,
     output_uri: str = Opts.OUT,
     output_format: IOFormats = Opts.IOFORMATS,
+    chunk_size: int = Opts.NUTS_CHUNK_SIZE,
+    stats: bool = Opts.STATS,
 ):
     """
     Apply EU NUTS codes to input stream
@@ -241,26 +350,122 @@ def apply_nuts(
     For ftm input, only Address entities with longitude and latitude properties
     will be considered.
 
-    For csv or json input, use these fields:
+    For csv, json, parquet or arrow input, use these fields:
         - "lat": Latitude
         - "lon": Longitude
         - all other fields will be passed through to the result
     """
     with ErrorHandler():
+        if stats:
+            metrics.enable()
         if input_format == FORMAT_FTM:
-            with ModelWriter(output_uri, output_format=output_format) as writer:
+            with get_writer(output_uri, output_format, ProxyNuts) as writer:
                 for proxy in smart_read_proxies(input_uri):
                     nuts = get_proxy_nuts(proxy)
                     if nuts is not None:
-                        writer.write(nuts)
+                        writer.write(nuts.model_dump(mode="json"))
+        elif is_columnar(input_format):
+            # columns of whole record batches, without a model per row
+            model = (LatLonRow, Nuts3)
+            with get_writer(
+                output_uri, output_format, model, passthrough=True
+            ) as writer:
+                for batch in iter_record_batches(input_uri, input_format, chunk_size):
+                    batch = add_nuts_columns(batch)
+                    if is_columnar(output_format):
+                        writer.write_record_batch(batch)
+                    else:
+                        for row in batch.to_pylist():
+                            writer.write(row)
         else:
-            with Writer(output_uri, output_format=output_format) as writer:
-                for row in smart_stream_models(input_uri, LatLonRow, input_format):
-                    nuts = get_nuts(row.lon, row.lat)
-                    if nuts is not None:
-                        data = row.model_dump()
-                        data.update(nuts.model_dump())
-                        writer.write(data)
+            rows = stream_models(input_uri, LatLonRow, input_format)
+            model = (LatLonRow, Nuts3)
+            with get_writer(
+                output_uri, output_format, model, passthrough=True
+            ) as writer:
+                for chunk in chunked(rows, chunk_size):
+                    lons, lats = [r.lon for r in chunk], [r.lat for r in chunk]
+                    for row, nuts in zip(chunk, get_nuts_batch(lons, lats)):
+                        if nuts is not None:
+                            data = row.model_dump()
+                            data.update(nuts.model_dump())
+                            writer.write(data)
+        if stats:
+            print_stats()
+
+
+@cli.command()
+def reverse(
+    input_uri: str = Opts.IN,
+    input_format: Formats = Opts.FORMATS,
+    output_uri: str = Opts.OUT,
+    output_format: Formats = Opts.FORMATS,
+    max_distance: Annotated[
+        float, typer.Option(help="Maximum distance in meters (0 for unbounded)")
+    ] = settings.reverse_max_distance,
+    chunk_size: Annotated[
+        int, typer.Option(help="Number of coordinates per lookup batch")
+    ] = settings.geocode_chunk_size,
+    stats: bool = Opts.STATS,
+):
+    """
+    Find the nearest cached address for coordinates (offline reverse geocoding)
+
+    For ftm input, entities with longitude and latitude properties but without
+    an address get the nearest address within the distance applied. All
+    entities are passed through.
+
+    For csv, json, parquet or arrow input, use these fields:
+        - "lat": Latitude
+        - "lon": Longitude
+        - all other fields will be passed through to the result
+    """
+    with ErrorHandler():
+        if stats:
+            metrics.enable()
+        out_format = FORMAT_JSON if output_format == FORMAT_FTM else output_format
+        model = None
+        if FORMAT_FTM not in (input_format, output_format):
+            model = (LatLonRow, ReverseResult)
+        with get_writer(output_uri, out_format, model, passthrough=True) as writer:
+            if input_format == FORMAT_FTM:
+                for proxy in smart_read_proxies(input_uri):
+                    for res in reverse_geocode_proxy(proxy, max_distance):
+                        writer.write(res.to_dict())
+            else:
+                rows = stream_models(input_uri, LatLonRow, input_format)
+                for chunk in chunked(rows, chunk_size):
+                    lons, lats = [r.lon for r in chunk], [r.lat for r in chunk]
+                    results = reverse_geocode_many(lons, lats, max_distance)
+                    for row, res in zip(chunk, results):
+                        if res is None:
+                            continue
+                        if output_format == FORMAT_FTM:
+                            writer.write(res.to_proxy().to_dict())
+                        else:
+                            data = res.model_dump(mode="json", exclude=REVERSE_EXCLUDE)
+                            data.update(row.model_dump())
+                            writer.write(data)
+        if stats:
+            print_stats()
+
+
+@cli_nuts.command("compile")
+def nuts_compile(
+    input_path: Annotated[
+        Path, typer.Option("-i", help="NUTS shapefile")
+    ] = settings.nuts_data,
+    output_path: Annotated[
+        Path, typer.Option("-o", help="Output directory for compiled data")
+    ] = settings.nuts_compiled,
+):
+    """
+    Compile the NUTS shapefile into a compact artifact (level 3 geometries as
+    WKB, names table and bounds) for fast loading. If the artifact exists at
+    `FTMGEO_NUTS_COMPILED`, it is used instead of the shapefile.
+    """
+    with ErrorHandler():
+        compile_nuts(output_path, input_path)
 
 
 @cli_cache.command("iterate")
@@ -268,22 +473,122 @@ def cache_iterate(
     output_uri: str = Opts.OUT,
     output_format: Formats = Opts.FORMATS,
     apply_nuts: bool = Opts.APPLY_NUTS,
+    chunk_size: int = Opts.NUTS_CHUNK_SIZE,
+    workers: Annotated[
+        int, typer.Option(help="Number of processes to export shards in parallel")
+    ] = 1,
+    shards: Annotated[
+        int, typer.Option(help="Number of shards to split the export into")
+    ] = 16,
+    parts: Annotated[
+        Optional[Path],
+        typer.Option(
+            help="Directory for part files per shard, run again to resume an "
+            "interrupted export"
+        ),
+    ] = None,
+    merge: Annotated[
+        bool, typer.Option(help="Merge the part files into the output")
+    ] = True,
 ):
     """
-    Export cached addresses to csv or ftm entities
+    Export cached addresses to csv, json, parquet, arrow or ftm entities
     """
     with ErrorHandler():
-        cache = get_cache()
-        results = cache.iterate_values()
-        if apply_nuts:
-            results = (r.apply_nuts() for r in results)
-        if output_format in (FORMAT_CSV, FORMAT_JSON):
-            with ModelWriter(output_uri, output_format=output_format) as writer:
-                for res in results:
-                    writer.write(res)
+        if workers < 2 and parts is None:
+            write_cached(
+                output_uri, output_format, apply_nuts=apply_nuts, chunk_size=chunk_size
+            )
         else:
-            proxies = (r.to_proxy() for r in results)
-            smart_write_proxies(output_uri, proxies)
+            with TemporaryDirectory() as tmp:
+                path = parts or Path(tmp)
+                export_results(
+                    path,
+                    output_format,
+                    shards=shards,
+                    workers=workers,
+                    apply_nuts=apply_nuts,
+                    chunk_size=chunk_size,
+                )
+                if merge:
+                    merge_parts(path, output_uri, output_format, shards=shards)
+        if apply_nuts:
+            log.info("Nuts cache", **get_nuts_cache_stats().model_dump())
+
+
+@cli_cache.command("stats")
+def cache_stats():
+    """
+    Show statistics about the cached results
+    """
+    with ErrorHandler():
+        console.print(maintenance.get_stats())
+
+
+@cli_cache.command("prune")
+def cache_prune(
+    older_than: Annotated[str, Opts.OLDER_THAN],
+    undated: bool = Opts.UNDATED,
+    dry_run: bool = Opts.DRY_RUN,
+):
+    """
+    Delete cached results older than the given age (e.g. "365d") and expired
+    records of unmatched addresses
+    """
+    with ErrorHandler():
+        maintenance.prune(parse_duration(older_than), undated, dry_run)
+
+
+@cli_cache.command("refresh")
+def cache_refresh(
+    older_than: Annotated[str, Opts.OLDER_THAN],
+    undated: bool = Opts.UNDATED,
+    limit: Annotated[
+        Optional[int], typer.Option(help="Maximum number of results to refresh")
+    ] = None,
+    dry_run: bool = Opts.DRY_RUN,
+):
+    """
+    Geocode cached results older than the given age (e.g. "180d") again with
+    their geocoder (rate limited) and replace them
+    """
+    with ErrorHandler(), registry:
+        maintenance.refresh(parse_duration(older_than), undated, limit, dry_run)
+
+
+@cli_cache.command("compact")
+def cache_compact(
+    components: Annotated[
+        bool, typer.Option(help="Store parsed postal components with the results")
+    ] = False,
+    dry_run: bool = Opts.DRY_RUN,
+):
+    """
+    Rewrite cached results under their current key and in the current
+    serialization, and delete superseded results
+    """
+    with ErrorHandler():
+        if components and not settings.libpostal:
+            raise Exception("Please install and activate libpostal")
+        maintenance.compact(components, dry_run)
+
+
+@cli_cache.command("reverse-index")
+def cache_reverse_index(
+    output_path: Annotated[
+        Path, typer.Option("-o", help="Output directory for the index")
+    ] = settings.reverse_index,
+    full: Annotated[
+        bool, typer.Option(help="Rebuild from scratch instead of updating")
+    ] = False,
+):
+    """
+    Build or update the persisted index of the cached results' coordinates for
+    `ftmgeo reverse`. Only results that are not indexed yet are read from the
+    cache.
+    """
+    with ErrorHandler():
+        build_index(output_path, full)
 
 
 @cli_cache.command("populate")
@@ -291,9 +596,10 @@ def cache_populate(
     input_uri: str = Opts.IN,
     input_format: IOFormats = Opts.IOFORMATS,
     apply_nuts: bool = Opts.APPLY_NUTS,
+    chunk_size: int = Opts.NUTS_CHUNK_SIZE,
 ):
     """
-    Populate cache from csv or json input with these fields:\n
+    Populate cache from csv, json, parquet or arrow input with these fields:\n
         address_id: str\n
         canonical_id: str\n
         original_line: str\n
@@ -309,10 +615,15 @@ def cache_populate(
         nuts2_id: str | None = None\n
         nuts3_id: str | None = None\n
         ts: datetime | None = None\n
+        components: str | None = None\n
+        input_line: str | None = None\n
+        input_country: str | None = None\n
     """
     with ErrorHandler():
         cache = get_cache()
-        for row in smart_stream_models(input_uri, GeocodingResult, input_format):
+        rows = stream_models(input_uri, GeocodingResult, input_format)
+        for chunk in chunked(rows, chunk_size):
             if apply_nuts:
-                row.apply_nuts()
-            cache.put(row.address_id, row)
+                chunk = apply_nuts_batch(chunk)
+            for row in chunk:
+                cache.put(row.address_id, row)
@@ -0,0 +1,217 @@
+"""
+Parallel, sharded export of the results cache
+
+The key space is split into shards by the prefix of the key hashes. Each shard
+is exported into its own part file (optionally by multiple worker processes),
+and finished shards are recorded in a checkpoint file next to the parts, so an
+interrupted export can be resumed by running it again.
+"""
+
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from pathlib import Path
+from typing import Iterable, Self
+
+from anystore.io import FORMAT_CSV, smart_open
+from ftmq.io import smart_write_proxies
+from pydantic import BaseModel
+
+from ftm_geocode.cache import get_shard_keys, iterate_result_data, iterate_results
+from ftm_geocode.io import (
+    FORMAT_FTM,
+    BatchWriter,
+    Formats,
+    get_schema,
+    get_writer,
+    is_columnar,
+    merge_batches,
+)
+from ftm_geocode.logging import get_logger
+from ftm_geocode.logic import warmup
+from ftm_geocode.model import GeocodingResult, apply_nuts_batch, apply_nuts_data
+from ftm_geocode.settings import Settings
+from ftm_geocode.util import chunked
+
+log = get_logger(__name__)
+settings = Settings()
+
+CHECKPOINT = "checkpoint.json"
+
+
+class ExportCheckpoint(BaseModel):
+    shards: int
+    output_format: Formats
+    done: dict[int, int] = {}  # shard -> number of exported results
+
+    @classmethod
+    def load(cls, path: Path, shards: int, output_format: Formats) -> Self:
+        if not path.exists():
+            return cls(shards=shards, output_format=output_format)
+        checkpoint = cls.model_validate_json(path.read_bytes())
+        if checkpoint.shards != shards:
+            raise ValueError(
+                f"Checkpoint `{path}` is for {checkpoint.shards} shards, not {shards}"
+            )
+        if checkpoint.output_format != output_format:
+            raise ValueError(
+                f"Checkpoint `{path}` is for `{checkpoint.output_format}` output, "
+                f"not `{output_format}`"
+            )
+        return checkpoint
+
+    def save(self, path: Path) -> None:
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(self.model_dump_json())
+        tmp.replace(path)
+
+
+def get_part_path(parts: Path, shard: int, output_format: Formats) -> Path:
+    return parts / f"part-{shard:05d}.{output_format}"
+
+
+def write_results(
+    uri: str | Path, results: Iterable[GeocodingResult], output_format: Formats
+) -> int:
+    """
+    Write results as csv, json, parquet, arrow or ftm entities, returns the
+    number written
+    """
+    if output_format == FORMAT_FTM:
+        return smart_write_proxies(uri, (r.to_proxy() for r in results))
+    count = 0
+    with get_writer(uri, output_format, GeocodingResult) as writer:
+        for result in results:
+            writer.write(result.model_dump(by_alias=True, mode="json"))
+            count += 1
+    return count
+
+
+def write_cached(
+    uri: str | Path,
+    output_format: Formats,
+    keys: Iterable[str] | None = None,
+    apply_nuts: bool | None = False,
+    chunk_size: int = settings.nuts_chunk_size,
+) -> int:
+    """
+    Write the cached results (optionally only the ones of the given keys),
+    returns the number written. Columnar output is written in record batches
+    from the deserialized data, without a model per result.
+    """
+    if is_columnar(output_format):
+        count = 0
+        schema = get_schema(GeocodingResult)
+        with BatchWriter(uri, output_format, schema) as writer:
+            for chunk in chunked(iterate_result_data(keys), chunk_size):
+                if apply_nuts:
+                    chunk = apply_nuts_data(chunk)
+                for row in chunk:
+                    writer.write(row)
+                count += len(chunk)
+        return count
+    results = iterate_results(keys)
+    if apply_nuts:
+        results = (r for c in chunked(results, chunk_size) for r in apply_nuts_batch(c))
+    return write_results(uri, results, output_format)
+
+
+def export_shard(
+    shard: int,
+    keys: list[str],
+    parts: Path,
+    output_format: Formats,
+    apply_nuts: bool | None = False,
+    chunk_size: int = settings.nuts_chunk_size,
+) -> int:
+    """
+    Export the results of one shard into its part file (written atomically)
+    """
+    path = get_part_path(parts, shard, output_format)
+    tmp = path.with_suffix(".tmp")
+    count = write_cached(tmp, output_format, keys, apply_nuts, chunk_size)
+    tmp.touch()  # empty shards
+    tmp.replace(path)
+    return count
+
+
+def export_results(
+    parts: Path,
+    output_format: Formats,
+    shards: int = 16,
+    workers: int = 1,
+    apply_nuts: bool | None = False,
+    chunk_size: int = settings.nuts_chunk_size,
+) -> int:
+    """
+    Export all cached results into one part file per shard in the `parts`
+    directory, using `workers` processes. The keys are partitioned into the
+    shards with one scan over the store. Shards that are already recorded in
+    the checkpoint of a previous run are skipped. Returns the number of results
+    exported in this run.
+    """
+    parts.mkdir(parents=True, exist_ok=True)
+    checkpoint_path = parts / CHECKPOINT
+    checkpoint = ExportCheckpoint.load(checkpoint_path, shards, output_format)
+    todo = [s for s in range(shards) if s not in checkpoint.done]
+    if checkpoint.done:
+        log.info("Resuming export", done=len(checkpoint.done), shards=shards)
+    keys = get_shard_keys(shards) if todo else {}
+    export = partial(
+        export_shard,
+        parts=parts,
+        output_format=output_format,
+        apply_nuts=apply_nuts,
+        chunk_size=chunk_size,
+    )
+
+    def _done(shard: int, count: int) -> None:
+        checkpoint.done[shard] = count
+        checkpoint.save(checkpoint_path)
+        log.info(f"Exported shard {shard}", results=count, done=len(checkpoint.done))
+
+    total = 0
+    if workers < 2:
+        for shard in todo:
+            count = export(shard, keys.pop(shard))
+            _done(shard, count)
+            total += count
+        return total
+
+    initializer = None
+    if settings.libpostal and output_format == FORMAT_FTM:
+        # converting to entities parses the result lines
+        warmup()
+        initializer = warmup
+    with ProcessPoolExecutor(workers, initializer=initializer) as executor:
+        futures = {
+            executor.submit(export, shard, keys.pop(shard)): shard for shard in todo
+        }
+        for future in as_completed(futures):
+            count = future.result()
+            _done(futures[future], count)
+            total += count
+    return total
+
+
+def merge_parts(
+    parts: Path, output_uri: str, output_format: Formats, shards: int = 16
+) -> None:
+    """
+    Concatenate the part files (in shard order) into one output stream
+    """
+    paths = [get_part_path(parts, shard, output_format) for shard in range(shards)]
+    if is_columnar(output_format):
+        schema = get_schema(GeocodingResult)
+        return merge_batches(paths, output_uri, output_format, schema)
+    header = False
+    with smart_open(output_uri, "wb") as out:
+        for path in paths:
+            with open(path, "rb") as fh:
+                if output_format == FORMAT_CSV:
+                    # only keep the csv header of the first non-empty part
+                    line = fh.readline()
+                    if line and not header:
+                        out.write(line)
+                        header = True
+                shutil.copyfileobj(fh, out)
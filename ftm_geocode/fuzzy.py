@@ -0,0 +1,206 @@
+"""
+Fuzzy matching of address lines against the cached results
+
+Variants of an already geocoded address line ("Str." vs "Straße", a different
+order of the parts, an additional company name, ...) have a different cache
+key. Before asking a geocoder, the line is compared to the original and result
+lines of the cached results within the same country.
+
+Lines are compared by their normalized (and with libpostal: expanded) tokens:
+Candidates sharing the rarest tokens of the line are scored by the trigram
+similarity of their tokens, and only if they contain the same numbers (house
+number, postcode). The best candidate with a score of at least
+`settings.fuzzy_threshold` is accepted.
+
+The index is built from the cache on its first use and updated as new results
+are cached.
+"""
+
+import threading
+import time
+from typing import Iterable, NamedTuple
+
+from ftm_geocode.cache import get_cache, iterate_raw_results, load_result
+from ftm_geocode.logging import get_logger
+from ftm_geocode.metrics import count, timed
+from ftm_geocode.model import GeocodingResult
+from ftm_geocode.settings import Settings
+from ftm_geocode.util import get_country_code, normalize_line
+
+log = get_logger(__name__)
+settings = Settings()
+
+BLOCKING_TOKENS = 2  # number of rarest tokens to look up candidates for
+MAX_CANDIDATES = 200  # per blocking token
+MAX_VARIANTS = 4  # libpostal expansions per line
+
+
+class Variant(NamedTuple):
+    tokens: frozenset[str]
+    numbers: frozenset[str]
+    trigrams: frozenset[str]
+
+
+def make_variant(line: str) -> Variant | None:
+    tokens = frozenset(line.split())
+    if not tokens:
+        return
+    numbers = frozenset(t for t in tokens if any(c.isdigit() for c in t))
+    trigrams: set[str] = set()
+    for token in tokens:
+        token = f" {token} "
+        trigrams.update(token[i : i + 3] for i in range(len(token) - 2))
+    return Variant(tokens, numbers, frozenset(trigrams))
+
+
+def get_variants(value: str) -> list[Variant]:
+    """Normalized variants of an address line (libpostal expansions if enabled)"""
+    lines = [normalize_line(value, latinize=True)]
+    if settings.libpostal:
+        from postal.expand import expand_address
+
+        lines.extend(normalize_line(v, latinize=True) for v in expand_address(value))
+    lines = list(dict.fromkeys(x for x in lines if x))[: MAX_VARIANTS + 1]
+    return [v for v in map(make_variant, lines) if v is not None]
+
+
+def similarity(a: Variant, b: Variant) -> float:
+    """
+    Mean of the jaccard similarity and the containment (of the smaller in the
+    larger one) of the token trigrams, 0 if the numbers differ
+    """
+    if a.numbers != b.numbers:
+        return 0.0
+    shared = len(a.trigrams & b.trigrams)
+    jaccard = shared / len(a.trigrams | b.trigrams)
+    containment = shared / min(len(a.trigrams), len(b.trigrams))
+    return (jaccard + containment) / 2
+
+
+class FuzzyIndex:
+    """
+    In-memory index of the normalized original and result lines of cached
+    results, blocked by country and token
+
+    Entries and postings are only ever appended (under the lock), so a search
+    reads the snapshot of the entries that existed when it started without
+    locking.
+    """
+
+    def __init__(self) -> None:
+        self._entries: list[tuple[str, Variant]] = []  # cache key, variant
+        self._tokens: dict[tuple[str | None, str], list[int]] = {}
+        self._keys: set[str] = set()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._keys
+
+    def add(self, key: str, result: GeocodingResult) -> None:
+        """Add a result by the key it is stored under"""
+        country = _get_country(result.country)
+        variants = [
+            v
+            for x in (result.original_line, result.result_line)
+            for v in get_variants(x)
+        ]
+        with self._lock:
+            if key in self._keys:
+                return
+            self._keys.add(key)
+            for variant in variants:
+                ix = len(self._entries)
+                self._entries.append((key, variant))
+                for token in variant.tokens:
+                    self._tokens.setdefault((country, token), []).append(ix)
+
+    def add_many(self, results: Iterable[tuple[str, GeocodingResult]]) -> None:
+        for key, result in results:
+            self.add(key, result)
+
+    def search(
+        self, value: str, country: str | None = None
+    ) -> tuple[str, float] | None:
+        """Find the cache key of the most similar line above the threshold"""
+        country = _get_country(country)
+        threshold = settings.fuzzy_threshold or 1.0
+        best: tuple[str, float] | None = None
+        variants = get_variants(value)
+        with self._lock:
+            entries, tokens, size = self._entries, self._tokens, len(self._entries)
+        for variant in variants:
+            postings = [tokens.get((country, t), []) for t in variant.tokens]
+            postings = sorted((p for p in postings if p), key=len)
+            candidates = {
+                ix
+                for p in postings[:BLOCKING_TOKENS]
+                for ix in p[:MAX_CANDIDATES]
+                if ix < size
+            }
+            for ix in candidates:
+                key, other = entries[ix]
+                score = similarity(variant, other)
+                if score >= threshold and (best is None or score > best[1]):
+                    best = key, score
+        return best
+
+
+def _get_country(value: str | None) -> str | None:
+    # the first country of a result (or the geocoding context)
+    return get_country_code((value or "").split(";")[0] or None)
+
+
+_index: FuzzyIndex | None = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> FuzzyIndex:
+    """Get the index, built from the cached results on first use"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            start = time.perf_counter()
+            index = FuzzyIndex()
+            results = ((k, load_result(v)) for k, v in iterate_raw_results())
+            index.add_many((k, r) for k, r in results if r is not None)
+            log.info(
+                "Built fuzzy index",
+                results=len(index),
+                seconds=round(time.perf_counter() - start, 2),
+            )
+            _index = index
+        return _index
+
+
+def index_result(key: str, result: GeocodingResult) -> None:
+    """Add a newly cached result to the index (if it is in use)"""
+    if _index is not None:
+        _index.add(key, result)
+
+
+@timed("fuzzy")
+def find_match(value: str, country: str | None = None) -> GeocodingResult | None:
+    """
+    Find a cached result for a similar address line (if fuzzy matching is
+    enabled). The returned result is a copy for the given line.
+    """
+    if not settings.fuzzy_threshold:
+        return
+    match = get_index().search(value, country)
+    if match is None:
+        count("fuzzy_misses")
+        return
+    key, score = match
+    result = get_cache().get(key)
+    if result is None:
+        return
+    log.debug(f"Fuzzy match: `{value}`", line=result.original_line, score=score)
+    count("fuzzy_hits")
+    data = result.model_dump()
+    data["original_line"] = value
+    data["input_line"] = value
+    data["input_country"] = country
+    return GeocodingResult(**data)
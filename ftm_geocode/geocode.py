@@ -1,29 +1,56 @@
+import asyncio
+import atexit
 import os
+import threading
+import time
 from datetime import datetime
-from typing import Any, Generator, TypedDict
+from typing import Any, AsyncGenerator, Generator, Iterable, Self, TypedDict
 
 import geopy.geocoders
-from anystore import anycache
 from banal import clean_dict
 from followthemoney.proxy import EntityProxy
 from ftmq.util import ensure_proxy
-from geopy.adapters import AdapterHTTPError
+from geopy.adapters import AdapterHTTPError, AioHTTPAdapter, RequestsAdapter
 from geopy.exc import GeocoderQueryError, GeocoderServiceError
-from geopy.extra.rate_limiter import RateLimiter
+from geopy.extra.rate_limiter import AsyncRateLimiter, RateLimiter
 from geopy.geocoders import get_geocoder_for_service
+from geopy.location import Location
 from normality import collapse_spaces
 
-from ftm_geocode.cache import get_cache, make_cache_key
-from ftm_geocode.io import FORMAT_FTM, Formats
+from ftm_geocode import fuzzy, reverse
+from ftm_geocode.cache import (
+    HotKey,
+    get_cache,
+    get_hot,
+    get_many,
+    is_miss,
+    make_cache_key,
+    make_hot_key,
+    put_hot,
+    put_many,
+    put_miss,
+)
+from ftm_geocode.fuzzy import find_match
+from ftm_geocode.health import ProviderUnavailable, health
+from ftm_geocode.io import FORMAT_FTM, Formats, PostalRow
 from ftm_geocode.logging import get_logger
-from ftm_geocode.model import Address, GeocodingResult, get_canonical_id
+from ftm_geocode.metrics import count, timer
+from ftm_geocode.model import (
+    Address,
+    GeocodingResult,
+    apply_nuts_batch,
+    get_canonical_id,
+)
 from ftm_geocode.settings import GEOCODERS, Settings
 from ftm_geocode.util import (
+    SingleFlight,
     apply_address,
+    chunked,
     get_country_name,
     get_proxy_addresses,
     normalize,
     normalize_google,
+    ordered_map,
 )
 
 settings = Settings()
@@ -34,12 +61,43 @@ geopy.geocoders.options.default_timeout = settings.default_timeout
 log = get_logger(__name__)
 
 
+def index_result(key: str, result: GeocodingResult) -> None:
+    """Add a newly cached result to the in-memory fuzzy and reverse indexes"""
+    fuzzy.index_result(key, result)
+    reverse.index_result(key, result)
+
+
+class TimedRateLimiter(RateLimiter):
+    """Rate limiter that counts the time spent waiting per geocoder"""
+
+    def __init__(self, *args: Any, name: str | None = None, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.name = name
+
+    def _sleep(self, seconds: float) -> None:
+        count("rate_limit_sleep_seconds", seconds, geocoder=self.name)
+        super()._sleep(seconds)
+
+
+class TimedAsyncRateLimiter(AsyncRateLimiter):
+    """Async rate limiter that counts the time spent waiting per geocoder"""
+
+    def __init__(self, *args: Any, name: str | None = None, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.name = name
+
+    async def _sleep(self, seconds: float) -> None:
+        count("rate_limit_sleep_seconds", seconds, geocoder=self.name)
+        await super()._sleep(seconds)
+
+
 class GeocodingContext(TypedDict):
     country: str | None
     language: str | None
 
 
 class Geocoder:
+    RATE_LIMITER = TimedRateLimiter
     SETTINGS = {
         GEOCODERS.nominatim: {
             "config": {
@@ -62,10 +120,76 @@ class Geocoder:
         },
     }
 
-    def __init__(self, geocoder: GEOCODERS):
+    def __init__(self, geocoder: GEOCODERS, pool_size: int | None = None):
+        self.name = geocoder
+        # keep-alive connection pool, large enough for all concurrent workers
+        self.pool_size = max(10, pool_size or settings.workers)
         self._settings = self.SETTINGS.get(geocoder, {})
         config = clean_dict(self._settings.get("config", {}))
+        config.update(get_service_url(geocoder))
+        config["adapter_factory"] = self.make_adapter
         self.geocoder = get_geocoder_for_service(geocoder.value)(**config)
+        self.breaker = health.get_breaker(geocoder)
+        self._dispatched = False
+        self._pool_lock = threading.Lock()
+        self.geocode = self.RATE_LIMITER(
+            self.attempt,
+            min_delay_seconds=get_min_delay(geocoder),
+            max_retries=settings.max_retries,
+            error_wait_seconds=settings.retry_wait_seconds,
+            swallow_exceptions=False,  # handled (and counted) after the retries
+            name=geocoder.value,
+        )
+
+    def make_adapter(self, **kwargs: Any) -> RequestsAdapter:
+        size = self.pool_size
+        return RequestsAdapter(pool_connections=size, pool_maxsize=size, **kwargs)
+
+    def grow_pool(self, pool_size: int) -> None:
+        """
+        Replace the connection pool by a larger one for more workers (and close
+        the previous one). This is only possible before the first request, the
+        pool in use is not changed.
+        """
+        if pool_size <= self.pool_size:
+            return
+        with self._pool_lock:
+            if self._dispatched:
+                log.debug(
+                    "Connection pool in use, not resizing",
+                    geocoder=self.name.value,
+                    pool_size=self.pool_size,
+                )
+                return
+            self.pool_size = pool_size
+            geocoder = self.geocoder
+            adapter = geocoder.adapter
+            geocoder.adapter = self.make_adapter(
+                proxies=geocoder.proxies, ssl_context=geocoder.ssl_context
+            )
+            adapter.__exit__(None, None, None)
+
+    def attempt(self, query: str, **kwargs: Any) -> Location | None:
+        if not self._dispatched:
+            with self._pool_lock:  # wait for a resizing pool
+                self._dispatched = True
+        # each attempt of the rate limiter (including its retries) passes the
+        # circuit breaker, so that retrying stops once the circuit opens
+        if not self.breaker.allow():
+            raise ProviderUnavailable(self.name)
+        try:
+            result = self.geocoder.geocode(query, **kwargs)
+        except GeocoderQueryError:
+            self.breaker.success()  # the service is up, the query is invalid
+            raise
+        except (AdapterHTTPError, GeocoderServiceError):
+            self.breaker.failure()
+            raise
+        self.breaker.success()
+        return result
+
+    def close(self) -> None:
+        self.geocoder.__exit__(None, None, None)
 
     def get_params(self, **ctx: GeocodingContext) -> dict[str, Any]:
         func = self._settings.get("params", lambda **ctx: {})
@@ -76,42 +200,280 @@ class Geocoder:
         return func(query, **ctx)
 
 
-@anycache(
-    store=get_cache(),
-    key_func=lambda _, v, **kwargs: make_cache_key(v, **kwargs),
-    model=GeocodingResult,
-)
+class AsyncGeocoder(Geocoder):
+    """
+    Geocoder using geopy's aiohttp adapter, `geocode` returns a coroutine
+    """
+
+    RATE_LIMITER = TimedAsyncRateLimiter
+
+    def make_adapter(self, **kwargs: Any) -> AioHTTPAdapter:
+        try:
+            import aiohttp  # noqa: F401
+        except ImportError:
+            raise ImportError("Please install `ftm-geocode[async]` for async geocoding")
+        return AioHTTPAdapter(**kwargs)
+
+    async def attempt(self, query: str, **kwargs: Any) -> Location | None:
+        if not self.breaker.allow():
+            raise ProviderUnavailable(self.name)
+        try:
+            result = await self.geocoder.geocode(query, **kwargs)
+        except GeocoderQueryError:
+            self.breaker.success()
+            raise
+        except (AdapterHTTPError, GeocoderServiceError):
+            self.breaker.failure()
+            raise
+        self.breaker.success()
+        return result
+
+    async def aclose(self) -> None:
+        await self.geocoder.__aexit__(None, None, None)
+
+
+def get_service_url(geocoder: GEOCODERS) -> dict[str, str]:
+    # geopy config for a custom service url: `{"scheme": ..., "domain": ...}`
+    url = settings.geocoder_urls.get(geocoder)
+    if not url:
+        return {}
+    scheme, _, domain = url.rpartition("://")
+    return clean_dict({"scheme": scheme, "domain": domain.rstrip("/")})
+
+
+def get_min_delay(geocoder: GEOCODERS) -> float:
+    return settings.provider_delay_seconds.get(geocoder, settings.min_delay_seconds)
+
+
+class GeocoderRegistry:
+    """
+    Process-level registry of configured geocoders. Each geocoder (with its
+    http connection pool and rate limiter) is created once and shared by all
+    geocoding calls and threads until the registry is closed.
+
+    Example:
+        ```python
+        with registry:
+            for line in lines:
+                geocode_line([GEOCODERS.nominatim], line)
+        ```
+    """
+
+    def __init__(self) -> None:
+        self._geocoders: dict[GEOCODERS, Geocoder] = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def get(self, geocoder: GEOCODERS, pool_size: int | None = None) -> Geocoder:
+        """
+        Get the shared geocoder, its connection pool holds at least `pool_size`
+        (default: `settings.workers`) connections
+        """
+        with self._lock:
+            if geocoder not in self._geocoders:
+                log.debug("Setting up geocoder", geocoder=geocoder.value)
+                self._geocoders[geocoder] = Geocoder(geocoder, pool_size)
+            elif pool_size is not None:
+                self._geocoders[geocoder].grow_pool(pool_size)
+            return self._geocoders[geocoder]
+
+    def close(self) -> None:
+        with self._lock:
+            for geocoder in self._geocoders.values():
+                geocoder.close()
+            self._geocoders = {}
+
+
+class AsyncGeocoderRegistry:
+    """
+    Registry of async geocoders sharing aiohttp sessions and rate limiters.
+    The sessions are bound to the running event loop, so the registry needs to
+    be closed before that loop ends.
+
+    Example:
+        ```python
+        async with async_registry:
+            results = await asyncio.gather(
+                *(geocode_line_async([GEOCODERS.nominatim], l) for l in lines)
+            )
+        ```
+    """
+
+    def __init__(self) -> None:
+        self._geocoders: dict[GEOCODERS, AsyncGeocoder] = {}
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        await self.close()
+
+    def get(self, geocoder: GEOCODERS) -> AsyncGeocoder:
+        if geocoder not in self._geocoders:
+            log.debug("Setting up async geocoder", geocoder=geocoder.value)
+            self._geocoders[geocoder] = AsyncGeocoder(geocoder)
+        return self._geocoders[geocoder]
+
+    async def close(self) -> None:
+        geocoders, self._geocoders = self._geocoders.values(), {}
+        for geocoder in geocoders:
+            await geocoder.aclose()
+
+
+registry = GeocoderRegistry()
+atexit.register(registry.close)
+async_registry = AsyncGeocoderRegistry()
+
+
+class AddressDeduplicator:
+    """
+    Per-run registry of address lines: Each distinct line (and country) is
+    normalized and keyed only once. Counts all lines to report the ratio of
+    duplicates at the end of a run.
+    """
+
+    def __init__(self) -> None:
+        self.total = 0
+        self._keys: dict[HotKey, str | None] = {}
+        self._lock = threading.Lock()
+
+    def get_key(self, value: str, **ctx: GeocodingContext) -> str | None:
+        hot_key = make_hot_key(value, ctx.get("country"))
+        with self._lock:
+            self.total += 1
+            if hot_key in self._keys:
+                return self._keys[hot_key]
+        key = _get_key(value, **ctx)
+        with self._lock:
+            self._keys[hot_key] = key
+        return key
+
+    @property
+    def unique(self) -> int:
+        return len(self._keys)
+
+    @property
+    def ratio(self) -> float:
+        """Share of duplicate lines"""
+        if not self.total:
+            return 0.0
+        return (self.total - self.unique) / self.total
+
+    def get_stats(self) -> dict[str, int | float]:
+        return {"lines": self.total, "unique": self.unique, "ratio": self.ratio}
+
+
+_in_flight: SingleFlight[Any, GeocodingResult | None] = SingleFlight()
+
+
+def get_geocoder(geocoder: GEOCODERS, pool_size: int | None = None) -> Geocoder:
+    return registry.get(geocoder, pool_size)
+
+
 def _geocode(
     geocoder: GEOCODERS,
     value: str,
     use_cache: bool | None = True,
     cache_only: bool | None = False,
+    retry_misses: bool | None = False,
     **ctx: GeocodingContext,
 ) -> GeocodingResult | None:
-    if cache_only:
+    cache = get_cache()
+    key = make_cache_key(value, use_cache=use_cache, **ctx)
+    result = None
+    if key is not None:
+        with timer("cache_read"):
+            result = cache.get(key)
+        if result is not None:
+            count("cache_hits", geocoder=geocoder.value)
+            backfill_components({key: result})
+            return result
+        count("cache_misses", geocoder=geocoder.value)
+        # a cached result of a similar line (if fuzzy matching is enabled)
+        result = find_match(value, ctx.get("country"))
+    if result is None and not cache_only:
+        result = _geocode_provider(
+            geocoder, value, use_cache=use_cache, retry_misses=retry_misses, **ctx
+        )
+    if result is not None and key is not None:
+        with timer("cache_write"):
+            cache.put(key, result)
+        index_result(key, result)
+    return result
+
+
+def _geocode_provider(
+    geocoder: GEOCODERS,
+    value: str,
+    use_cache: bool | None = True,
+    retry_misses: bool | None = False,
+    **ctx: GeocodingContext,
+) -> GeocodingResult | None:
+    # the actual geocoding request, skipped for recently unmatched lines
+    key = _get_key(value, **ctx) if use_cache else None
+    if key is not None and not retry_misses and is_miss(geocoder, key):
+        log.debug(f"Skipping recent miss: `{value}`", geocoder=geocoder.value)
+        count("provider_skipped_misses", geocoder=geocoder.value)
         return
-    geolocator = Geocoder(geocoder)
-    value = geolocator.get_query(value, **ctx)
+    geolocator = get_geocoder(geocoder)
+    if geolocator.breaker.is_open():
+        count("provider_skipped_open", geocoder=geocoder.value)
+        return
+    query = geolocator.get_query(value, **ctx)
     geocoding_params = geolocator.get_params(**ctx)
-    geocode = RateLimiter(
-        geolocator.geocoder.geocode,
-        min_delay_seconds=settings.min_delay_seconds,
-        max_retries=settings.max_retries,
-    )
 
+    start = time.perf_counter()
     try:
-        result = geocode(value, **geocoding_params)
+        with timer("provider", geocoder=geocoder.value):
+            result = geolocator.geocode(query, **geocoding_params)
+    except ProviderUnavailable:
+        count("provider_skipped_open", geocoder=geocoder.value)
+        return
     except (AdapterHTTPError, GeocoderQueryError, GeocoderServiceError) as e:
-        result = None
         log.error(
-            f"{e}: {e.message} `{value}`",
+            f"{type(e).__name__}: {e} `{query}`",
             geocoder=geocoder.value,
             **geocoding_params,
         )
+        count("provider_errors", geocoder=geocoder.value, error=type(e).__name__)
+        health.observe(
+            geocoder, ctx.get("country"), time.perf_counter() - start, error=True
+        )
+        return
+
+    health.observe(
+        geocoder,
+        ctx.get("country"),
+        time.perf_counter() - start,
+        matched=result is not None,
+    )
 
+    if result is None:
+        count("provider_no_matches", geocoder=geocoder.value)
+    else:
+        count("provider_matches", geocoder=geocoder.value)
+    if result is None and key is not None:
+        put_miss(geocoder, key)
+    return _make_result(geocoder, value, query, result, geocoding_params, **ctx)
+
+
+def _make_result(
+    geocoder: GEOCODERS,
+    value: str,
+    query: str,
+    result: Location | None,
+    geocoding_params: dict[str, Any],
+    **ctx: GeocodingContext,
+) -> GeocodingResult | None:
+    # `value` is the looked up line, `query` what was sent to the geocoder
     if result is not None:
         log.info(
-            f"Geocoder hit: `{value}`",
+            f"Geocoder hit: `{query}`",
             geocoder=geocoder.value,
             **geocoding_params,
         )
@@ -124,7 +486,9 @@ def _geocode(
         result = GeocodingResult(
             cache_key=make_cache_key(value, **ctx),
             address_id=address_id,
-            original_line=value,
+            original_line=query,
+            input_line=value,
+            input_country=ctx.get("country"),
             result_line=result.address,
             country=address.get_country(),
             lat=result.latitude,
@@ -134,31 +498,69 @@ def _geocode(
             geocoder_raw=result.raw,
             ts=datetime.now(),
         )
+        if settings.libpostal:
+            result.get_components()  # store parsed result line along with it
         return result
 
 
+def backfill_components(results: dict[str, GeocodingResult]) -> None:
+    """
+    Store the parsed postal components with cached results that don't have
+    them yet (only with libpostal)
+    """
+    if settings.libpostal:
+        missing = {k: r for k, r in results.items() if r.components is None}
+        if missing:
+            for result in missing.values():
+                result.get_components()
+            put_many(missing)
+
+
 def geocode_line(
     geocoders: list[GEOCODERS],
     value: str,
     use_cache: bool | None = True,
     cache_only: bool | None = False,
+    retry_misses: bool | None = False,
     apply_nuts: bool | None = False,
     **ctx: GeocodingContext,
 ) -> GeocodingResult | None:
     cleaned_value = collapse_spaces(value)
     if cleaned_value:
-        for geocoder in geocoders:
-            result = _geocode(
-                geocoder,
-                cleaned_value,
-                use_cache=use_cache,
-                cache_only=cache_only,
-                **ctx,
+        country = ctx.get("country")
+
+        def _resolve() -> GeocodingResult | None:
+            for geocoder in health.rank(geocoders, country):
+                result = _geocode(
+                    geocoder,
+                    cleaned_value,
+                    use_cache=use_cache,
+                    cache_only=cache_only,
+                    retry_misses=retry_misses,
+                    **ctx,
+                )
+                if result is not None:
+                    put_hot(cleaned_value, country, result)
+                    return result
+
+        result = get_hot(cleaned_value, country) if use_cache else None
+        if result is not None:
+            count("hot_hits")
+        else:
+            # concurrent calls for the same line wait for the one in flight
+            flight_key = (
+                make_hot_key(cleaned_value, country),
+                tuple(geocoders),
+                use_cache,
+                cache_only,
+                retry_misses,
             )
-            if result is not None:
-                if apply_nuts:
-                    result.apply_nuts()
-                return result
+            result = _in_flight.do(flight_key, _resolve)
+        if result is not None:
+            if apply_nuts:
+                result = result.model_copy()
+                result.apply_nuts()
+            return result
 
     log.warning(f"No geocoding match found: `{value}`", geocoders=geocoders)
 
@@ -168,6 +570,7 @@ def geocode_proxy(
     proxy: EntityProxy | dict[str, Any],
     use_cache: bool | None = True,
     cache_only: bool | None = False,
+    retry_misses: bool | None = False,
     apply_nuts: bool | None = False,
     output_format: Formats | None = FORMAT_FTM,
     rewrite_ids: bool | None = True,
@@ -178,7 +581,6 @@ def geocode_proxy(
             yield proxy
         return
 
-    is_address = proxy.schema.is_a("Address")
     ctx = {"country": proxy.first("country") or ""}
     results = (
         geocode_line(
@@ -186,11 +588,23 @@ def geocode_proxy(
             value,
             use_cache=use_cache,
             cache_only=cache_only,
+            retry_misses=retry_misses,
             apply_nuts=apply_nuts,
             **ctx,
         )
         for value in get_proxy_addresses(proxy)
     )
+    yield from _apply_results(proxy, results, output_format, rewrite_ids, **ctx)
+
+
+def _apply_results(
+    proxy: EntityProxy,
+    results: Iterable[GeocodingResult | None],
+    output_format: Formats | None = FORMAT_FTM,
+    rewrite_ids: bool | None = True,
+    **ctx: GeocodingContext,
+) -> Generator[EntityProxy | GeocodingResult, None, None]:
+    is_address = proxy.schema.is_a("Address")
     if output_format == FORMAT_FTM:
         for result in results:
             if result is not None:
@@ -209,3 +623,410 @@ def geocode_proxy(
         for result in results:
             if result is not None:
                 yield result
+
+
+def geocode_lines(
+    geocoders: list[GEOCODERS],
+    rows: Iterable[PostalRow],
+    use_cache: bool | None = True,
+    cache_only: bool | None = False,
+    retry_misses: bool | None = False,
+    apply_nuts: bool | None = False,
+    workers: int | None = 1,
+    chunk_size: int | None = None,
+    dedup: AddressDeduplicator | None = None,
+) -> Generator[GeocodingResult | None, None, None]:
+    """
+    Geocode a stream of address rows in chunks via `geocode_bulk` (bulk cache
+    lookups, concurrent geocoding of misses). Results are yielded in input
+    order, rate limits are shared per geocoder across workers.
+    """
+    for chunk in chunked(rows, chunk_size or settings.geocode_chunk_size):
+        values = [(r.original_line, {"country": r.country}) for r in chunk]
+        resolved = geocode_bulk(
+            geocoders,
+            values,
+            use_cache=use_cache,
+            cache_only=cache_only,
+            retry_misses=retry_misses,
+            apply_nuts=apply_nuts,
+            workers=workers,
+            dedup=dedup,
+        )
+        for value, ctx in values:
+            yield resolved.get(make_hot_key(value, ctx["country"]))
+
+
+def geocode_proxies(
+    geocoders: list[GEOCODERS],
+    proxies: Iterable[EntityProxy | dict[str, Any]],
+    use_cache: bool | None = True,
+    cache_only: bool | None = False,
+    retry_misses: bool | None = False,
+    apply_nuts: bool | None = False,
+    output_format: Formats | None = FORMAT_FTM,
+    rewrite_ids: bool | None = True,
+    workers: int | None = 1,
+    chunk_size: int | None = None,
+    timeout: float | None = None,
+    dedup: AddressDeduplicator | None = None,
+) -> Generator[EntityProxy | GeocodingResult, None, None]:
+    """
+    Geocode a stream of entities in chunks via `geocode_proxies_bulk`. Results
+    are yielded in input order, rate limits are shared per geocoder across
+    workers. The `timeout` is the time budget for the whole stream.
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    for chunk in chunked(proxies, chunk_size or settings.geocode_chunk_size):
+        if deadline is not None:
+            timeout = max(deadline - time.monotonic(), 0)
+        yield from geocode_proxies_bulk(
+            geocoders,
+            chunk,
+            use_cache=use_cache,
+            cache_only=cache_only,
+            retry_misses=retry_misses,
+            apply_nuts=apply_nuts,
+            output_format=output_format,
+            rewrite_ids=rewrite_ids,
+            workers=workers,
+            timeout=timeout,
+            dedup=dedup,
+        )
+
+
+def _get_key(value: str, **ctx: GeocodingContext) -> str | None:
+    value = collapse_spaces(value)
+    if value:
+        try:
+            return make_cache_key(value, **ctx)
+        except AssertionError:  # line normalizes to nothing
+            return
+
+
+def geocode_bulk(
+    geocoders: list[GEOCODERS],
+    values: Iterable[tuple[str, GeocodingContext]],
+    use_cache: bool | None = True,
+    cache_only: bool | None = False,
+    retry_misses: bool | None = False,
+    apply_nuts: bool | None = False,
+    workers: int | None = 1,
+    timeout: float | None = None,
+    dedup: AddressDeduplicator | None = None,
+) -> dict[HotKey, GeocodingResult | None]:
+    """
+    Resolve many address lines at once: Lines are first looked up in the
+    in-process cache, then the distinct remaining lines in the cache store with
+    one bulk read. The misses are geocoded concurrently and the new results are
+    written back to the cache in one batch.
+
+    Args:
+        geocoders: Geocoders to use (in order)
+        values: Address lines with their geocoding context
+        use_cache: Lookup cache before geocoding
+        cache_only: Only lookup cache (including fuzzy matches)
+        apply_nuts: Add EU nuts codes
+        workers: Number of concurrent geocoding workers
+        timeout: Time budget in seconds, after it lines are not submitted to
+            geocoders anymore (they are missing in the result)
+        dedup: Keep track of (and key only once) all lines of a run
+
+    Returns:
+        Results (or `None` for no match) by their line and country (see
+            `cache.make_hot_key`)
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    resolved: dict[HotKey, GeocodingResult | None] = {}
+    lookups: dict[HotKey, str] = {}
+    todo: dict[str, tuple[str, GeocodingContext]] = {}
+    dedup = dedup or AddressDeduplicator()
+    for value, ctx in values:
+        key = dedup.get_key(value, **ctx)
+        hot_key = make_hot_key(value, ctx.get("country"))
+        if hot_key in resolved or hot_key in lookups:
+            continue
+        result = get_hot(*hot_key) if use_cache else None
+        if result is not None:
+            resolved[hot_key] = result
+            continue
+        if key is not None:
+            lookups[hot_key] = key
+            todo.setdefault(key, (value, ctx))
+
+    results: dict[str, GeocodingResult | None] = {}
+    if use_cache:
+        results.update(get_many(todo.keys()))
+        backfill_components(results)
+    misses = [k for k in todo if k not in results]
+    count("hot_hits", len(resolved))
+    count("cache_hits", len(results))
+    count("cache_misses", len(misses))
+    log.info(
+        "Bulk geocoding",
+        lines=len(lookups) + len(resolved),
+        hot_hits=len(resolved),
+        cache_hits=len(results),
+    )
+
+    def _geocode_miss(key: str) -> tuple[str, GeocodingResult | None]:
+        value, ctx = todo[key]
+        value = collapse_spaces(value)
+
+        def _resolve() -> GeocodingResult | None:
+            # a cached result of a similar line (if fuzzy matching is enabled)
+            result = find_match(value, ctx.get("country")) if use_cache else None
+            if result is not None or cache_only:
+                return result
+            for geocoder in health.rank(geocoders, ctx.get("country")):
+                result = _geocode_provider(
+                    geocoder,
+                    value,
+                    use_cache=use_cache,
+                    retry_misses=retry_misses,
+                    **ctx,
+                )
+                if result is not None:
+                    return result
+            log.warning(f"No geocoding match found: `{value}`", geocoders=geocoders)
+
+        flight_key = (key, tuple(geocoders), use_cache, cache_only, retry_misses)
+        return key, _in_flight.do(flight_key, _resolve)
+
+    def _until_deadline(keys: list[str]) -> Generator[str, None, None]:
+        for ix, key in enumerate(keys):
+            if deadline is not None and time.monotonic() > deadline:
+                log.warning("Geocoding time budget exceeded", skipped=len(keys) - ix)
+                return
+            yield key
+
+    if misses and workers and not cache_only:
+        for geocoder in geocoders:
+            get_geocoder(geocoder, pool_size=workers)
+    # with `cache_only`, misses are only fuzzy matched against the cache
+    new = dict(ordered_map(_geocode_miss, _until_deadline(misses), workers))
+    if use_cache:
+        new_results = {k: r for k, r in new.items() if r is not None}
+        put_many(new_results)
+        for key, result in new_results.items():
+            index_result(key, result)
+    results.update(new)
+
+    for hot_key, key in lookups.items():
+        if key in results:
+            result = results[key]
+            resolved[hot_key] = result
+            if result is not None:
+                put_hot(*hot_key, result)
+    if apply_nuts:
+        # don't change the results in the in-process cache
+        copies = {k: r.model_copy() for k, r in resolved.items() if r is not None}
+        apply_nuts_batch(copies.values())
+        resolved.update(copies)
+    return resolved
+
+
+def geocode_proxies_bulk(
+    geocoders: list[GEOCODERS],
+    proxies: Iterable[EntityProxy | dict[str, Any]],
+    use_cache: bool | None = True,
+    cache_only: bool | None = False,
+    retry_misses: bool | None = False,
+    apply_nuts: bool | None = False,
+    output_format: Formats | None = FORMAT_FTM,
+    rewrite_ids: bool | None = True,
+    workers: int | None = 1,
+    timeout: float | None = None,
+    dedup: AddressDeduplicator | None = None,
+) -> Generator[EntityProxy | GeocodingResult, None, None]:
+    """
+    Geocode a batch of entities: All their distinct addresses are resolved at
+    once via `geocode_bulk` before the entities are rewritten.
+    """
+    proxies = [ensure_proxy(p) for p in proxies]
+    values = (
+        (value, {"country": proxy.first("country") or ""})
+        for proxy in proxies
+        if proxy.schema.is_a("Thing")
+        for value in get_proxy_addresses(proxy)
+    )
+    resolved = geocode_bulk(
+        geocoders,
+        values,
+        use_cache=use_cache,
+        cache_only=cache_only,
+        retry_misses=retry_misses,
+        apply_nuts=apply_nuts,
+        workers=workers,
+        timeout=timeout,
+        dedup=dedup,
+    )
+    for proxy in proxies:
+        if not proxy.schema.is_a("Thing"):
+            if output_format == FORMAT_FTM:
+                yield proxy
+            continue
+        ctx = {"country": proxy.first("country") or ""}
+        results = (
+            resolved.get(make_hot_key(value, ctx["country"]))
+            for value in get_proxy_addresses(proxy)
+        )
+        yield from _apply_results(proxy, results, output_format, rewrite_ids, **ctx)
+
+
+async def _geocode_async(
+    geocoder: GEOCODERS,
+    value: str,
+    use_cache: bool | None = True,
+    cache_only: bool | None = False,
+    retry_misses: bool | None = False,
+    **ctx: GeocodingContext,
+) -> GeocodingResult | None:
+    # same as `_geocode`, the (sync) cache store is accessed in worker threads
+    cache = get_cache()
+    key = make_cache_key(value, use_cache=use_cache, **ctx)
+    if key is not None:
+        with timer("cache_read"):
+            result = await asyncio.to_thread(cache.get, key, raise_on_nonexist=False)
+        if result is not None:
+            count("cache_hits", geocoder=geocoder.value)
+            await asyncio.to_thread(backfill_components, {key: result})
+            return result
+        count("cache_misses", geocoder=geocoder.value)
+        result = await asyncio.to_thread(find_match, value, ctx.get("country"))
+        if result is not None:
+            await asyncio.to_thread(cache.put, key, result)
+            index_result(key, result)
+            return result
+    if cache_only:
+        return
+    if key is not None and not retry_misses:
+        if await asyncio.to_thread(is_miss, geocoder, key):
+            log.debug(f"Skipping recent miss: `{value}`", geocoder=geocoder.value)
+            count("provider_skipped_misses", geocoder=geocoder.value)
+            return
+    geolocator = async_registry.get(geocoder)
+    if geolocator.breaker.is_open():
+        count("provider_skipped_open", geocoder=geocoder.value)
+        return
+    query = geolocator.get_query(value, **ctx)
+    geocoding_params = geolocator.get_params(**ctx)
+
+    start = time.perf_counter()
+    try:
+        with timer("provider", geocoder=geocoder.value):
+            result = await geolocator.geocode(query, **geocoding_params)
+    except ProviderUnavailable:
+        count("provider_skipped_open", geocoder=geocoder.value)
+        return
+    except (AdapterHTTPError, GeocoderQueryError, GeocoderServiceError) as e:
+        log.error(
+            f"{type(e).__name__}: {e} `{query}`",
+            geocoder=geocoder.value,
+            **geocoding_params,
+        )
+        count("provider_errors", geocoder=geocoder.value, error=type(e).__name__)
+        health.observe(
+            geocoder, ctx.get("country"), time.perf_counter() - start, error=True
+        )
+        return
+
+    health.observe(
+        geocoder,
+        ctx.get("country"),
+        time.perf_counter() - start,
+        matched=result is not None,
+    )
+
+    if result is None:
+        count("provider_no_matches", geocoder=geocoder.value)
+    else:
+        count("provider_matches", geocoder=geocoder.value)
+    if result is None and key is not None:
+        await asyncio.to_thread(put_miss, geocoder, key)
+    result = _make_result(geocoder, value, query, result, geocoding_params, **ctx)
+    if result is not None and key is not None:
+        with timer("cache_write"):
+            await asyncio.to_thread(cache.put, key, result)
+        index_result(key, result)
+    return result
+
+
+async def geocode_line_async(
+    geocoders: list[GEOCODERS],
+    value: str,
+    use_cache: bool | None = True,
+    cache_only: bool | None = False,
+    retry_misses: bool | None = False,
+    apply_nuts: bool | None = False,
+    **ctx: GeocodingContext,
+) -> GeocodingResult | None:
+    """
+    Async counterpart of `geocode_line`, using the geocoders from
+    `async_registry`
+    """
+    cleaned_value = collapse_spaces(value)
+    if cleaned_value:
+        country = ctx.get("country")
+        result = get_hot(cleaned_value, country) if use_cache else None
+        if result is not None:
+            count("hot_hits")
+        else:
+            for geocoder in health.rank(geocoders, country):
+                result = await _geocode_async(
+                    geocoder,
+                    cleaned_value,
+                    use_cache=use_cache,
+                    cache_only=cache_only,
+                    retry_misses=retry_misses,
+                    **ctx,
+                )
+                if result is not None:
+                    put_hot(cleaned_value, country, result)
+                    break
+        if result is not None:
+            if apply_nuts:
+                result = result.model_copy()
+                result.apply_nuts()
+            return result
+
+    log.warning(f"No geocoding match found: `{value}`", geocoders=geocoders)
+
+
+async def geocode_proxy_async(
+    geocoder: list[GEOCODERS],
+    proxy: EntityProxy | dict[str, Any],
+    use_cache: bool | None = True,
+    cache_only: bool | None = False,
+    retry_misses: bool | None = False,
+    apply_nuts: bool | None = False,
+    output_format: Formats | None = FORMAT_FTM,
+    rewrite_ids: bool | None = True,
+) -> AsyncGenerator[EntityProxy | GeocodingResult, None]:
+    """
+    Async counterpart of `geocode_proxy`, the addresses of the entity are
+    geocoded concurrently.
+    """
+    proxy = ensure_proxy(proxy)
+    if not proxy.schema.is_a("Thing"):
+        if output_format == FORMAT_FTM:
+            yield proxy
+        return
+
+    ctx = {"country": proxy.first("country") or ""}
+    results = await asyncio.gather(
+        *(
+            geocode_line_async(
+                geocoder,
+                value,
+                use_cache=use_cache,
+                cache_only=cache_only,
+                retry_misses=retry_misses,
+                apply_nuts=apply_nuts,
+                **ctx,
+            )
+            for value in get_proxy_addresses(proxy)
+        )
+    )
+    for result in _apply_results(proxy, results, output_format, rewrite_ids, **ctx):
+        yield result
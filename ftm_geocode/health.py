@@ -0,0 +1,194 @@
+"""
+Health of the geocoding providers: circuit breakers and observed performance
+
+A provider that fails `settings.breaker_threshold` times in a row is skipped
+(its circuit is open) for `settings.breaker_timeout` seconds. After that, one
+probe request is let through (half-open): on success the circuit closes again,
+on failure it stays open for another timeout.
+
+Optionally, the chain of geocoders is reordered per country by the observed
+seconds per match (`settings.adaptive_geocoders`).
+"""
+
+import threading
+import time
+from enum import StrEnum
+from typing import Callable, Iterable
+
+from pydantic import BaseModel
+
+from ftm_geocode.logging import get_logger
+from ftm_geocode.metrics import count
+from ftm_geocode.settings import GEOCODERS, Settings
+
+log = get_logger(__name__)
+settings = Settings()
+
+
+class ProviderUnavailable(Exception):
+    """The circuit of this provider is open"""
+
+
+class CircuitState(StrEnum):
+    closed = "closed"
+    open = "open"
+    half_open = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Thread-safe circuit breaker for one provider. `threshold=0` disables it.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        threshold: int,
+        timeout: float,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.name = name
+        self.threshold = threshold
+        self.timeout = timeout
+        self.failures = 0
+        self._clock = clock
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> CircuitState:
+        with self._lock:
+            return self._get_state()
+
+    def _get_state(self) -> CircuitState:
+        if not self.threshold or self.failures < self.threshold:
+            return CircuitState.closed
+        if self._clock() - self._opened_at >= self.timeout:
+            return CircuitState.half_open
+        return CircuitState.open
+
+    def is_open(self) -> bool:
+        """Check (without taking the probe) if requests would be rejected"""
+        with self._lock:
+            state = self._get_state()
+            return state == CircuitState.open or (
+                state == CircuitState.half_open and self._probing
+            )
+
+    def allow(self) -> bool:
+        """Check if a request may be sent, a half-open circuit allows one probe"""
+        with self._lock:
+            state = self._get_state()
+            if state == CircuitState.closed:
+                return True
+            if state == CircuitState.half_open and not self._probing:
+                log.info("Probing provider", geocoder=self.name)
+                self._probing = True
+                return True
+            return False
+
+    def success(self) -> None:
+        with self._lock:
+            if self.threshold and self.failures >= self.threshold:
+                log.info("Circuit closed", geocoder=self.name)
+            self.failures = 0
+            self._probing = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.threshold and (self._probing or self.failures == self.threshold):
+                log.warning("Circuit open", geocoder=self.name, timeout=self.timeout)
+                count("circuit_opened", geocoder=self.name)
+                self._opened_at = self._clock()
+            self._probing = False
+
+
+class ProviderStats(BaseModel):
+    requests: int = 0
+    matches: int = 0
+    errors: int = 0
+    seconds: float = 0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.matches / self.requests if self.requests else 0.0
+
+    @property
+    def cost(self) -> float:
+        """Seconds spent per match"""
+        return self.seconds / self.matches if self.matches else float("inf")
+
+
+class ProviderHealth:
+    """
+    Process-wide registry of circuit breakers and observed performance per
+    provider and country
+    """
+
+    def __init__(self) -> None:
+        self._breakers: dict[GEOCODERS, CircuitBreaker] = {}
+        self._stats: dict[tuple[GEOCODERS, str | None], ProviderStats] = {}
+        self._lock = threading.Lock()
+
+    def get_breaker(self, geocoder: GEOCODERS) -> CircuitBreaker:
+        with self._lock:
+            if geocoder not in self._breakers:
+                self._breakers[geocoder] = CircuitBreaker(
+                    geocoder.value, settings.breaker_threshold, settings.breaker_timeout
+                )
+            return self._breakers[geocoder]
+
+    def observe(
+        self,
+        geocoder: GEOCODERS,
+        country: str | None,
+        seconds: float,
+        matched: bool | None = False,
+        error: bool | None = False,
+    ) -> None:
+        with self._lock:
+            stats = self._stats.get((geocoder, country))
+            if stats is None:
+                stats = self._stats[(geocoder, country)] = ProviderStats()
+            stats.requests += 1
+            stats.matches += int(bool(matched))
+            stats.errors += int(bool(error))
+            stats.seconds += seconds
+
+    def get_stats(
+        self, geocoder: GEOCODERS, country: str | None = None
+    ) -> ProviderStats:
+        with self._lock:
+            stats = self._stats.get((geocoder, country)) or ProviderStats()
+            return stats.model_copy()
+
+    def rank(
+        self,
+        geocoders: Iterable[GEOCODERS],
+        country: str | None = None,
+        adaptive: bool | None = None,
+    ) -> list[GEOCODERS]:
+        """
+        Order the chain of geocoders: providers with an open circuit last. If
+        `adaptive` (default: `settings.adaptive_geocoders`) and all of them
+        have enough observations for the country, by their seconds per match.
+        """
+        geocoders = list(geocoders)
+        if adaptive is None:
+            adaptive = settings.adaptive_geocoders
+        if adaptive and len(geocoders) > 1:
+            stats = [self.get_stats(g, country) for g in geocoders]
+            if all(s.requests >= settings.adaptive_min_samples for s in stats):
+                costs = {g: s.cost for g, s in zip(geocoders, stats)}
+                geocoders = sorted(geocoders, key=lambda g: costs[g])
+        return sorted(geocoders, key=lambda g: self.get_breaker(g).is_open())
+
+    def reset(self) -> None:
+        with self._lock:
+            self._breakers = {}
+            self._stats = {}
+
+
+health = ProviderHealth()
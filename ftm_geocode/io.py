@@ -1,16 +1,46 @@
-from typing import Generator, Iterator, Literal, TypeAlias
+"""
+Input and output rows
 
-from ftmq.util import get_country_code
+Besides csv and json (via `anystore`), rows can be read from and written to
+Parquet and Arrow IPC files in record batches. This requires `pyarrow`, which
+is imported on first use. Nested values (e.g. the raw geocoder payload) are
+stored as json strings.
+"""
+
+from contextlib import ExitStack
+from itertools import chain
+from pathlib import Path
+from typing import (
+    Any,
+    Generator,
+    Iterable,
+    Iterator,
+    Literal,
+    Self,
+    TypeAlias,
+    get_args,
+)
+
+import orjson
+from anystore.io import Writer, smart_open, smart_stream_models
+from anystore.types import M, Uri
 from pydantic import BaseModel, ConfigDict
 
 from ftm_geocode.logging import get_logger
 from ftm_geocode.model import GeocodingResult, PostalContext
+from ftm_geocode.nuts import get_nuts_columns
+from ftm_geocode.settings import Settings
+from ftm_geocode.util import get_country_code
 
 log = get_logger(__name__)
+settings = Settings()
 
 
 FORMAT_FTM = "ftm"
-Formats: TypeAlias = Literal["csv", "json", "ftm"]
+FORMAT_PARQUET = "parquet"
+FORMAT_ARROW = "arrow"
+COLUMNAR_FORMATS = (FORMAT_PARQUET, FORMAT_ARROW)
+Formats: TypeAlias = Literal["csv", "json", "ftm", "parquet", "arrow"]
 
 
 class PostalRow(BaseModel):
@@ -38,3 +68,253 @@ LatLonRows: TypeAlias = Generator[LatLonRow, None, None]
 GeocodingResults: TypeAlias = (
     Generator[GeocodingResult, None, None] | Iterator[GeocodingResult]
 )
+
+
+def _get_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        raise ImportError(
+            "Please install `ftm-geocode[parquet]` for parquet and arrow formats"
+        )
+    return pyarrow
+
+
+def is_columnar(format: str | None) -> bool:
+    return format in COLUMNAR_FORMATS
+
+
+Models: TypeAlias = type[BaseModel] | tuple[type[BaseModel], ...]
+
+
+def get_schema(model: Models) -> Any:
+    """Arrow schema for the (json dumped) fields of one or more models"""
+    pa = _get_pyarrow()
+    types = {float: pa.float64(), int: pa.int64(), bool: pa.bool_()}
+    fields = {}
+    for model in model if isinstance(model, tuple) else (model,):
+        for name, field in model.model_fields.items():
+            args = [a for a in get_args(field.annotation) if a is not type(None)]
+            annotation = args[0] if len(args) == 1 else field.annotation
+            fields.setdefault(name, pa.field(name, types.get(annotation, pa.string())))
+    return pa.schema(fields.values())
+
+
+def stream_batches(
+    uri: Uri, input_format: str, batch_size: int | None = None
+) -> Generator[list[dict[str, Any]], None, None]:
+    """Read a parquet or arrow (file or stream) input as lists of rows"""
+    for batch in iter_record_batches(uri, input_format, batch_size):
+        yield batch.to_pylist()
+
+
+def iter_record_batches(
+    uri: Uri, input_format: str, batch_size: int | None = None
+) -> Generator[Any, None, None]:
+    pa = _get_pyarrow()
+    batch_size = batch_size or settings.columnar_batch_size
+    with smart_open(uri, "rb") as fh:
+        if not fh.seekable():  # stdin
+            fh = pa.BufferReader(fh.read())
+        if input_format == FORMAT_PARQUET:
+            batches = pa.parquet.ParquetFile(fh).iter_batches(batch_size)
+        else:
+            try:
+                reader = pa.ipc.open_file(fh)
+                batches = (
+                    reader.get_batch(i) for i in range(reader.num_record_batches)
+                )
+            except pa.ArrowInvalid:
+                fh.seek(0)
+                batches = pa.ipc.open_stream(fh)
+        yield from batches
+
+
+def stream_models(
+    uri: Uri, model: type[M], input_format: str
+) -> Generator[M, None, None]:
+    """Stream csv, json, parquet or arrow input as pydantic objects"""
+    if is_columnar(input_format):
+        for rows in stream_batches(uri, input_format):
+            for row in rows:
+                yield model(**row)
+    else:
+        yield from smart_stream_models(uri, model, input_format)
+
+
+def add_nuts_columns(batch: Any) -> Any:
+    """
+    Add the `Nuts3` fields as columns to an arrow record batch with `lon` and
+    `lat` columns (replacing existing columns of the same name). Rows outside
+    of any region are dropped.
+    """
+    pa = _get_pyarrow()
+    lons = batch.column("lon").to_numpy(zero_copy_only=False)
+    lats = batch.column("lat").to_numpy(zero_copy_only=False)
+    columns = get_nuts_columns(lons, lats)
+    found = [c is not None for c in columns["nuts3_id"]]
+    batch = batch.filter(pa.array(found, pa.bool_()))
+    names = [n for n in batch.schema.names if n not in columns]
+    arrays = [batch.column(n) for n in names]
+    for name, values in columns.items():
+        names.append(name)
+        values = [v for v, ok in zip(values, found) if ok]
+        arrays.append(pa.array(values, pa.string()))
+    return pa.RecordBatch.from_arrays(arrays, names=names)
+
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, dict):
+        return orjson.dumps(value).decode()
+    return value
+
+
+class BatchWriter:
+    """
+    Write rows (dicts or pydantic objects) in record batches to a parquet or
+    arrow file. Without a `schema`, it is inferred from the first batch, with
+    the columns of `fieldnames` and `known_schema` (e.g. the model fields of
+    passed through input rows) first and the types of `known_schema`.
+
+    Columns that are not in the schema or values of another type than it
+    raise a `ValueError`.
+    """
+
+    def __init__(
+        self,
+        uri: Uri,
+        output_format: str,
+        schema: Any | None = None,
+        batch_size: int | None = None,
+        fieldnames: list[str] | None = None,
+        known_schema: Any | None = None,
+    ) -> None:
+        if not is_columnar(output_format):
+            raise ValueError("Invalid output format, only parquet or arrow allowed")
+        self.pa = _get_pyarrow()
+        self.uri = uri
+        self.output_format = output_format
+        self.schema = schema
+        self.fieldnames = fieldnames or []
+        self.known_schema = known_schema
+        self.batch_size = batch_size or settings.columnar_batch_size
+        self.rows: list[dict[str, Any]] = []
+        self.count = 0
+        self._writer = None
+        self._stack = ExitStack()
+
+    def __enter__(self) -> Self:
+        self._fh = self._stack.enter_context(smart_open(self.uri, "wb"))
+        return self
+
+    def __exit__(self, exc_type: Any, *args: Any) -> None:
+        with self._stack:
+            try:
+                if exc_type is None:
+                    self.flush()
+                if self._writer is None and self.schema is not None:
+                    self._open(self.schema)  # empty file with schema
+            finally:
+                if self._writer is not None:
+                    self._writer.close()
+
+    def write(self, row: dict[str, Any] | BaseModel) -> None:
+        if isinstance(row, BaseModel):
+            row = row.model_dump(by_alias=True, mode="json")
+        self.rows.append({k: _encode(v) for k, v in row.items()})
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def write_record_batch(self, batch: Any) -> None:
+        """Write an arrow record batch as it is"""
+        self.flush()
+        if self._writer is None:
+            self.schema = self.schema or batch.schema
+            self._open(self.schema)
+        self._writer.write_batch(batch)
+        self.count += batch.num_rows
+
+    def flush(self) -> None:
+        if not self.rows:
+            return
+        if self.schema is None:
+            self.schema = self._infer_schema()
+        table = self._make_table()
+        if self._writer is None:
+            self._open(self.schema)
+        self._writer.write_table(table)
+        self.count += len(self.rows)
+        self.rows = []
+
+    def _infer_schema(self) -> Any:
+        pa = self.pa
+        known = self.known_schema or pa.schema([])
+        keys = dict.fromkeys(chain(self.fieldnames, known.names, *self.rows))
+        fields = []
+        for key in keys:
+            if key in known.names:
+                fields.append(known.field(key))
+                continue
+            try:
+                field = pa.field(key, pa.array([r.get(key) for r in self.rows]).type)
+            except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+                raise ValueError(f"Invalid values for column `{key}`: {e}")
+            # no type for all empty columns, assume strings
+            fields.append(
+                field.with_type(pa.string()) if field.type == pa.null() else field
+            )
+        return pa.schema(fields)
+
+    def _make_table(self) -> Any:
+        pa = self.pa
+        unknown = set(chain(*self.rows)) - set(self.schema.names)
+        if unknown:
+            raise ValueError(
+                f"Columns not in the output schema: {', '.join(sorted(unknown))}"
+            )
+        try:
+            return pa.Table.from_pylist(self.rows, schema=self.schema)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            raise ValueError(f"Values don't match the output schema: {e}")
+
+    def _open(self, schema: Any) -> None:
+        if self.output_format == FORMAT_PARQUET:
+            self._writer = self.pa.parquet.ParquetWriter(self._fh, schema)
+        else:
+            self._writer = self.pa.ipc.new_file(self._fh, schema)
+
+
+def get_writer(
+    uri: Uri,
+    output_format: str,
+    model: Models | None = None,
+    fieldnames: list[str] | None = None,
+    passthrough: bool | None = False,
+) -> Writer | BatchWriter:
+    """
+    Get a writer for csv / json (`anystore`) or parquet / arrow output, both
+    accept dicts. For columnar output, the schema is derived from the `model`
+    (or the fields of multiple models) if given. With `passthrough`, rows have
+    additional columns of the input, their types are inferred from the first
+    batch.
+    """
+    if is_columnar(output_format):
+        schema = get_schema(model) if model is not None else None
+        if passthrough:
+            return BatchWriter(
+                uri, output_format, fieldnames=fieldnames, known_schema=schema
+            )
+        return BatchWriter(uri, output_format, schema=schema, fieldnames=fieldnames)
+    return Writer(uri, output_format=output_format, fieldnames=fieldnames)
+
+
+def merge_batches(
+    paths: Iterable[Path], uri: Uri, output_format: str, schema: Any | None = None
+) -> None:
+    """Concatenate parquet or arrow files (with the same schema) into one"""
+    with BatchWriter(uri, output_format, schema=schema) as writer:
+        for path in paths:
+            for batch in iter_record_batches(path, output_format):
+                writer.write_record_batch(batch)
@@ -1,5 +1,43 @@
+import threading
+
+from ftmq.types import SDict
+
 from ftm_geocode.io import PostalRow
+from ftm_geocode.logging import get_logger
 from ftm_geocode.model import get_address, get_components
+from ftm_geocode.settings import Settings
+
+log = get_logger(__name__)
+settings = Settings()
+
+_ready = threading.Event()
+_lock = threading.Lock()
+
+
+def warmup() -> None:
+    """
+    Load the libpostal parser and expander (and their ~2 GB of model data)
+    once, instead of lazily on the first parsed address. Call this in the
+    parent before forking workers, so that they share the loaded model pages
+    copy-on-write. Subsequent calls (e.g. in forked children) are no-ops.
+    """
+    with _lock:
+        if _ready.is_set():
+            return
+        from postal.expand import expand_address
+        from postal.parser import parse_address
+
+        parse_address("1 Main Street")
+        expand_address("1 Main Street")
+        log.info("Loaded libpostal.")
+        _ready.set()
+        if settings.ready_file is not None:
+            settings.ready_file.touch()
+
+
+def is_ready() -> bool:
+    """Check if libpostal is loaded"""
+    return _ready.is_set()
 
 
 def format_line(row: PostalRow) -> PostalRow:
@@ -12,3 +50,10 @@ def parse_components(row: PostalRow) -> dict[str, str | None]:
     res = get_components(row.original_line, **row.ctx)
     res.update(row.model_dump())
     return res
+
+
+def map_entity(row: PostalRow) -> SDict:
+    # return plain data as entities can't be passed between processes
+    ctx = {"country": row.country, "language": row.language}
+    address = get_address(row.original_line, **ctx)
+    return address.to_proxy().to_dict()
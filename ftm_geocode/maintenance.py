@@ -0,0 +1,223 @@
+"""
+Maintenance of the results cache: statistics, expiry, refresh and compaction
+
+All operations stream over the store key by key and don't load it into memory.
+"""
+
+from datetime import datetime, timedelta
+
+from pydantic import BaseModel
+
+from ftm_geocode.cache import (
+    MISS_NAMESPACE,
+    dump_result,
+    get_raw_cache,
+    iterate_raw_results,
+    load_result,
+)
+from ftm_geocode.geocode import _geocode_provider
+from ftm_geocode.logging import get_logger
+from ftm_geocode.model import GeocodingResult, apply_nuts_batch
+from ftm_geocode.settings import GEOCODERS, Settings
+
+log = get_logger(__name__)
+settings = Settings()
+
+
+class CacheReport(BaseModel):
+    results: int = 0
+    """Number of cached geocoding results"""
+    size: int = 0
+    """Total size of the serialized results in bytes"""
+    geocoders: dict[str, int] = {}
+    """Number of results per geocoder"""
+    oldest: datetime | None = None
+    newest: datetime | None = None
+    undated: int = 0
+    """Number of results without a timestamp"""
+    outdated_keys: int = 0
+    """Number of results stored under a key of an older key normalization"""
+    unkeyed: int = 0
+    """Number of results stored without their input line, these can't be
+    rekeyed or refreshed"""
+    outdated_encoding: int = 0
+    """Number of results not stored in the current serialization"""
+    misses: int = 0
+    """Number of recorded unmatched addresses"""
+
+
+class CompactReport(BaseModel):
+    rewritten: int = 0
+    """Results stored again in the current serialization"""
+    rekeyed: int = 0
+    """Results moved to their current key"""
+    superseded: int = 0
+    """Results deleted as a newer one exists under the current key"""
+
+
+def _naive(ts: datetime) -> datetime:
+    if ts.tzinfo is not None:
+        return ts.astimezone().replace(tzinfo=None)
+    return ts
+
+
+def is_stale(
+    result: GeocodingResult, older_than: timedelta, undated: bool | None = False
+) -> bool:
+    """
+    Check if the result is older than the given age. Results without a
+    timestamp are only considered stale if `undated` is set.
+    """
+    if result.ts is None:
+        return bool(undated)
+    return _naive(result.ts) < datetime.now() - older_than
+
+
+def get_stats() -> CacheReport:
+    report = CacheReport()
+    for key, value in iterate_raw_results():
+        result = load_result(value)
+        if result is None:
+            continue
+        report.results += 1
+        report.size += len(value)
+        report.geocoders[result.geocoder] = report.geocoders.get(result.geocoder, 0) + 1
+        if result.ts is None:
+            report.undated += 1
+        else:
+            ts = _naive(result.ts)
+            report.oldest = min(ts, report.oldest or ts)
+            report.newest = max(ts, report.newest or ts)
+        lookup_key = result.lookup_key
+        if lookup_key is None:
+            report.unkeyed += 1
+        elif key != lookup_key:
+            report.outdated_keys += 1
+        if value != dump_result(result):
+            report.outdated_encoding += 1
+    store = get_raw_cache()
+    prefix = f"{MISS_NAMESPACE}/"
+    report.misses = sum(1 for k in store.iterate_keys() if k.startswith(prefix))
+    return report
+
+
+def prune(
+    older_than: timedelta, undated: bool | None = False, dry_run: bool | None = False
+) -> int:
+    """
+    Delete results older than the given age and expired records of unmatched
+    addresses. Returns the number of deleted results.
+    """
+    store = get_raw_cache()
+    deleted = 0
+    for key, value in iterate_raw_results():
+        result = load_result(value)
+        if result is not None and is_stale(result, older_than, undated):
+            log.debug(f"Pruning `{key}`", ts=result.ts)
+            if not dry_run:
+                store.delete(key, ignore_errors=True)
+            deleted += 1
+
+    prefix = f"{MISS_NAMESPACE}/"
+    # all records are expired if they are disabled
+    threshold = datetime.now() - timedelta(seconds=settings.cache_miss_ttl or 0)
+    misses = 0
+    for key in store.iterate_keys():
+        if key.startswith(prefix):
+            value = store.get(key)
+            if value and datetime.fromisoformat(value.decode()) < threshold:
+                if not dry_run:
+                    store.delete(key, ignore_errors=True)
+                misses += 1
+    log.info("Pruned cache", results=deleted, misses=misses, dry_run=dry_run)
+    return deleted
+
+
+def refresh(
+    older_than: timedelta,
+    undated: bool | None = False,
+    limit: int | None = None,
+    dry_run: bool | None = False,
+) -> int:
+    """
+    Geocode the input lines of stale results again with the geocoder they came
+    from (rate limited by the geocoders' minimum delay) and replace them under
+    the same key. Results are kept if the geocoder doesn't return a match
+    anymore, or if their input line is unknown. Returns the number of
+    refreshed results.
+    """
+    store = get_raw_cache()
+    refreshed = 0
+    for key, value in iterate_raw_results():
+        if limit is not None and refreshed >= limit:
+            break
+        result = load_result(value)
+        if result is None or not is_stale(result, older_than, undated):
+            continue
+        if not result.input_line:
+            log.debug("Skipping result without input line", key=key)
+            continue
+        if dry_run:
+            refreshed += 1
+            continue
+        try:
+            geocoder = GEOCODERS(result.geocoder)
+        except ValueError:
+            log.warning(f"Unknown geocoder: `{result.geocoder}`", key=key)
+            continue
+        fresh = _geocode_provider(
+            geocoder, result.input_line, use_cache=False, country=result.input_country
+        )
+        if fresh is None:
+            log.warning(f"No refreshed result: `{result.input_line}`", key=key)
+            continue
+        if result.has_nuts:
+            fresh = apply_nuts_batch([fresh])[0]
+        store.put(key, dump_result(fresh))
+        refreshed += 1
+    log.info("Refreshed cache", results=refreshed, dry_run=dry_run)
+    return refreshed
+
+
+def compact(
+    components: bool | None = False, dry_run: bool | None = False
+) -> CompactReport:
+    """
+    Rewrite results under the cache key of their input line (as of the current
+    key normalization) and in the current serialization, optionally storing the
+    parsed postal components along with them. If a result exists under an old
+    and the current key, the newer one is kept. Results without their input
+    line are only rewritten in place.
+    """
+    store = get_raw_cache()
+    report = CompactReport()
+    for key, value in iterate_raw_results():
+        result = load_result(value)
+        if result is None:
+            continue
+        if components:
+            result.get_components()
+        data = dump_result(result)
+        lookup_key = result.lookup_key
+        if lookup_key is not None and key != lookup_key:
+            current = load_result(store.get(lookup_key))
+            if current is not None and _is_newer(current, result):
+                report.superseded += 1
+            else:
+                report.rekeyed += 1
+                if not dry_run:
+                    store.put(lookup_key, data)
+            if not dry_run:
+                store.delete(key, ignore_errors=True)
+        elif data != value:
+            report.rewritten += 1
+            if not dry_run:
+                store.put(key, data)
+    log.info("Compacted cache", dry_run=dry_run, **report.model_dump())
+    return report
+
+
+def _is_newer(result: GeocodingResult, other: GeocodingResult) -> bool:
+    if result.ts is None:
+        return other.ts is None
+    return other.ts is None or _naive(result.ts) >= _naive(other.ts)
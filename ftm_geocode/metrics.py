@@ -0,0 +1,231 @@
+"""
+Per-stage timings and counters of the geocoding path
+
+Collection is disabled by default (enable via `FTMGEO_METRICS=1` or the
+`--stats` cli option). When disabled, the instrumentation points return right
+away without taking the time or a lock.
+
+Example:
+    ```python
+    with timer("provider", geocoder="nominatim"):
+        ...
+    count("cache_hits", geocoder="nominatim")
+    ```
+"""
+
+import threading
+import time
+from contextlib import nullcontext
+from functools import wraps
+from pathlib import Path
+from typing import Any, Callable, ContextManager
+
+import orjson
+from pydantic import BaseModel
+
+from ftm_geocode.settings import Settings
+
+settings = Settings()
+
+PREFIX = "ftmgeo"
+
+# (name, ((label, value), ...))
+Key = tuple[str, tuple[tuple[str, str], ...]]
+
+_noop = nullcontext()
+
+
+class StageMetrics(BaseModel):
+    calls: int = 0
+    seconds: float = 0
+    """Total time spent in this stage"""
+    max: float = 0
+    """Longest single call"""
+
+
+class Metric(BaseModel):
+    name: str
+    labels: dict[str, str] = {}
+
+
+class StageReport(Metric, StageMetrics):
+    pass
+
+
+class CounterReport(Metric):
+    value: float
+
+
+class MetricsReport(BaseModel):
+    stages: list[StageReport] = []
+    counters: list[CounterReport] = []
+
+
+class Metrics:
+    """
+    Thread-safe, process-wide registry of stage timings and counters
+    """
+
+    def __init__(self, enabled: bool | None = False) -> None:
+        self.enabled = bool(enabled)
+        self._stages: dict[Key, StageMetrics] = {}
+        self._counters: dict[Key, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, **labels: Any) -> None:
+        if not self.enabled:
+            return
+        key = _make_key(stage, labels)
+        with self._lock:
+            metrics = self._stages.get(key)
+            if metrics is None:
+                metrics = self._stages[key] = StageMetrics()
+            metrics.calls += 1
+            metrics.seconds += seconds
+            metrics.max = max(metrics.max, seconds)
+
+    def count(self, name: str, value: float = 1, **labels: Any) -> None:
+        if not self.enabled:
+            return
+        key = _make_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def timer(self, stage: str, **labels: Any) -> ContextManager[Any]:
+        if not self.enabled:
+            return _noop
+        return _Timer(self, stage, labels)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stages = {}
+            self._counters = {}
+
+    def get_report(self) -> MetricsReport:
+        with self._lock:
+            stages = [
+                StageReport(name=n, labels=dict(labels), **m.model_dump())
+                for (n, labels), m in sorted(self._stages.items())
+            ]
+            counters = [
+                CounterReport(name=n, labels=dict(labels), value=v)
+                for (n, labels), v in sorted(self._counters.items())
+            ]
+        return MetricsReport(stages=stages, counters=counters)
+
+
+class _Timer:
+    __slots__ = ("metrics", "stage", "labels", "start")
+
+    def __init__(self, metrics: Metrics, stage: str, labels: dict[str, Any]) -> None:
+        self.metrics = metrics
+        self.stage = stage
+        self.labels = labels
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args: Any) -> None:
+        seconds = time.perf_counter() - self.start
+        self.metrics.observe(self.stage, seconds, **self.labels)
+
+
+def _make_key(name: str, labels: dict[str, Any]) -> Key:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+metrics = Metrics(settings.metrics)
+
+
+def enable(enabled: bool | None = True) -> None:
+    metrics.enabled = bool(enabled)
+
+
+def is_enabled() -> bool:
+    return metrics.enabled
+
+
+def observe(stage: str, seconds: float, **labels: Any) -> None:
+    """Record the duration of a stage that was measured elsewhere"""
+    metrics.observe(stage, seconds, **labels)
+
+
+def count(name: str, value: float = 1, **labels: Any) -> None:
+    metrics.count(name, value, **labels)
+
+
+def timer(stage: str, **labels: Any) -> ContextManager[Any]:
+    """Context manager to record the duration of a stage"""
+    return metrics.timer(stage, **labels)
+
+
+def timed(stage: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """Decorator to record the duration of each call of a function as stage"""
+
+    def decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+        @wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not metrics.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.observe(stage, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def get_report() -> MetricsReport:
+    return metrics.get_report()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    values = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+    return "{" + values + "}"
+
+
+def to_prometheus(report: MetricsReport) -> str:
+    """Render the report in the prometheus text exposition format"""
+    lines: list[str] = []
+    stages = (
+        ("stage_calls_total", "counter", "calls"),
+        ("stage_seconds_total", "counter", "seconds"),
+        ("stage_seconds_max", "gauge", "max"),
+    )
+    for metric, kind, attr in stages:
+        lines.append(f"# TYPE {PREFIX}_{metric} {kind}")
+        for stage in report.stages:
+            labels = _format_labels({"stage": stage.name, **stage.labels})
+            lines.append(f"{PREFIX}_{metric}{labels} {getattr(stage, attr)}")
+    names = dict.fromkeys(c.name for c in report.counters)
+    for name in names:
+        lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+        for counter in report.counters:
+            if counter.name == name:
+                labels = _format_labels(counter.labels)
+                lines.append(f"{PREFIX}_{name}_total{labels} {counter.value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_report(path: Path, report: MetricsReport | None = None) -> None:
+    """
+    Write the metrics report atomically to a json file (by `.json` suffix) or a
+    prometheus textfile (e.g. for the node exporter's textfile collector)
+    """
+    report = report or get_report()
+    if path.suffix == ".json":
+        data = orjson.dumps(report.model_dump(), option=orjson.OPT_INDENT_2)
+    else:
+        data = to_prometheus(report).encode()
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_bytes(data)
+    tmp.replace(path)
@@ -1,6 +1,6 @@
 from collections import defaultdict
 from datetime import datetime
-from typing import Any, TypeAlias, TypedDict
+from typing import Any, Iterable, TypeAlias, TypedDict
 
 import lazy_import
 import orjson
@@ -13,21 +13,25 @@ from ftmq.util import clean_string, make_proxy
 from nomenklatura.entity import CE, CompositeEntity
 from normality import collapse_spaces
 from pydantic import BaseModel, create_model, field_validator, model_validator
-from rigour.addresses import clean_address, format_address_line, normalize_address
+from rigour.addresses import clean_address, format_address_line
 
 from ftm_geocode.cache import make_cache_key
-from ftm_geocode.nuts import get_nuts
+from ftm_geocode.metrics import timer
+from ftm_geocode.nuts import get_nuts, get_nuts_batch, get_nuts_codes, split_nuts3
 from ftm_geocode.settings import GEOCODERS, Settings
 from ftm_geocode.util import (
     clean_country_codes,
     clean_country_names,
     get_country_code,
     get_first,
+    normalize_line,
 )
 
 settings = Settings()
 USE_LIBPOSTAL = settings.libpostal
 
+NUTS_KEYS = ("nuts1_id", "nuts2_id", "nuts3_id")
+
 
 class GeocodingResult(BaseModel):
     cache_key: str
@@ -44,20 +48,49 @@ class GeocodingResult(BaseModel):
     nuts2_id: str | None = None
     nuts3_id: str | None = None
     ts: datetime | None = None
+    components: dict[str, list[str]] | None = None
+    input_line: str | None = None
+    """The looked up address line (before it was adapted for the geocoder)"""
+    input_country: str | None = None
+    """The country context of the lookup"""
+
+    @property
+    def lookup_key(self) -> str | None:
+        """
+        The cache key this result is looked up by, unknown for results that
+        were stored without their input line
+        """
+        if self.input_line:
+            return make_cache_key(self.input_line, country=self.input_country)
 
     @property
     def nuts(self) -> tuple[str, str, str] | None:
         if self.nuts1_id:
             return (self.nuts1_id, self.nuts2_id, self.nuts3_id)
 
+    @property
+    def has_nuts(self) -> bool:
+        return bool(self.nuts1_id and self.nuts2_id and self.nuts3_id)
+
     def apply_nuts(self) -> None:
-        if not self.nuts1_id or not self.nuts2_id or not self.nuts3_id:
+        if not self.has_nuts:
             nuts = get_nuts(self.lon, self.lat)
             if nuts is not None:
                 self.nuts1_id = nuts.nuts1_id
                 self.nuts2_id = nuts.nuts2_id
                 self.nuts3_id = nuts.nuts3_id
 
+    def get_components(self) -> dict[str, list[str]]:
+        # parsed postal components of the result line, only kept (and parsed
+        # once) with libpostal, as the fallback has no actual components
+        if self.components is not None:
+            return self.components
+        postal = PostalAddress.from_string(self.result_line, country=self.country)
+        components = clean_dict(postal.model_dump())
+        if USE_LIBPOSTAL:
+            self.components = components
+        return components
+
     def to_proxy(self) -> CE:
         address = Address.from_result(self)
         proxy = address.to_proxy()
@@ -67,9 +100,11 @@ class GeocodingResult(BaseModel):
     @model_validator(mode="before")
     @classmethod
     def make_cache_key(cls, data: SDict) -> SDict:
-        data["cache_key"] = make_cache_key(
-            data["original_line"], country=data.get("country")
-        )
+        if data.get("input_line"):
+            key = make_cache_key(data["input_line"], country=data.get("input_country"))
+        else:
+            key = make_cache_key(data["original_line"], country=data.get("country"))
+        data["cache_key"] = key
         return data
 
     @field_validator("geocoder_place_id", mode="before")
@@ -86,6 +121,44 @@ class GeocodingResult(BaseModel):
             return orjson.loads(value)
         return {}
 
+    @field_validator("components", mode="before")
+    @classmethod
+    def load_components(cls, value: Any) -> dict[str, list[str]] | None:
+        if isinstance(value, (str, bytes)):
+            return orjson.loads(value) if value else None
+        return value
+
+
+def apply_nuts_batch(results: Iterable[GeocodingResult]) -> list[GeocodingResult]:
+    """
+    Apply nuts codes to a chunk of geocoding results with one vectorized lookup
+    """
+    results = list(results)
+    todo = [r for r in results if not r.has_nuts]
+    if todo:
+        lons, lats = [r.lon for r in todo], [r.lat for r in todo]
+        for result, nuts in zip(todo, get_nuts_batch(lons, lats)):
+            if nuts is not None:
+                result.nuts1_id = nuts.nuts1_id
+                result.nuts2_id = nuts.nuts2_id
+                result.nuts3_id = nuts.nuts3_id
+    return results
+
+
+def apply_nuts_data(rows: Iterable[dict[str, Any]]) -> list[dict[str, Any]]:
+    """
+    Apply nuts codes to a chunk of geocoding results data (e.g. deserialized
+    from the cache without a model) with one vectorized lookup
+    """
+    rows = list(rows)
+    todo = [r for r in rows if not all(r.get(k) for k in NUTS_KEYS)]
+    if todo:
+        lons, lats = [r["lon"] for r in todo], [r["lat"] for r in todo]
+        for row, code in zip(todo, get_nuts_codes(lons, lats)):
+            if code is not None:
+                row.update(zip(NUTS_KEYS, split_nuts3(code)[1:]))
+    return rows
+
 
 # https://github.com/openvenues/libpostal#parser-labels
 # postal -> ftm
@@ -163,7 +236,7 @@ class AddressBase(BaseModel):
         return get_first(getattr(self, attr, None), default)
 
     def get_id(self) -> str:  # serves as cache key
-        line = normalize_address(self.get_formatted_line(), latinize=True)
+        line = normalize_line(self.get_formatted_line(), latinize=True)
         key = make_cache_key(line, country=self.get_first("country"))
         assert key is not None
         return key
@@ -216,7 +289,8 @@ class PostalAddressBase(AddressBase):
             parse_address = lazy_import.lazy_callable("postal.parser.parse_address")
             # postal screams if language or country is None
             ctx = {k: ctx.get(k, "") or "" for k in ("language", "country")}
-            result = parse_address(value, **ctx)
+            with timer("postal_parse"):
+                result = parse_address(value, **ctx)
         else:
             result = [(value, "full")]
         return cls.from_postal_result(result, **ctx)
@@ -299,8 +373,7 @@ class Address(FtmAddressBase):
 
     @classmethod
     def from_result(cls, result: GeocodingResult) -> "Address":
-        ctx = {"country": result.country}
-        address = cls.from_postal(PostalAddress.from_string(result.result_line, **ctx))
+        address = cls.from_postal(PostalAddress(**result.get_components()))
         address.full = [result.result_line]
         address.longitude = [str(result.lon)]
         address.latitude = [str(result.lat)]
@@ -350,7 +423,7 @@ def get_components(data: AddressInput, **ctx: PostalContext) -> dict[str, str |
     elif isinstance(data, CompositeEntity):
         data = PostalAddress.from_string(data.caption, **ctx)
     elif isinstance(data, GeocodingResult):
-        data = PostalAddress.from_string(GeocodingResult.result_line, **ctx)
+        data = PostalAddress(**data.get_components())
     else:
         raise NotImplementedError(data)
 
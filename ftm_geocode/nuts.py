@@ -5,21 +5,32 @@ https://ec.europa.eu/eurostat/web/gisco/geodata/reference-data/administrative-un
 https://en.wikipedia.org/wiki/Nomenclature_of_Territorial_Units_for_Statistics
 """
 
+import threading
 from functools import cache
+from pathlib import Path
 from typing import Any, Self
 
 import geopandas as gpd
+import numpy as np
+import orjson
+import shapely
 from ftmq.util import get_country_name
 from nomenklatura.entity import CE
-from pydantic import BaseModel
-from shapely.geometry import Point
+from pydantic import BaseModel, ConfigDict
+from shapely import STRtree
 
+from ftm_geocode.cache import get_namespace_cache
 from ftm_geocode.logging import get_logger
+from ftm_geocode.metrics import timed
 from ftm_geocode.settings import Settings
+from ftm_geocode.util import MISSING, LRUCache
 
 log = get_logger(__name__)
 settings = Settings()
 
+CACHE_NAMESPACE = "nuts"
+NO_NUTS = "-"  # cached value for coordinates outside of any nuts region
+
 
 class Nuts(BaseModel):
     level: int
@@ -74,26 +85,250 @@ class ProxyNuts(Nuts3):
     entity_id: str
 
 
+class NutsCacheStats(BaseModel):
+    hits: int
+    misses: int
+    size: int
+    store_hits: int
+    store_misses: int
+
+
+class WkbGeometries:
+    """
+    Geometries stored as concatenated WKB (e.g. a memory mapped buffer) with
+    their offsets. They are decoded (and prepared) on first access by index.
+    """
+
+    def __init__(self, buffer: Any, offsets: Any) -> None:
+        self.buffer = buffer
+        self.offsets = offsets
+        self._geometries = np.full(len(offsets) - 1, None, dtype=object)
+        self._loaded = np.zeros(len(offsets) - 1, dtype=bool)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._geometries)
+
+    def __getitem__(self, ix: Any) -> np.ndarray:
+        ix = np.asarray(ix, dtype=np.intp)
+        missing = np.unique(ix[~self._loaded[ix]])
+        if len(missing):
+            with self._lock:
+                missing = missing[~self._loaded[missing]]
+                wkb = [
+                    self.buffer[self.offsets[i] : self.offsets[i + 1]].tobytes()
+                    for i in missing
+                ]
+                geometries = shapely.from_wkb(wkb)
+                shapely.prepare(geometries)
+                self._geometries[missing] = geometries
+                self._loaded[missing] = True
+        return self._geometries[ix]
+
+    def to_array(self) -> np.ndarray:
+        return self[np.arange(len(self))]
+
+
+class NutsIndex:
+    """
+    Point lookup engine for NUTS3 regions.
+
+    The level 3 subset is extracted once, the geometries are prepared and
+    indexed in an `STRtree`. A lookup prefilters candidates via their bounding
+    boxes and then runs the exact containment test only on these. If the
+    bounds are already known (from a compiled artifact), the tree is built
+    from them directly and the geometries are only decoded once they are
+    candidates of a lookup.
+    """
+
+    def __init__(
+        self, codes: Any, geometries: Any | WkbGeometries, bounds: Any | None = None
+    ) -> None:
+        self.codes = np.asarray(codes)
+        if not isinstance(geometries, WkbGeometries):
+            geometries = np.asarray(geometries, dtype=object)
+            shapely.prepare(geometries)
+        self.geometries = geometries
+        if bounds is not None:
+            bounds = np.asarray(bounds, dtype=float)
+            self.tree = STRtree(shapely.box(*bounds.T))
+        else:
+            self.tree = STRtree(self.geometries)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @classmethod
+    def from_data(cls, df: gpd.GeoDataFrame) -> Self:
+        df = df[df["LEVL_CODE"] == 3]
+        return cls(df["NUTS_ID"].values, df.geometry.values)
+
+    def lookup(self, lon: float, lat: float) -> str | None:
+        candidates = self.tree.query(shapely.points(lon, lat))
+        if not len(candidates):
+            return
+        hits = shapely.contains_xy(self.geometries[candidates], lon, lat)
+        codes = set(self.codes[candidates[hits]].tolist())
+        if not codes:
+            return
+        if len(codes) > 1:
+            log.error(
+                "Invalid nuts lookup result, got %d values instead of 1" % len(codes)
+            )
+            return
+        return codes.pop()
+
+    def lookup_many(self, lons: Any, lats: Any) -> np.ndarray:
+        """
+        Vectorized lookup for arrays of coordinates. Returns an object array of
+        the same length holding the NUTS3 code (or `None`) for each point.
+        """
+        lons = np.asarray(lons, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        result = np.full(len(lons), None, dtype=object)
+        inputs, candidates = self.tree.query(shapely.points(lons, lats))
+        hits = shapely.contains_xy(
+            self.geometries[candidates], lons[inputs], lats[inputs]
+        )
+        inputs = inputs[hits]
+        codes = np.asarray(self.codes[candidates[hits]].tolist(), dtype=object)
+        result[inputs] = codes
+        invalid = np.unique(inputs[codes != result[inputs]])
+        if len(invalid):
+            log.error(
+                "Invalid nuts lookup results: %d coordinates with more than 1 value"
+                % len(invalid)
+            )
+            result[invalid] = None
+        return result
+
+
 def split_nuts3(code: str) -> tuple[str, str, str, str]:
     # country, nuts1, nuts2, nuts3
     return code[:2], code[:3], code[:4], code[:5]
 
 
-@cache
-def get_nuts_data():
-    log.info("Loading nuts shapefile", fp=settings.nuts_data)
-    df = gpd.read_file(settings.nuts_data)
-    df = df[["LEVL_CODE", "NUTS_ID", "NUTS_NAME", "geometry"]]
-    return df
+class CompiledNuts(BaseModel):
+    """
+    Preprocessed NUTS3 data loaded from a compiled artifact directory (see
+    `compile_nuts`). The arrays are memory mapped from `.npy` files, the
+    geometries are decoded lazily.
+    """
+
+    codes: Any
+    geometries: WkbGeometries
+    bounds: Any
+    names: dict[str, str]
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    def to_data(self) -> gpd.GeoDataFrame:
+        """Level 3 regions only (decodes all geometries)"""
+        codes = self.codes.tolist()
+        return gpd.GeoDataFrame(
+            {
+                "LEVL_CODE": 3,
+                "NUTS_ID": codes,
+                "NUTS_NAME": [self.names[c] for c in codes],
+            },
+            geometry=self.geometries.to_array(),
+            crs="EPSG:4326",
+        )
+
+    def to_index(self) -> NutsIndex:
+        return NutsIndex(self.codes, self.geometries, self.bounds)
+
+
+def compile_nuts(out: Path | None = None, in_path: Path | None = None) -> Path:
+    """
+    Compile the NUTS shapefile into a compact artifact directory that loads in
+    milliseconds: Level 3 geometries as concatenated WKB with offsets, their
+    codes and bounds (all as `.npy` files) and the names table for all levels.
+
+    Args:
+        out: Artifact directory, defaults to `settings.nuts_compiled`
+        in_path: Shapefile, defaults to `settings.nuts_data`
+
+    Returns:
+        The artifact directory
+    """
+    out = out or settings.nuts_compiled
+    df = _read_nuts_data(in_path or settings.nuts_data)
+    names = _make_nuts_names(df)
+    df = df[df["LEVL_CODE"] == 3].drop_duplicates(subset=("NUTS_ID",))
+    geometries = np.asarray(df.geometry.values, dtype=object)
+    wkb = shapely.to_wkb(geometries)
+    offsets = np.cumsum([0] + [len(g) for g in wkb], dtype=np.int64)
+    out.mkdir(parents=True, exist_ok=True)
+    np.save(out / "codes.npy", np.asarray(df["NUTS_ID"].values, dtype=str))
+    np.save(out / "geometries.npy", np.frombuffer(b"".join(wkb), dtype=np.uint8))
+    np.save(out / "offsets.npy", offsets)
+    np.save(out / "bounds.npy", shapely.bounds(geometries))
+    with open(out / "names.json", "wb") as fh:
+        fh.write(orjson.dumps(names))
+    log.info("Compiled nuts data", fp=out, regions=len(df), names=len(names))
+    return out
 
 
 @cache
-def get_nuts_names():
-    df = get_nuts_data()
+def load_compiled_nuts(path: Path) -> CompiledNuts:
+    log.info("Loading compiled nuts data", fp=path)
+    with open(path / "names.json", "rb") as fh:
+        names = orjson.loads(fh.read())
+    geometries = WkbGeometries(
+        np.load(path / "geometries.npy", mmap_mode="r"),
+        np.load(path / "offsets.npy", mmap_mode="r"),
+    )
+    return CompiledNuts(
+        codes=np.load(path / "codes.npy", mmap_mode="r"),
+        geometries=geometries,
+        bounds=np.load(path / "bounds.npy", mmap_mode="r"),
+        names=names,
+    )
+
+
+def get_compiled_nuts() -> CompiledNuts | None:
+    if (settings.nuts_compiled / "codes.npy").exists():
+        return load_compiled_nuts(settings.nuts_compiled)
+
+
+def _read_nuts_data(path: Path) -> gpd.GeoDataFrame:
+    log.info("Loading nuts shapefile", fp=path)
+    df = gpd.read_file(path)
+    return df[["LEVL_CODE", "NUTS_ID", "NUTS_NAME", "geometry"]]
+
+
+def _make_nuts_names(df: gpd.GeoDataFrame) -> dict[str, str]:
     df = df[["NUTS_ID", "NUTS_NAME"]].drop_duplicates().set_index("NUTS_ID")
     return df["NUTS_NAME"].T.to_dict()
 
 
+@cache
+def get_nuts_data() -> gpd.GeoDataFrame:
+    """
+    Get the NUTS data of all levels from the shapefile. The compiled artifact
+    only has the level 3 geometries (see `CompiledNuts.to_data`), so it is
+    used for the lookups and names but not here.
+    """
+    return _read_nuts_data(settings.nuts_data)
+
+
+@cache
+def get_nuts_names() -> dict[str, str]:
+    compiled = get_compiled_nuts()
+    if compiled is not None:
+        return compiled.names
+    return _make_nuts_names(get_nuts_data())
+
+
+@cache
+def get_nuts_index() -> NutsIndex:
+    compiled = get_compiled_nuts()
+    if compiled is not None:
+        return compiled.to_index()
+    return NutsIndex.from_data(get_nuts_data())
+
+
 def get_nuts_name(code: str) -> str:
     names = get_nuts_names()
     return names[code]
@@ -103,18 +338,116 @@ def get_nuts_path(code: str) -> str:
     return "/".join([code[: i + 2] for i in range(len(code) - 1)])
 
 
+_memo: LRUCache[tuple[float, float], str | None] = LRUCache(settings.nuts_cache_size)
+_store_stats = {"hits": 0, "misses": 0}
+
+
+def get_nuts_cache_stats() -> NutsCacheStats:
+    return NutsCacheStats(
+        hits=_memo.hits,
+        misses=_memo.misses,
+        size=len(_memo),
+        store_hits=_store_stats["hits"],
+        store_misses=_store_stats["misses"],
+    )
+
+
+def _get_cached_code(lon: float, lat: float) -> Any:
+    key = (lon, lat)
+    code = _memo.get(key, MISSING)
+    if code is MISSING and settings.nuts_cache_persist:
+        store = get_namespace_cache(CACHE_NAMESPACE)
+        value = store.get(f"{lon},{lat}")
+        if value is None:
+            _store_stats["misses"] += 1
+        else:
+            _store_stats["hits"] += 1
+            value = value.decode() if isinstance(value, bytes) else value
+            code = None if value == NO_NUTS else value
+            _memo.put(key, code)
+    return code
+
+
+def _set_cached_code(lon: float, lat: float, code: str | None) -> None:
+    _memo.put((lon, lat), code)
+    if settings.nuts_cache_persist:
+        store = get_namespace_cache(CACHE_NAMESPACE)
+        store.put(f"{lon},{lat}", (code or NO_NUTS).encode())
+
+
+@timed("nuts")
 def _get_nuts(lon: float, lat: float) -> Nuts3 | None:
-    df = get_nuts_data()
-    df = df[df["LEVL_CODE"] == 3]
-    point = Point(lon, lat)
-    res = df[df.contains(point)].drop_duplicates(subset=("NUTS_ID",))
-    if res.empty:
-        return
-    if len(res) > 1:
-        log.error("Invalid nuts lookup result, got %d values instead of 1" % len(res))
-        return
-    for _, row in res.iterrows():
-        return Nuts3.from_code(row["NUTS_ID"])
+    code = _get_cached_code(lon, lat)
+    if code is MISSING:
+        code = get_nuts_index().lookup(lon, lat)
+        _set_cached_code(lon, lat, code)
+    if code is not None:
+        return _get_nuts3(code).model_copy()
+
+
+@cache
+def _get_nuts3(code: str) -> Nuts3:
+    return Nuts3.from_code(code)
+
+
+def get_nuts_codes(lons: Any, lats: Any) -> list[str | None]:
+    """
+    Get NUTS3 codes for arrays of longitudes and latitudes, the points that are
+    not memoized are looked up with one vectorized spatial index query.
+
+    Args:
+        lons: Array-like of longitudes
+        lats: Array-like of latitudes
+
+    Returns:
+        List of the same length with a code or `None` for each point
+    """
+    lons = np.asarray(lons, dtype=float).tolist()
+    lats = np.asarray(lats, dtype=float).tolist()
+    coords = [(round(lon, 6), round(lat, 6)) for lon, lat in zip(lons, lats)]
+    codes = [_get_cached_code(lon, lat) for lon, lat in coords]
+    todo = list({c for c, code in zip(coords, codes) if code is MISSING})
+    if todo:
+        found = get_nuts_index().lookup_many(*zip(*todo))
+        found = dict(zip(todo, found))
+        for (lon, lat), code in found.items():
+            _set_cached_code(lon, lat, code)
+        codes = [
+            found[c] if code is MISSING else code for c, code in zip(coords, codes)
+        ]
+    return codes
+
+
+@timed("nuts")
+def get_nuts_batch(lons: Any, lats: Any) -> list[Nuts3 | None]:
+    """
+    Get NUTS3 regions for arrays of longitudes and latitudes with one
+    vectorized spatial index query.
+
+    Args:
+        lons: Array-like of longitudes
+        lats: Array-like of latitudes
+
+    Returns:
+        List of the same length with a `Nuts3` result or `None` for each point
+    """
+    codes = get_nuts_codes(lons, lats)
+    return [_get_nuts3(c).model_copy() if c is not None else None for c in codes]
+
+
+@timed("nuts")
+def get_nuts_columns(lons: Any, lats: Any) -> dict[str, list[str | None]]:
+    """
+    Get the `Nuts3` fields for arrays of longitudes and latitudes as columns
+    (without a model per point), with `None` values for points outside of any
+    region.
+    """
+    codes = get_nuts_codes(lons, lats)
+    regions = {c: _get_nuts3(c).model_dump() for c in set(codes) if c is not None}
+    return {
+        field: [regions[c][field] if c is not None else None for c in codes]
+        for field in Nuts3.model_fields
+    }
 
 
 def get_nuts(lon: Any | None = None, lat: Any | None = None) -> Nuts3 | None:
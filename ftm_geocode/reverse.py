@@ -0,0 +1,333 @@
+"""
+Offline reverse geocoding: the nearest known address for coordinates
+
+The coordinates of all cached geocoding results are indexed in an `STRtree`.
+A lookup queries the candidates within a bounding box around the point (derived
+from the distance bound) and picks the nearest one by the great-circle
+distance, so no geocoding service is involved.
+
+The index is persisted as `.npy` files (`ftmgeo cache reverse-index`) and
+updated incrementally: only results that are not indexed yet are read from the
+cache. Results geocoded in the running process are added to the index as they
+are cached.
+"""
+
+import threading
+import time
+from pathlib import Path
+from typing import Any, Generator, Iterable, Self
+
+import numpy as np
+import shapely
+from nomenklatura.entity import CE
+from shapely import STRtree
+
+from ftm_geocode.cache import RESULT_PREFIX, get_many, get_raw_cache, load_result
+from ftm_geocode.logging import get_logger
+from ftm_geocode.metrics import count, timed
+from ftm_geocode.model import GeocodingResult
+from ftm_geocode.settings import Settings
+from ftm_geocode.util import apply_address
+
+log = get_logger(__name__)
+settings = Settings()
+
+EARTH_RADIUS = 6_371_008.8  # mean radius in meters
+
+
+class ReverseResult(GeocodingResult):
+    distance: float
+    """Distance in meters between the requested coordinates and the result"""
+
+
+def haversine(lons1: Any, lats1: Any, lons2: Any, lats2: Any) -> np.ndarray:
+    """Great-circle distance in meters (vectorized)"""
+    lons1, lats1, lons2, lats2 = map(np.radians, (lons1, lats1, lons2, lats2))
+    a = (
+        np.sin((lats2 - lats1) / 2) ** 2
+        + np.cos(lats1) * np.cos(lats2) * np.sin((lons2 - lons1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class ReverseIndex:
+    """
+    Nearest neighbour lookup engine for the coordinates of cached results,
+    keyed by their cache keys.
+
+    New points are collected and merged (rebuilding the tree) on the next
+    lookup.
+    """
+
+    def __init__(self, keys: Any = (), coords: Any | None = None) -> None:
+        self.keys = np.asarray(keys, dtype=object)
+        if coords is None:
+            coords = np.empty((0, 2))
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        self._known: set[str] = set(self.keys)
+        self._pending: list[tuple[str, float, float]] = []
+        self._tree: STRtree | None = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._known)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._known
+
+    def add(self, key: str, lon: float, lat: float) -> None:
+        with self._lock:
+            if key not in self._known:
+                self._known.add(key)
+                self._pending.append((key, lon, lat))
+
+    def retain(self, keys: Iterable[str]) -> int:
+        """Remove all but the given keys (e.g. of pruned results)"""
+        with self._lock:
+            self._merge()
+            remove = self._known.difference(keys)
+            if remove:
+                keep = ~np.isin(self.keys, list(remove))
+                self.keys, self.coords = self.keys[keep], self.coords[keep]
+                self._known -= remove
+                self._tree = None
+            return len(remove)
+
+    def _merge(self) -> None:
+        if self._pending:
+            keys, lons, lats = zip(*self._pending)
+            self.keys = np.concatenate((self.keys, np.asarray(keys, dtype=object)))
+            coords = np.column_stack((lons, lats)).astype(float)
+            self.coords = np.concatenate((self.coords, coords))
+            self._pending = []
+            self._tree = None
+
+    def _get_state(self) -> tuple[STRtree, np.ndarray, np.ndarray]:
+        with self._lock:
+            self._merge()
+            if self._tree is None:
+                self._tree = STRtree(shapely.points(self.coords))
+            return self._tree, self.keys, self.coords
+
+    def lookup(
+        self, lon: float, lat: float, max_distance: float | None = None
+    ) -> tuple[str, float] | None:
+        """Get the key of the nearest point and its distance in meters"""
+        keys, distances = self.lookup_many([lon], [lat], max_distance)
+        if keys[0] is not None:
+            return keys[0], float(distances[0])
+
+    def lookup_many(
+        self, lons: Any, lats: Any, max_distance: float | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Vectorized lookup for arrays of coordinates. Returns an object array of
+        the keys (or `None`) and an array of the distances (or `nan`) of the
+        nearest points within `max_distance` meters (unbounded if not set).
+        """
+        lons = np.asarray(lons, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        result = np.full(len(lons), None, dtype=object)
+        distances = np.full(len(lons), np.nan)
+        tree, keys, coords = self._get_state()
+        if not len(keys) or not len(lons):
+            return result, distances
+        if max_distance:
+            # bounding boxes in degrees that contain the circles of the bound
+            dlat = np.degrees(max_distance / EARTH_RADIUS)
+            cos = np.cos(np.radians(np.minimum(np.abs(lats) + dlat, 90)))
+            dlon = np.minimum(dlat / np.maximum(cos, 1e-9), 180)
+            boxes = shapely.box(lons - dlon, lats - dlat, lons + dlon, lats + dlat)
+            inputs, candidates = tree.query(boxes)
+        else:
+            inputs, candidates = tree.query_nearest(shapely.points(lons, lats))
+        dist = haversine(
+            lons[inputs], lats[inputs], coords[candidates, 0], coords[candidates, 1]
+        )
+        if max_distance:
+            within = dist <= max_distance
+            inputs, candidates, dist = inputs[within], candidates[within], dist[within]
+        # nearest candidate per input
+        order = np.lexsort((dist, inputs))
+        inputs, candidates, dist = inputs[order], candidates[order], dist[order]
+        first = np.unique(inputs, return_index=True)[1]
+        result[inputs[first]] = keys[candidates[first]]
+        distances[inputs[first]] = dist[first]
+        return result, distances
+
+    def save(self, path: Path) -> Path:
+        """Persist the index as `.npy` files in the directory `path`"""
+        with self._lock:
+            self._merge()
+            keys, coords = self.keys, self.coords
+        path.mkdir(parents=True, exist_ok=True)
+        # replace the files, as the loaded index may still map them
+        for name, data in (("keys", np.asarray(keys, dtype=str)), ("coords", coords)):
+            tmp = path / f".{name}.tmp.npy"
+            np.save(tmp, data)
+            tmp.replace(path / f"{name}.npy")
+        log.info("Saved reverse index", fp=path, results=len(keys))
+        return path
+
+    @classmethod
+    def load(cls, path: Path) -> Self:
+        keys = np.load(path / "keys.npy", mmap_mode="r")
+        coords = np.load(path / "coords.npy", mmap_mode="r")
+        return cls(keys.astype(object), coords)
+
+
+def update_index(index: ReverseIndex) -> tuple[int, int]:
+    """
+    Incrementally update the index from the cache: add the results that are not
+    indexed yet and remove the ones that are no longer cached.
+
+    Returns:
+        Number of added and removed results
+    """
+    store = get_raw_cache()
+    keys = {k for k in store.iterate_keys() if k.startswith(RESULT_PREFIX)}
+    removed = index.retain(keys)
+    added = 0
+    for key in keys:
+        if key not in index:
+            result = load_result(store.get(key))
+            if result is not None:
+                index.add(key, result.lon, result.lat)
+                added += 1
+    return added, removed
+
+
+def build_index(path: Path | None = None, full: bool | None = False) -> ReverseIndex:
+    """
+    Update the persisted index from the cache (or build it from scratch if it
+    doesn't exist or `full`) and save it.
+
+    Args:
+        path: Index directory, defaults to `settings.reverse_index`
+        full: Rebuild from scratch instead of updating
+    """
+    global _index
+    path = path or settings.reverse_index
+    start = time.perf_counter()
+    index = _load_index(path) if not full else None
+    index = index or ReverseIndex()
+    added, removed = update_index(index)
+    log.info(
+        "Updated reverse index",
+        results=len(index),
+        added=added,
+        removed=removed,
+        seconds=round(time.perf_counter() - start, 2),
+    )
+    index.save(path)
+    with _index_lock:
+        _index = index
+    return index
+
+
+def _load_index(path: Path) -> ReverseIndex | None:
+    if (path / "keys.npy").exists():
+        log.info("Loading reverse index", fp=path)
+        return ReverseIndex.load(path)
+
+
+_index: ReverseIndex | None = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> ReverseIndex:
+    """
+    Get the index: the persisted one if it exists, otherwise built in memory
+    from the cache on first use
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            index = _load_index(settings.reverse_index)
+            if index is None:
+                index = ReverseIndex()
+                added, _ = update_index(index)
+                log.info("Built reverse index", results=added)
+            _index = index
+        return _index
+
+
+def index_result(key: str, result: GeocodingResult) -> None:
+    """Add a newly cached result to the index (if it is in use)"""
+    if _index is not None:
+        _index.add(key, result.lon, result.lat)
+
+
+@timed("reverse")
+def reverse_geocode_many(
+    lons: Any, lats: Any, max_distance: float | None = None
+) -> list[ReverseResult | None]:
+    """
+    Get the nearest cached result within `max_distance` meters (default:
+    `settings.reverse_max_distance`) for each of the coordinates
+    """
+    if max_distance is None:
+        max_distance = settings.reverse_max_distance
+    keys, distances = get_index().lookup_many(lons, lats, max_distance)
+    results = get_many({k for k in keys if k is not None})
+    matches: list[ReverseResult | None] = []
+    for key, distance in zip(keys, distances):
+        result = results.get(key) if key is not None else None
+        if result is None:
+            matches.append(None)
+            count("reverse_misses")
+        else:
+            matches.append(ReverseResult(**result.model_dump(), distance=distance))
+            count("reverse_hits")
+    return matches
+
+
+def reverse_geocode(
+    lon: float, lat: float, max_distance: float | None = None
+) -> ReverseResult | None:
+    """
+    Get the nearest cached result within `max_distance` meters (default:
+    `settings.reverse_max_distance`) for the coordinates
+    """
+    return reverse_geocode_many([lon], [lat], max_distance)[0]
+
+
+def get_proxy_coords(proxy: CE) -> tuple[float, float] | None:
+    lon, lat = proxy.first("longitude"), proxy.first("latitude")
+    if lon is not None and lat is not None:
+        try:
+            return float(lon), float(lat)
+        except ValueError:
+            log.error("Invalid coords", proxy=proxy.to_dict())
+
+
+def _has_address(proxy: CE) -> bool:
+    if proxy.schema.is_a("Address"):
+        return bool(proxy.first("full"))
+    return bool(proxy.first("address") or proxy.first("addressEntity"))
+
+
+def reverse_geocode_proxy(
+    proxy: CE, max_distance: float | None = None
+) -> Generator[CE, None, None]:
+    """
+    Add the nearest known address to an entity with coordinates but without an
+    address. Address entities get the address properties merged in (keeping
+    their coordinates), other entities are linked to a new Address entity.
+    """
+    coords = get_proxy_coords(proxy)
+    if coords is None or _has_address(proxy):
+        yield proxy
+        return
+    result = reverse_geocode(*coords, max_distance=max_distance)
+    if result is None:
+        yield proxy
+        return
+    address = result.to_proxy()
+    if proxy.schema.is_a("Address"):
+        address.pop("longitude")
+        address.pop("latitude")
+        yield apply_address(proxy, address, rewrite_id=False)
+        return
+    yield address
+    yield apply_address(proxy, address)
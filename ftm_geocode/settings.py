@@ -1,5 +1,6 @@
 from enum import StrEnum
 from pathlib import Path
+from typing import Literal
 
 from anystore.model import StoreModel
 from anystore.settings import Settings as Anystore
@@ -11,6 +12,8 @@ from ftm_geocode import __version__
 anystore = Anystore()
 
 NUTS = Path(__file__).parent.parent / "data" / "NUTS_RG_01M_2021_4326.shp.zip"
+NUTS_COMPILED = NUTS.parent / "NUTS_RG_01M_2021_4326.nuts3"
+REVERSE_INDEX = NUTS.parent / "reverse_index"
 GEOCODERS = StrEnum("Geocoders", ((k, k) for k in SERVICE_TO_GEOCODER.keys()))
 
 
@@ -43,14 +46,117 @@ class Settings(BaseSettings):
     max_retries: int = 5
     """Maximum retries for geocoding"""
 
+    retry_wait_seconds: float = 5
+    """Seconds to wait before retrying a failed geocoding request"""
+
+    geocoder_urls: dict[GEOCODERS, str] = {}
+    """Base urls per geocoder, e.g. for a self-hosted or mock service:
+    `FTMGEO_GEOCODER_URLS='{"nominatim": "http://localhost:8080"}'`"""
+
+    provider_delay_seconds: dict[GEOCODERS, float] = {}
+    """Minimum delay per geocoder, overrides `min_delay_seconds` (e.g. `0` for a
+    self-hosted nominatim: `FTMGEO_PROVIDER_DELAY_SECONDS='{"nominatim": 0}'`)"""
+
+    workers: int = 1
+    """Number of concurrent geocoding workers"""
+
+    breaker_threshold: int = 5
+    """Number of consecutive errors after which a geocoder is skipped (its
+    circuit opens), `0` to disable"""
+
+    breaker_timeout: float = 60
+    """Seconds to skip a failing geocoder before probing it again"""
+
+    adaptive_geocoders: bool = False
+    """Reorder the geocoders per country by their observed seconds per match"""
+
+    adaptive_min_samples: int = 20
+    """Number of requests per geocoder and country before reordering"""
+
+    metrics: bool = False
+    """Collect per-stage timings and counters of the geocoding path"""
+
+    metrics_file: Path | None = None
+    """Write the collected metrics after each job of the worker to this file
+    (json if it ends with `.json`, otherwise a prometheus textfile)"""
+
+    postal_chunk_size: int = 100
+    """Number of input rows per libpostal parsing task when using multiple
+    processes"""
+
+    geocode_chunk_size: int = 1_000
+    """Number of input rows to lookup in the cache at once"""
+
+    columnar_batch_size: int = 10_000
+    """Number of rows per record batch for parquet and arrow input and output
+    (requires `pyarrow`)"""
+
+    job_timeout: float | None = None
+    """Time budget in seconds for geocoding all addresses of a worker job,
+    addresses not resolved within it are left as they are"""
+
     cache: StoreModel = StoreModel(uri=anystore.uri)
     """Cache uri (using anystore)"""
 
+    cache_serialization: Literal["json", "msgpack"] = "json"
+    """Encoding of cached geocoding results (msgpack requires `msgpack`)"""
+
+    cache_compression: Literal["zstd", "zlib"] | None = None
+    """Compress the raw geocoder payload of cached results (zstd requires
+    `zstandard`)"""
+
+    cache_raw_fields: list[str] | None = None
+    """Only keep these top-level fields of the raw geocoder payload in the cache
+    (default: keep all)"""
+
+    cache_workers: int = 10
+    """Number of concurrent cache reads for bulk lookups"""
+
+    key_cache_size: int = 100_000
+    """Number of normalized address lines and cache keys to memorize per
+    process (0 to disable)"""
+
+    cache_hot_size: int = 10_000
+    """Number of recent results to keep in memory per process (0 to disable)"""
+
+    fuzzy_threshold: float | None = None
+    """Before geocoding, accept the cached result of a similar address line in
+    the same country with at least this similarity (0-1, e.g. `0.85`). The
+    index for this is built in memory from the cache on first use."""
+
+    reverse_index: Path = REVERSE_INDEX
+    """Location for the persisted reverse geocoding index (`ftmgeo cache
+    reverse-index`), used if existing"""
+
+    reverse_max_distance: float = 1_000
+    """Maximum distance in meters of the nearest cached result for reverse
+    geocoding (0 for unbounded)"""
+
+    cache_miss_ttl: int | None = None
+    """Seconds to not retry a geocoder for an address it didn't match (opt-in,
+    e.g. 2592000 for 30 days)"""
+
     nuts_data: Path = NUTS
     """Location for nuts shapefile data"""
 
+    nuts_compiled: Path = NUTS_COMPILED
+    """Location for compiled nuts data (`ftmgeo nuts compile`), used if existing"""
+
+    nuts_chunk_size: int = 10_000
+    """Number of coordinates to assign nuts codes to at once in batch mode"""
+
+    nuts_cache_size: int = 100_000
+    """Maximum number of coordinates to memorize nuts lookup results for"""
+
+    nuts_cache_persist: bool = False
+    """Store nuts lookup results in the cache as well"""
+
     geocoders: list[GEOCODERS] = [GEOCODERS.nominatim]
     """Default geocoders to use (in order)"""
 
     libpostal: bool = False
     """Activate libpostal (requires additional install)"""
+
+    ready_file: Path | None = None
+    """Touch this file once libpostal is loaded, e.g. for container readiness
+    probes of workers"""
@@ -2,7 +2,10 @@ from openaleph_procrastinate.app import make_app
 from openaleph_procrastinate.model import DatasetJob
 from openaleph_procrastinate.tasks import task
 
-from ftm_geocode.geocode import geocode_proxy
+from ftm_geocode.geocode import geocode_proxies
+from ftm_geocode.logic import warmup
+from ftm_geocode.metrics import enable as enable_metrics
+from ftm_geocode.metrics import write_report
 from ftm_geocode.settings import Settings
 
 settings = Settings()
@@ -10,12 +13,30 @@ app = make_app(__loader__.name)
 
 ORIGIN = "ftm-geocode"
 
+if settings.metrics_file:
+    enable_metrics()
+
+if settings.libpostal:
+    # load libpostal when the worker starts instead of during the first job
+    warmup()
+
 
 @task(app=app)
 def geocode(job: DatasetJob) -> DatasetJob:
-    results = []
-    for entity in job.get_entities():
-        for result in geocode_proxy(settings.geocoders, entity, rewrite_ids=False):
-            results.append(result)
-    job.payload["entities"] = results
+    # resolve the distinct addresses of each chunk of entities at once, and
+    # serialize the rewritten entities as they come
+    results = geocode_proxies(
+        settings.geocoders,
+        job.get_entities(),
+        rewrite_ids=False,
+        workers=settings.workers,
+        timeout=settings.job_timeout,
+    )
+    entities = []
+    for proxy in results:
+        entities.append(proxy.to_dict())
+    job.payload["entities"] = entities
+    if settings.metrics_file:
+        # cumulative since the worker started, e.g. for prometheus textfiles
+        write_report(settings.metrics_file)
     return job
@@ -1,18 +1,101 @@
-from typing import Any, Generator, Iterable
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+from functools import lru_cache
+from itertools import islice
+from typing import Any, Callable, Generator, Generic, Hashable, Iterable, TypeVar
 from unicodedata import normalize as _unormalize
 
 from banal import ensure_list
 from followthemoney.types import registry
 from followthemoney.util import make_entity_id
-from ftmq.util import get_country_code, get_country_name
+from ftmq.util import get_country_code as _get_country_code
+from ftmq.util import get_country_name
 from nomenklatura.entity import CE
 from normality import collapse_spaces
 from normality import normalize as _normalize
 from rigour.addresses import normalize_address
 
+from ftm_geocode.settings import Settings
 
-def make_address_id(line: str, country: str | None = None, **kwargs) -> str:
-    value = make_entity_id(normalize_address(line))
+T = TypeVar("T")
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+MISSING = object()
+
+settings = Settings()
+
+
+class LRUCache(Generic[K, V]):
+    """
+    A bounded, thread-safe in-memory LRU mapping that counts hits and misses.
+    Use `MISSING` as the default for `get` to distinguish cached `None` values.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[K, V] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: K, default: Any = None) -> V | Any:
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: K, value: V) -> None:
+        if self.maxsize < 1:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+# the same address lines and countries occur many times per run, memoize the
+# normalization and key derivation for them
+@lru_cache(maxsize=settings.key_cache_size)
+def normalize_line(value: str, latinize: bool = False) -> str | None:
+    return normalize_address(value, latinize=latinize)
+
+
+@lru_cache(maxsize=1_000)
+def _get_country_code_cached(value: str | None) -> str | None:
+    return _get_country_code(value)
+
+
+def get_country_code(value: Any) -> str | None:
+    if value is None or isinstance(value, str):
+        return _get_country_code_cached(value)
+    return _get_country_code(value)
+
+
+@lru_cache(maxsize=settings.key_cache_size)
+def _make_address_id(line: str, country: str | None = None) -> str:
+    value = make_entity_id(normalize_line(line))
     assert value, f"Invalid address line for id: {line}"
     ccode = get_country_code(country)
     if ccode is not None:
@@ -20,6 +103,10 @@ def make_address_id(line: str, country: str | None = None, **kwargs) -> str:
     return f"addr-{value}"
 
 
+def make_address_id(line: str, country: str | None = None, **kwargs) -> str:
+    return _make_address_id(line, country)
+
+
 def get_first(value: str | Iterable[Any] | None, default: Any | None = None) -> Any:
     value = ensure_list(value)
     if value:
@@ -27,6 +114,114 @@ def get_first(value: str | Iterable[Any] | None, default: Any | None = None) ->
     return default
 
 
+class SingleFlight(Generic[K, V]):
+    """
+    Deduplicate concurrent calls: While a call for a key is in flight, other
+    callers with the same key wait for its result instead of calling again.
+    """
+
+    def __init__(self) -> None:
+        self.shared = 0
+        self._calls: dict[K, Future[V]] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: K, func: Callable[[], V]) -> V:
+        with self._lock:
+            future = self._calls.get(key)
+            owner = future is None
+            if owner:
+                future = self._calls[key] = Future()
+            else:
+                self.shared += 1
+        if not owner:
+            return future.result()
+        try:
+            result = func()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+
+def chunked(values: Iterable[T], size: int) -> Generator[list[T], None, None]:
+    iterator = iter(values)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def ordered_map(
+    func: Callable[[T], V], values: Iterable[T], workers: int | None = 1
+) -> Generator[V, None, None]:
+    """
+    Apply `func` to `values` in a thread pool and yield the results in input
+    order. Only a bounded number of values is consumed ahead, so this works on
+    (endless) streams as well. With 1 worker, this is a plain `map`.
+    """
+    if not workers or workers < 2:
+        yield from map(func, values)
+        return
+    pending: deque[Future[V]] = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for value in values:
+            pending.append(executor.submit(func, value))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _map_chunk(func: Callable[[T], V], chunk: list[T]) -> list[V]:
+    return [func(value) for value in chunk]
+
+
+def process_map(
+    func: Callable[[T], V],
+    values: Iterable[T],
+    processes: int | None = 1,
+    chunk_size: int = 100,
+    initializer: Callable[[], Any] | None = None,
+) -> Generator[V, None, None]:
+    """
+    Apply `func` to chunks of `values` in a process pool and yield the results
+    in input order, for CPU bound work. `func` and the values need to be
+    picklable. `initializer` is called once per worker process. Only a bounded
+    number of chunks is consumed ahead. With 1 process, this is a plain `map`.
+    """
+    if not processes or processes < 2:
+        yield from map(func, values)
+        return
+    pending: deque[Future[list[V]]] = deque()
+    with ProcessPoolExecutor(
+        max_workers=processes, initializer=initializer
+    ) as executor:
+        for chunk in chunked(values, chunk_size):
+            pending.append(executor.submit(_map_chunk, func, chunk))
+            if len(pending) >= processes * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_duration(value: str) -> timedelta:
+    """
+    Parse a duration like "90d", "12h", "30m", "2w" or seconds ("3600")
+    """
+    amount, unit = value.strip().lower(), "s"
+    if amount[-1:] in DURATION_UNITS:
+        amount, unit = amount[:-1], amount[-1]
+    try:
+        return timedelta(seconds=float(amount) * DURATION_UNITS[unit])
+    except ValueError:
+        raise ValueError(f"Invalid duration: `{value}`")
+
+
 def clean_country_codes(values: Iterable[str] | str | None) -> set[str]:
     codes = set()
     for value in ensure_list(values):
@@ -1,10 +1,58 @@
+from datetime import datetime
 from pathlib import Path
+from typing import Any, Callable
 
 import pytest
 
+from ftm_geocode import cache, fuzzy, reverse
+from ftm_geocode.model import GeocodingResult
+
 FIXTURES_PATH = (Path(__file__).parent / "fixtures").absolute()
 
 
 @pytest.fixture(scope="module")
 def fixtures_path():
     return FIXTURES_PATH
+
+
+def _reset_cache() -> None:
+    cache.get_cache.cache_clear()
+    cache.get_raw_cache.cache_clear()
+    cache.get_namespace_cache.cache_clear()
+    cache._hot.clear()
+
+
+@pytest.fixture(autouse=True)
+def store(monkeypatch):
+    """A fresh (in memory) cache store and empty in-process indexes per test"""
+    _reset_cache()
+    monkeypatch.setattr(fuzzy, "_index", None)
+    monkeypatch.setattr(reverse, "_index", None)
+    yield cache.get_raw_cache()
+    _reset_cache()
+
+
+@pytest.fixture
+def make_result() -> Callable[..., GeocodingResult]:
+    """Factory for geocoding results of an address line looked up for `de`"""
+
+    def _make_result(
+        line: str, ts: datetime | None = None, **data: Any
+    ) -> GeocodingResult:
+        data = {
+            "address_id": "addr-test",
+            "original_line": line,
+            "result_line": line,
+            "country": "de",
+            "lon": 13.4,
+            "lat": 52.5,
+            "geocoder": "nominatim",
+            "geocoder_raw": {},
+            "input_line": line,
+            "input_country": "de",
+            "ts": ts,
+            **data,
+        }
+        return GeocodingResult(**data)
+
+    return _make_result
@@ -0,0 +1,171 @@
+"""
+Local stand-in for the geocoding services, speaking the response formats of
+Nominatim, Google and ArcGIS. Used by the benchmarks to measure the geocoding
+path without hitting real services.
+
+Results are deterministic per query: the coordinates derive from the hash of
+the query, and queries containing "nowhere" don't have a match.
+
+Example:
+    ```python
+    with MockGeocodingServer(latency=0.01, error_rate=0.05) as server:
+        settings.geocoder_urls = {GEOCODERS.nominatim: server.url}
+    ```
+"""
+
+import json
+import random
+import threading
+import time
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Self
+from urllib.parse import parse_qs, urlparse
+
+NO_MATCH = "nowhere"
+
+
+def _locate(query: str) -> tuple[int, float, float]:
+    digest = sha1(query.encode()).hexdigest()
+    place_id = int(digest[:8], 16)
+    lat = (int(digest[8:16], 16) / 0xFFFFFFFF) * 180 - 90
+    lon = (int(digest[16:24], 16) / 0xFFFFFFFF) * 360 - 180
+    return place_id, round(lat, 7), round(lon, 7)
+
+
+def nominatim(query: str) -> Any:
+    if NO_MATCH in query.lower():
+        return []
+    place_id, lat, lon = _locate(query)
+    return [
+        {
+            "place_id": place_id,
+            "lat": str(lat),
+            "lon": str(lon),
+            "display_name": query,
+            "type": "house",
+        }
+    ]
+
+
+def google(query: str) -> Any:
+    if NO_MATCH in query.lower():
+        return {"status": "ZERO_RESULTS", "results": []}
+    place_id, lat, lon = _locate(query)
+    return {
+        "status": "OK",
+        "results": [
+            {
+                "place_id": f"place-{place_id}",
+                "formatted_address": query,
+                "geometry": {"location": {"lat": lat, "lng": lon}},
+            }
+        ],
+    }
+
+
+def arcgis(query: str) -> Any:
+    if NO_MATCH in query.lower():
+        return {"candidates": []}
+    place_id, lat, lon = _locate(query)
+    return {
+        "candidates": [
+            {
+                "address": query,
+                "location": {"x": lon, "y": lat},
+                "score": 100,
+                "attributes": {"Place_addr": query, "place_id": place_id},
+            }
+        ]
+    }
+
+
+# url path suffix -> (query parameter, response)
+ROUTES = {
+    "/search": ("q", nominatim),
+    "/maps/api/geocode/json": ("address", google),
+    "/findAddressCandidates": ("singleLine", arcgis),
+}
+
+
+class MockGeocodingServer:
+    """
+    Threaded http server on a free local port with configurable latency (plus
+    random jitter) and rate of failing (503) responses
+    """
+
+    def __init__(
+        self,
+        latency: float = 0,
+        jitter: float = 0,
+        error_rate: float = 0,
+        seed: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> Self:
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def _roll(self) -> tuple[float, bool]:
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        return delay, failed
+
+    def _make_handler(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+            disable_nagle_algorithm = True
+
+            def do_GET(self) -> None:
+                url = urlparse(self.path)
+                delay, failed = server._roll()
+                if delay:
+                    time.sleep(delay)
+                for suffix, (param, respond) in ROUTES.items():
+                    if url.path.endswith(suffix):
+                        break
+                else:
+                    return self._send(404, {"error": "not found"})
+                if failed:
+                    return self._send(503, {"error": "unavailable"})
+                query = parse_qs(url.query).get(param, [""])[0]
+                self._send(200, respond(query))
+
+            def _send(self, status: int, data: Any) -> None:
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        return Handler
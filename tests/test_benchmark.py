@@ -0,0 +1,276 @@
+"""
+Offline benchmarks of the geocoding path against a local mock server
+
+Run with `make benchmark` (or `pytest -s tests/test_benchmark.py`) to see the
+report: addresses/sec, p50/p99 latency per address, hot cache hit rate and
+peak RSS.
+"""
+
+import csv
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import time
+from typing import Any, Callable
+from uuid import uuid4
+
+import numpy as np
+import pytest
+from followthemoney.util import make_entity_id
+from ftmq.util import get_country_code, make_proxy
+from rigour.addresses import normalize_address
+from shapely.geometry import Point
+
+from ftm_geocode import cache, geocode, nuts, util
+from ftm_geocode.io import PostalRow
+from ftm_geocode.settings import GEOCODERS
+from tests.mock_server import MockGeocodingServer
+
+CITIES = [
+    ("Berlin", "de"),
+    ("Paris", "fr"),
+    ("Madrid", "es"),
+    ("Roma", "it"),
+    ("Wien", "at"),
+]
+
+
+def make_corpus(size: int = 500, unique: int = 200) -> list[tuple[str, str]]:
+    """Address lines (with recurring ones) that are not cached by a prior run"""
+    run = uuid4().hex[:8]
+    lines = []
+    for i in range(size):
+        n = i % unique
+        city, country = CITIES[n % len(CITIES)]
+        lines.append((f"Teststraße {n} {run}, {city}", country))
+    return lines
+
+
+def get_peak_rss() -> dict[str, int]:
+    """Peak resident memory in MB of this process and its children"""
+    return {
+        "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024,
+        "rss_children_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        // 1024,
+    }
+
+
+def report(name: str, total: float, latencies: list[float] | None = None, **stats):
+    data: dict[str, Any] = {"addresses/sec": round(stats.pop("addresses") / total)}
+    if latencies:
+        quantiles = statistics.quantiles(latencies, n=100)
+        data["p50_ms"] = round(quantiles[49] * 1000, 3)
+        data["p99_ms"] = round(quantiles[98] * 1000, 3)
+    data.update(stats)
+    data.update(get_peak_rss())
+    print(f"\n[benchmark] {name}: " + " ".join(f"{k}={v}" for k, v in data.items()))
+    return data
+
+
+def timed(func: Callable[..., Any], values: list[Any]) -> tuple[float, list[float]]:
+    latencies = []
+    start = time.perf_counter()
+    for value in values:
+        t = time.perf_counter()
+        func(value)
+        latencies.append(time.perf_counter() - t)
+    return time.perf_counter() - start, latencies
+
+
+@pytest.fixture
+def server(monkeypatch):
+    with MockGeocodingServer(latency=0.001, jitter=0.002) as server:
+        urls = {g: server.url for g in GEOCODERS}
+        monkeypatch.setattr(geocode.settings, "geocoder_urls", urls)
+        monkeypatch.setattr(geocode.settings, "min_delay_seconds", 0)
+        monkeypatch.setattr(geocode.settings, "provider_delay_seconds", {})
+        geocode.registry.close()
+        yield server
+        geocode.registry.close()
+
+
+def test_benchmark_geocode_line(server):
+    geocoders = [GEOCODERS.nominatim]
+    corpus = make_corpus()
+    before = cache.get_hot_cache_stats()
+
+    def _geocode(value):
+        line, country = value
+        assert geocode.geocode_line(geocoders, line, country=country) is not None
+
+    cold, cold_latencies = timed(_geocode, corpus)
+    stats = cache.get_hot_cache_stats()
+    report(
+        "geocode_line (cold)",
+        cold,
+        cold_latencies,
+        addresses=len(corpus),
+        requests=server.requests,
+        hot_hits=stats.hits - before.hits,
+    )
+    assert server.requests == len(set(corpus))
+
+    warm, warm_latencies = timed(_geocode, corpus)
+    report("geocode_line (warm)", warm, warm_latencies, addresses=len(corpus))
+    assert server.requests == len(set(corpus))
+    assert warm < cold
+
+    # store lookups without the in-process cache
+    cache._hot.clear()
+    stored, stored_latencies = timed(_geocode, corpus)
+    report("geocode_line (cached)", stored, stored_latencies, addresses=len(corpus))
+    assert server.requests == len(set(corpus))
+
+
+def test_benchmark_geocode_lines(server):
+    corpus = make_corpus(1000, 400)
+    rows = [PostalRow(original_line=line, country=c) for line, c in corpus]
+    dedup = geocode.AddressDeduplicator()
+    start = time.perf_counter()
+    results = list(
+        geocode.geocode_lines([GEOCODERS.nominatim], rows, workers=8, dedup=dedup)
+    )
+    report(
+        "geocode_lines (8 workers)",
+        time.perf_counter() - start,
+        addresses=len(rows),
+        requests=server.requests,
+        duplicates=round(dedup.ratio, 2),
+    )
+    assert all(results)
+    assert server.requests == dedup.unique
+
+
+def test_benchmark_geocode_proxy(server):
+    corpus = make_corpus(300, 300)
+    proxies = [
+        make_proxy(
+            {
+                "id": f"org-{i}",
+                "schema": "Company",
+                "properties": {"address": [line], "country": [country]},
+            }
+        )
+        for i, (line, country) in enumerate(corpus)
+    ]
+
+    def _geocode(proxy):
+        address, proxy = geocode.geocode_proxy([GEOCODERS.nominatim], proxy)
+        assert proxy.first("addressEntity") == address.id
+
+    total, latencies = timed(_geocode, proxies)
+    report("geocode_proxy", total, latencies, addresses=len(proxies))
+
+
+def test_benchmark_fallback(monkeypatch):
+    # failing responses of the first geocoder fall back to the next one
+    with (
+        MockGeocodingServer(error_rate=0.2, seed=1) as failing,
+        MockGeocodingServer(latency=0.002) as server,
+    ):
+        urls = {GEOCODERS.nominatim: failing.url, GEOCODERS.arcgis: server.url}
+        monkeypatch.setattr(geocode.settings, "geocoder_urls", urls)
+        monkeypatch.setattr(geocode.settings, "min_delay_seconds", 0)
+        monkeypatch.setattr(geocode.settings, "provider_delay_seconds", {})
+        monkeypatch.setattr(geocode.settings, "max_retries", 0)
+        geocode.registry.close()
+        corpus = make_corpus(200, 200) + [("Nowhere 1, Berlin", "de")]
+        geocoders = [GEOCODERS.nominatim, GEOCODERS.arcgis]
+        start = time.perf_counter()
+        results = [geocode.geocode_line(geocoders, v, country=c) for v, c in corpus]
+        report(
+            "geocode_line (fallback)",
+            time.perf_counter() - start,
+            addresses=len(corpus),
+            errors=failing.errors,
+        )
+        geocode.registry.close()
+    assert failing.errors > 0
+    assert server.requests == failing.errors + 1
+    assert all(results[:-1])
+    assert results[-1] is None
+    assert {r.geocoder for r in results[:-1]} == {"nominatim", "arcgis"}
+
+
+def test_benchmark_address_keys():
+    corpus = make_corpus(10_000, 1_000)
+
+    def _make_address_id(value):
+        line, country = value
+        value = make_entity_id(normalize_address(line))
+        ccode = get_country_code(country)
+        return f"addr-{ccode}-{value}" if ccode else f"addr-{value}"
+
+    util._make_address_id.cache_clear()
+    util.normalize_line.cache_clear()
+    uncached, _ = timed(_make_address_id, corpus)
+    cached, latencies = timed(lambda v: util.make_address_id(*v), corpus)
+    report("address keys (uncached)", uncached, addresses=len(corpus))
+    report("address keys (memoized)", cached, latencies, addresses=len(corpus))
+    assert cached < uncached
+
+
+@pytest.mark.skipif(
+    not nuts.settings.nuts_data.exists(), reason="nuts data not downloaded"
+)
+def test_benchmark_nuts_index():
+    # spatial index lookups against a linear scan over all polygons
+    rng = np.random.default_rng(42)
+    points = list(zip(rng.uniform(-10, 30, 200), rng.uniform(36, 60, 200)))
+    df = nuts.get_nuts_data()
+    df = df[df["LEVL_CODE"] == 3]
+    index = nuts.get_nuts_index()
+    linear, _ = timed(lambda p: df[df.contains(Point(*p))], points)
+    indexed, latencies = timed(lambda p: index.lookup(*p), points)
+    report("nuts lookup (linear)", linear, addresses=len(points))
+    report("nuts lookup (indexed)", indexed, latencies, addresses=len(points))
+    assert indexed < linear
+
+
+@pytest.mark.skipif(not shutil.which("ftmgeo"), reason="cli not installed")
+def test_benchmark_cli(tmp_path):
+    corpus = make_corpus(300, 150)
+    input_path = tmp_path / "corpus.csv"
+    with open(input_path, "w") as fh:
+        writer = csv.writer(fh)
+        writer.writerow(["original_line", "country"])
+        writer.writerows(corpus)
+    output_path = tmp_path / "geocoded.csv"
+    with MockGeocodingServer(latency=0.001) as server:
+        env = {
+            **os.environ,
+            "FTMGEO_GEOCODER_URLS": f'{{"nominatim": "{server.url}"}}',
+            "FTMGEO_MIN_DELAY_SECONDS": "0",
+            "FTMGEO_PROVIDER_DELAY_SECONDS": "{}",
+        }
+        start = time.perf_counter()
+        subprocess.run(
+            [
+                "ftmgeo",
+                "geocode",
+                "-i",
+                str(input_path),
+                "--input-format",
+                "csv",
+                "-o",
+                str(output_path),
+                "--output-format",
+                "csv",
+                "--workers",
+                "8",
+            ],
+            env=env,
+            check=True,
+            capture_output=True,
+        )
+        report(
+            "cli geocode (8 workers)",
+            time.perf_counter() - start,
+            addresses=len(corpus),
+            requests=server.requests,
+        )
+    with open(output_path) as fh:
+        assert len(list(csv.DictReader(fh))) == len(corpus)
+    assert server.requests == len(set(corpus))
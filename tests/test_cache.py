@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+import orjson
+import pytest
+
+from ftm_geocode import cache
+
+
+def test_cache_bulk(make_result):
+    results = {r.cache_key: r for r in (make_result("Foo 1"), make_result("Foo 2"))}
+    cache.put_many(results)
+    keys = [*results.keys(), "addr-missing"]
+    assert cache.get_many(keys) == results
+    assert list(cache.iterate_results()) == list(results.values())
+
+
+def test_cache_misses(monkeypatch):
+    key = cache.make_cache_key("Nowhere 1", country="de")
+    # disabled by default
+    cache.put_miss("nominatim", key)
+    assert not cache.is_miss("nominatim", key)
+
+    monkeypatch.setattr(cache.settings, "cache_miss_ttl", 60)
+    assert not cache.is_miss("nominatim", key)
+    cache.put_miss("nominatim", key)
+    assert cache.is_miss("nominatim", key)
+    assert not cache.is_miss("arcgis", key)
+    # stored under the namespace of the misses
+    assert cache.get_raw_cache().exists(f"{cache.MISS_NAMESPACE}/nominatim/{key}")
+
+    # expired
+    store = cache.get_namespace_cache(cache.MISS_NAMESPACE)
+    ts = datetime.now() - timedelta(seconds=cache.settings.cache_miss_ttl + 1)
+    store.put(cache.make_miss_key("nominatim", key), ts.isoformat().encode())
+    assert not cache.is_miss("nominatim", key)
+
+    # misses are not iterated as results
+    assert not any(r.original_line == "Nowhere 1" for r in cache.iterate_results())
+
+
+def test_cache_serialization(monkeypatch, make_result):
+    raw = {"place_id": 1, "display_name": "Foo 3", "extratags": {"a": 1}}
+    result = make_result("Foo 3", geocoder_raw=raw)
+    assert cache.load_result(cache.dump_result(result)) == result
+
+    # existing json entries stay readable
+    assert cache.load_result(orjson.dumps(result.model_dump(mode="json"))) == result
+
+    monkeypatch.setattr(cache.settings, "cache_compression", "zlib")
+    monkeypatch.setattr(cache.settings, "cache_raw_fields", ["place_id"])
+    data = cache.dump_result(result)
+    assert b"extratags" not in data
+    loaded = cache.load_result(data)
+    assert loaded.geocoder_raw == {"place_id": 1}
+    assert loaded.model_dump(exclude={"geocoder_raw"}) == result.model_dump(
+        exclude={"geocoder_raw"}
+    )
+
+    pytest.importorskip("msgpack")
+    monkeypatch.setattr(cache.settings, "cache_serialization", "msgpack")
+    monkeypatch.setattr(cache.settings, "cache_raw_fields", None)
+    data = cache.dump_result(result)
+    assert not data.startswith(b"{")
+    assert cache.load_result(data) == result
@@ -0,0 +1,77 @@
+import orjson
+import pytest
+
+from ftm_geocode import cache, export
+from ftm_geocode.io import stream_models
+from ftm_geocode.model import GeocodingResult
+
+
+def _make_results(make_result, numbers: range) -> dict[str, GeocodingResult]:
+    results = (
+        make_result(f"Exportstraße {i}, Berlin", address_id=f"addr-osm-{i}")
+        for i in numbers
+    )
+    return {r.cache_key: r for r in results}
+
+
+def _get_ids(results: dict[str, GeocodingResult], keys: set[str]) -> set[str]:
+    return {results[k].address_id for k in keys}
+
+
+def test_export(tmp_path, make_result):
+    results = _make_results(make_result, range(50))
+    cache.put_many(results)
+    keys = set(cache.get_cache().iterate_keys())
+    assert keys == set(results)
+    shards = {cache.get_shard(k, 4) for k in keys}
+    assert shards == {0, 1, 2, 3}
+    shard_keys = cache.get_shard_keys(4)
+    assert {s: set(k) for s, k in shard_keys.items()} == {
+        s: {k for k in keys if cache.get_shard(k, 4) == s} for s in shards
+    }
+
+    parts = tmp_path / "parts"
+    total = export.export_results(parts, "json", shards=4)
+    assert total == len(keys)
+    out = tmp_path / "out.json"
+    export.merge_parts(parts, str(out), "json", shards=4)
+    exported = [orjson.loads(line) for line in out.read_bytes().splitlines()]
+    assert {r["address_id"] for r in exported} == _get_ids(results, keys)
+
+    # resume: only missing shards are exported again
+    checkpoint = export.ExportCheckpoint.load(parts / export.CHECKPOINT, 4, "json")
+    count = checkpoint.done.pop(2)
+    checkpoint.save(parts / export.CHECKPOINT)
+    assert export.export_results(parts, "json", shards=4) == count
+    assert export.export_results(parts, "json", shards=4) == 0
+    # resuming with other parameters
+    with pytest.raises(ValueError):
+        export.export_results(parts, "json", shards=8)
+    with pytest.raises(ValueError):
+        export.export_results(parts, "csv", shards=4)
+
+    # parallel export into csv, merged with one header
+    parts = tmp_path / "parts-csv"
+    total = export.export_results(parts, "csv", shards=4, workers=2)
+    assert total == len(keys)
+    out = tmp_path / "out.csv"
+    export.merge_parts(parts, str(out), "csv", shards=4)
+    lines = out.read_text().splitlines()
+    assert lines[0].startswith("cache_key")
+    assert len(lines) == len(keys) + 1
+
+
+def test_export_parquet(tmp_path, make_result):
+    pytest.importorskip("pyarrow")
+    results = _make_results(make_result, range(50, 80))
+    cache.put_many(results)
+    keys = set(cache.get_cache().iterate_keys())
+    assert keys == set(results)
+
+    parts = tmp_path / "parts"
+    total = export.export_results(parts, "parquet", shards=4)
+    assert total == len(keys)
+    out = tmp_path / "out.parquet"
+    export.merge_parts(parts, str(out), "parquet", shards=4)
+    exported = list(stream_models(out, GeocodingResult, "parquet"))
+    assert {r.address_id for r in exported} == _get_ids(results, keys)
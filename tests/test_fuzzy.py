@@ -0,0 +1,83 @@
+from ftm_geocode import cache, fuzzy, geocode
+from ftm_geocode.io import PostalRow
+from ftm_geocode.model import GeocodingResult
+from ftm_geocode.settings import GEOCODERS
+from tests.mock_server import MockGeocodingServer
+
+
+def _similarity(a: str, b: str) -> float:
+    return fuzzy.similarity(fuzzy.get_variants(a)[0], fuzzy.get_variants(b)[0])
+
+
+def test_fuzzy_similarity():
+    line = "Hauptstraße 1, 10115 Berlin"
+    assert _similarity(line, "10115 Berlin, Hauptstrasse 1") == 1
+    assert _similarity(line, "ACME GmbH, Hauptstraße 1, 10115 Berlin") > 0.85
+    assert _similarity(line, "Hauptstraße 1, 10115 Berlin, Germany") > 0.85
+    assert _similarity(line, "Haupstraße 1, 10115 Berlin") > 0.85
+    assert _similarity(line, "Nebenstraße 1, 10115 Berlin") < 0.7
+    # different numbers never match
+    assert _similarity(line, "Hauptstraße 1a, 10115 Berlin") == 0
+    assert _similarity(line, "Hauptstraße 1, Berlin") == 0
+
+
+def test_fuzzy_match(monkeypatch):
+    monkeypatch.setattr(fuzzy.settings, "fuzzy_threshold", 0.85)
+    geocoders = [GEOCODERS.nominatim]
+    result = GeocodingResult(
+        address_id="addr-fuzzy",
+        original_line="Unscharfe Gasse 12, 10117 Berlin",
+        result_line="Unscharfe Gasse 12, Mitte, 10117 Berlin, Deutschland",
+        country="de",
+        lon=13.4,
+        lat=52.5,
+        geocoder="nominatim",
+    )
+    cache.put_many({result.cache_key: result})
+
+    line = "ACME GmbH, Unscharfe Gasse 12, 10117 Berlin"
+    assert fuzzy.find_match(line, "fr") is None
+    assert fuzzy.find_match("Unscharfe Gasse 14, 10117 Berlin", "de") is None
+    match = geocode.geocode_line(geocoders, line, cache_only=True, country="de")
+    assert match.address_id == result.address_id
+    assert match.original_line == line
+    # stored as a regular result for this line now
+    assert cache.get_cache().get(match.cache_key).address_id == result.address_id
+    assert result.cache_key in fuzzy.get_index()
+    assert match.cache_key in fuzzy.get_index()
+
+    # the same for bulk lookups
+    line = "Unscharfe Gasse 12, 10117 Berlin, Deutschland"
+    rows = [PostalRow(original_line=line, country="de")]
+    (match,) = geocode.geocode_lines(geocoders, rows, cache_only=True)
+    assert match.address_id == result.address_id
+    assert match.original_line == line
+    assert cache.get_cache().get(match.cache_key).address_id == result.address_id
+
+    # disabled
+    monkeypatch.setattr(fuzzy.settings, "fuzzy_threshold", None)
+    line = "10117 Berlin, Unscharfe Gasse 12"
+    assert geocode.geocode_line(geocoders, line, cache_only=True) is None
+
+
+def test_fuzzy_index_update(monkeypatch):
+    monkeypatch.setattr(fuzzy.settings, "fuzzy_threshold", 0.85)
+    monkeypatch.setattr(fuzzy, "_index", fuzzy.FuzzyIndex())
+    with MockGeocodingServer() as server:
+        monkeypatch.setattr(
+            geocode.settings, "geocoder_urls", {GEOCODERS.nominatim: server.url}
+        )
+        monkeypatch.setattr(geocode.settings, "min_delay_seconds", 0)
+        geocode.registry.close()
+        geocoders = [GEOCODERS.nominatim]
+        result = geocode.geocode_line(
+            geocoders, "Neuer Weg 5, 10115 Berlin", country="de"
+        )
+        line = "10115 Berlin, Neuer Weg 5"
+        match = geocode.geocode_line(geocoders, line, country="de")
+        rows = [PostalRow(original_line="Berlin 10115 Neuer Weg 5", country="de")]
+        (bulk_match,) = geocode.geocode_lines(geocoders, rows)
+        geocode.registry.close()
+    assert server.requests == 1
+    assert match.address_id == result.address_id
+    assert bulk_match.address_id == result.address_id
@@ -1,11 +1,16 @@
-from unittest import TestCase
+import asyncio
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
 
 from anystore.io import FORMAT_CSV
 from ftmq.util import make_proxy
 from normality import collapse_spaces
 
-from ftm_geocode import geocode
+from ftm_geocode import cache, geocode
+from ftm_geocode.cache import get_cache, get_hot, get_hot_cache_stats
+from ftm_geocode.health import health
 from ftm_geocode.model import USE_LIBPOSTAL
+from tests.mock_server import MockGeocodingServer
 
 
 class GeocodingTestCase(TestCase):
@@ -82,3 +87,272 @@ class GeocodingTestCase(TestCase):
             )
         )
         self.assertIsInstance(result, geocode.GeocodingResult)
+
+    def test_geocode_lines(self):
+        rows = [
+            geocode.PostalRow(original_line=self.ADDR, country="gb"),
+            geocode.PostalRow(original_line="Alexanderplatz, Berlin", country="de"),
+            geocode.PostalRow(original_line=self.ADDR, country="gb"),
+        ]
+        results = list(geocode.geocode_lines([self.geocoder], rows, workers=3))
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0].original_line, self.ADDR)
+        self.assertEqual(results[1].country, "de")
+        self.assertEqual(results[0].address_id, results[2].address_id)
+
+    def test_geocoder_registry(self):
+        geocode.registry.close()
+        health.reset()
+        geocoder = geocode.get_geocoder(self.geocoder)
+        self.assertIs(geocoder, geocode.get_geocoder(self.geocoder))
+        self.assertIs(geocoder.geocode, geocode.get_geocoder(self.geocoder).geocode)
+        # the connection pool grows with the number of workers
+        self.assertEqual(geocoder.pool_size, 10)
+        previous = geocoder.geocoder.adapter
+        with mock.patch.object(previous.session, "close") as close:
+            geocoder = geocode.get_geocoder(self.geocoder, pool_size=32)
+            close.assert_called_once()
+        self.assertIs(geocoder, geocode.get_geocoder(self.geocoder))
+        self.assertEqual(geocoder.pool_size, 32)
+        adapter = geocoder.geocoder.adapter.session.get_adapter("https://")
+        self.assertEqual(adapter._pool_maxsize, 32)
+        # but not anymore once requests are made
+        with mock.patch.object(geocoder.geocoder, "geocode", return_value=None):
+            geocoder.attempt("Cowley Road")
+        adapter = geocoder.geocoder.adapter
+        geocode.get_geocoder(self.geocoder, pool_size=64)
+        self.assertIs(adapter, geocoder.geocoder.adapter)
+        self.assertEqual(geocoder.pool_size, 32)
+        geocode.registry.close()
+        self.assertIsNot(geocoder, geocode.get_geocoder(self.geocoder))
+
+    def test_geocode_async(self):
+        async def _run():
+            async with geocode.async_registry:
+                result = await geocode.geocode_line_async(
+                    [self.geocoder], self.ADDR, use_cache=False, country="gb"
+                )
+                proxy = make_proxy(
+                    {
+                        "id": "test-org",
+                        "schema": "Organization",
+                        "properties": {"address": [self.ADDR], "country": "gb"},
+                    }
+                )
+                proxies = [
+                    p
+                    async for p in geocode.geocode_proxy_async(
+                        [self.geocoder], proxy, use_cache=False
+                    )
+                ]
+            return result, proxies
+
+        result, (addressProxy, updatedProxy) = asyncio.run(_run())
+        self.assertIsInstance(result, geocode.GeocodingResult)
+        self.assertTrue(result.address_id.startswith("addr-osm-"))
+        self.assertEqual(updatedProxy.first("addressEntity"), addressProxy.id)
+
+    def test_geocode_async_nuts(self):
+        line = "Async Street 1, Berlin"
+        result = geocode.GeocodingResult(
+            address_id="addr-osm-3",
+            original_line=line,
+            result_line="Asyncstraße 1, 10178 Berlin, Deutschland",
+            country="de",
+            lon=13.4,
+            lat=52.5,
+            geocoder="nominatim",
+        )
+        get_cache().put(result.cache_key, result)
+
+        def apply_nuts(self):
+            self.nuts3_id = "DE300"
+
+        with mock.patch.object(geocode.GeocodingResult, "apply_nuts", apply_nuts):
+            for _ in range(2):
+                found = asyncio.run(
+                    geocode.geocode_line_async(
+                        [self.geocoder],
+                        line,
+                        cache_only=True,
+                        apply_nuts=True,
+                        country="de",
+                    )
+                )
+                self.assertEqual(found.nuts3_id, "DE300")
+        # the result in the in-process cache is not changed
+        self.assertIsNone(get_hot(line, "de").nuts3_id)
+
+    def test_geocode_bulk(self):
+        line = "Bulk Street 1, Berlin"
+        result = geocode.GeocodingResult(
+            address_id="addr-osm-1",
+            original_line=line,
+            result_line="Bulkstraße 1, 10178 Berlin, Deutschland",
+            country="de",
+            lon=13.4,
+            lat=52.5,
+            geocoder="nominatim",
+            geocoder_place_id="1",
+            geocoder_raw={"place_id": 1},
+        )
+        get_cache().put(result.cache_key, result)
+
+        def apply_nuts_batch(results):
+            for res in results:
+                res.nuts3_id = "DE300"
+
+        with mock.patch.object(geocode, "apply_nuts_batch", apply_nuts_batch):
+            resolved = geocode.geocode_bulk(
+                [self.geocoder],
+                [(line, {"country": "de"})],
+                cache_only=True,
+                apply_nuts=True,
+            )
+        self.assertEqual(resolved[(line, "de")].nuts3_id, "DE300")
+
+        proxies = [
+            make_proxy(
+                {
+                    "id": f"company-{i}",
+                    "schema": "Company",
+                    "properties": {"address": [line], "country": ["de"]},
+                }
+            )
+            for i in range(3)
+        ]
+        proxies.append(
+            make_proxy(
+                {
+                    "id": "company-unknown",
+                    "schema": "Company",
+                    "properties": {"address": ["Nowhere 1"], "country": ["de"]},
+                }
+            )
+        )
+        dedup = geocode.AddressDeduplicator()
+        resolved = geocode.geocode_bulk(
+            [self.geocoder],
+            [(line, {"country": "de"})] * 3,
+            cache_only=True,
+            dedup=dedup,
+        )
+        self.assertEqual(list(resolved.values()), [result])
+        self.assertDictEqual(
+            dedup.get_stats(), {"lines": 3, "unique": 1, "ratio": 2 / 3}
+        )
+
+        results = list(
+            geocode.geocode_proxies_bulk([self.geocoder], proxies, cache_only=True)
+        )
+        self.assertEqual(len(results), 7)
+        self.assertEqual(results[0].schema.name, "Address")
+        self.assertEqual(results[1].first("addressEntity"), results[0].id)
+        self.assertEqual(results[-1].id, "company-unknown")
+        self.assertIsNone(results[-1].first("addressEntity"))
+
+        # recurring lines are served from memory (without nuts codes applied)
+        self.assertEqual(get_hot(f" {line} ", "de"), result)
+        self.assertIsNone(get_hot(line, "gb"))
+        stats = get_hot_cache_stats()
+        self.assertGreater(stats.hits, 0)
+        self.assertGreater(stats.hit_rate, 0)
+
+    def test_geocode_components_backfill(self):
+        line = "Backfill Street 1, Berlin"
+        result = geocode.GeocodingResult(
+            address_id="addr-osm-2",
+            original_line=line,
+            result_line="Backfillstraße 1, 10178 Berlin, Deutschland",
+            country="de",
+            lon=13.4,
+            lat=52.5,
+            geocoder="nominatim",
+        )
+        get_cache().put(result.cache_key, result)
+
+        def parse(self):
+            self.components = {"road": ["backfillstraße"], "city": ["berlin"]}
+            return self.components
+
+        with (
+            mock.patch.object(geocode.settings, "libpostal", True),
+            mock.patch.object(geocode.GeocodingResult, "get_components", parse),
+        ):
+            resolved = geocode.geocode_bulk(
+                [self.geocoder], [(line, {"country": "de"})], cache_only=True
+            )
+        (cached,) = resolved.values()
+        self.assertIsNotNone(cached.components)
+        # parsed once and written back to the cache
+        stored = get_cache().get(result.cache_key)
+        self.assertEqual(stored.components, cached.components)
+        self.assertEqual(get_hot(line, "de").components, cached.components)
+
+
+def test_geocode_misses(monkeypatch):
+    # unmatched lines are not requested again until their record expired
+    monkeypatch.setattr(cache.settings, "cache_miss_ttl", 60)
+    monkeypatch.setattr(geocode.settings, "min_delay_seconds", 0)
+    monkeypatch.setattr(geocode.settings, "provider_delay_seconds", {})
+    geocoders = [geocode.GEOCODERS.nominatim]
+    line = "Nowhere 1, Berlin"
+    with MockGeocodingServer() as server:
+        urls = {geocode.GEOCODERS.nominatim: server.url}
+        monkeypatch.setattr(geocode.settings, "geocoder_urls", urls)
+        geocode.registry.close()
+        health.reset()
+        assert geocode.geocode_line(geocoders, line, country="de") is None
+        assert geocode.geocode_line(geocoders, line, country="de") is None
+        assert server.requests == 1
+
+        store = cache.get_namespace_cache(cache.MISS_NAMESPACE)
+        key = cache.make_miss_key("nominatim", cache.make_cache_key(line, country="de"))
+        ts = datetime.now() - timedelta(seconds=61)
+        store.put(key, ts.isoformat().encode())
+        assert geocode.geocode_line(geocoders, line, country="de") is None
+        assert server.requests == 2
+        assert geocode.geocode_line(geocoders, line, country="de") is None
+        assert server.requests == 2
+        geocode.registry.close()
+        health.reset()
+
+
+def test_geocode_proxies_stream(monkeypatch):
+    # entities are geocoded chunk by chunk, within a time budget for all
+    monkeypatch.setattr(geocode.settings, "min_delay_seconds", 0)
+    monkeypatch.setattr(geocode.settings, "provider_delay_seconds", {})
+    proxies = [
+        make_proxy(
+            {
+                "id": f"org-{i}",
+                "schema": "Company",
+                "properties": {"address": [f"Stromstraße {i}, Berlin"]},
+            }
+        )
+        for i in range(5)
+    ]
+    geocoders = [geocode.GEOCODERS.nominatim]
+    with MockGeocodingServer() as server:
+        urls = {geocode.GEOCODERS.nominatim: server.url}
+        monkeypatch.setattr(geocode.settings, "geocoder_urls", urls)
+        geocode.registry.close()
+        health.reset()
+        results = geocode.geocode_proxies(
+            geocoders, proxies, rewrite_ids=False, chunk_size=2
+        )
+        assert next(results).schema.name == "Address"
+        assert server.requests == 2
+        assert len(list(results)) == 9
+        assert server.requests == 5
+
+        proxies = [p.clone() for p in proxies]
+        for proxy in proxies:
+            proxy.set("address", proxy.first("address").replace("Strom", "Zeit"))
+        results = geocode.geocode_proxies(
+            geocoders, proxies, rewrite_ids=False, chunk_size=2, timeout=0
+        )
+        assert [p.schema.name for p in results] == ["Company"] * 5
+        assert server.requests == 5
+        geocode.registry.close()
+        health.reset()
@@ -0,0 +1,96 @@
+import time
+
+from ftm_geocode import geocode
+from ftm_geocode.health import CircuitBreaker, CircuitState, ProviderHealth, health
+from ftm_geocode.settings import GEOCODERS
+from tests.mock_server import MockGeocodingServer
+
+
+def test_health_breaker():
+    now = [0.0]
+    breaker = CircuitBreaker("test", threshold=3, timeout=10, clock=lambda: now[0])
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.failure()
+    assert breaker.state == CircuitState.closed
+    breaker.failure()
+    assert breaker.state == CircuitState.open
+    assert breaker.is_open()
+    assert not breaker.allow()
+
+    # half-open: only one probe, a failed probe opens it again
+    now[0] = 10
+    assert breaker.state == CircuitState.half_open
+    assert not breaker.is_open()
+    assert breaker.allow()
+    assert breaker.is_open()
+    assert not breaker.allow()
+    breaker.failure()
+    assert breaker.state == CircuitState.open
+
+    now[0] = 20
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == CircuitState.closed
+    assert breaker.allow()
+
+    disabled = CircuitBreaker("test", threshold=0, timeout=10)
+    for _ in range(10):
+        disabled.failure()
+    assert disabled.allow()
+
+
+def test_health_rank(monkeypatch):
+    registry = ProviderHealth()
+    geocoders = [GEOCODERS.nominatim, GEOCODERS.arcgis]
+    monkeypatch.setattr("ftm_geocode.health.settings.adaptive_min_samples", 5)
+    for _ in range(5):
+        registry.observe(GEOCODERS.nominatim, "de", 1, matched=False)
+        registry.observe(GEOCODERS.arcgis, "de", 0.1, matched=True)
+    registry.observe(GEOCODERS.arcgis, "fr", 0.1, matched=True)
+    assert registry.get_stats(GEOCODERS.arcgis, "de").hit_rate == 1
+    assert registry.rank(geocoders, "de") == geocoders
+    assert registry.rank(geocoders, "de", adaptive=True) == geocoders[::-1]
+    # not enough observations
+    assert registry.rank(geocoders, "fr", adaptive=True) == geocoders
+
+    breaker = registry.get_breaker(GEOCODERS.nominatim)
+    for _ in range(breaker.threshold):
+        breaker.failure()
+    assert registry.rank(geocoders, "fr") == geocoders[::-1]
+
+
+def test_health_provider_chain(monkeypatch):
+    with MockGeocodingServer(error_rate=1) as failing, MockGeocodingServer() as server:
+        urls = {GEOCODERS.nominatim: failing.url, GEOCODERS.arcgis: server.url}
+        monkeypatch.setattr(geocode.settings, "geocoder_urls", urls)
+        monkeypatch.setattr(geocode.settings, "min_delay_seconds", 0)
+        monkeypatch.setattr(geocode.settings, "max_retries", 2)
+        monkeypatch.setattr(geocode.settings, "retry_wait_seconds", 0.01)
+        monkeypatch.setattr("ftm_geocode.health.settings.breaker_threshold", 3)
+        monkeypatch.setattr("ftm_geocode.health.settings.breaker_timeout", 2)
+        geocode.registry.close()
+        health.reset()
+        geocoders = [GEOCODERS.nominatim, GEOCODERS.arcgis]
+        try:
+            results = [
+                geocode.geocode_line(geocoders, f"Ausfallweg {i}, Berlin", country="de")
+                for i in range(20)
+            ]
+            assert all(r.geocoder == "arcgis" for r in results)
+            # the retries stopped once the circuit opened
+            assert failing.requests == 3
+            assert health.rank(geocoders, "de") == geocoders[::-1]
+
+            # a successful probe closes the circuit again
+            failing.error_rate = 0
+            time.sleep(2)
+            result = geocode.geocode_line(
+                geocoders, "Ausfallweg 100, Berlin", country="de"
+            )
+            assert result.geocoder == "nominatim"
+            assert health.get_breaker(GEOCODERS.nominatim).state == "closed"
+            assert health.rank(geocoders, "de") == geocoders
+        finally:
+            geocode.registry.close()
+            health.reset()
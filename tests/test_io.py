@@ -0,0 +1,183 @@
+import pytest
+from typer.testing import CliRunner
+
+from ftm_geocode import cache, model, nuts
+from ftm_geocode.cli import cli
+from ftm_geocode.io import (
+    BatchWriter,
+    LatLonRow,
+    PostalRow,
+    add_nuts_columns,
+    get_schema,
+    get_writer,
+    stream_batches,
+    stream_models,
+)
+from ftm_geocode.model import GeocodingResult
+
+pa = pytest.importorskip("pyarrow")
+
+
+@pytest.fixture
+def nuts_codes(monkeypatch):
+    """Stub the nuts lookup without the shapefile: points east of 13° are DE300"""
+
+    def get_nuts_codes(lons, lats):
+        return ["DE300" if lon > 13 else None for lon in lons]
+
+    names = {"DE3": "Berlin", "DE30": "Berlin", "DE300": "Berlin"}
+    monkeypatch.setattr(nuts, "get_nuts_codes", get_nuts_codes)
+    monkeypatch.setattr(model, "get_nuts_codes", get_nuts_codes)
+    monkeypatch.setattr(nuts, "get_nuts_names", lambda: names)
+    nuts._get_nuts3.cache_clear()
+    yield
+    nuts._get_nuts3.cache_clear()
+
+
+def _make_result(make_result, i: int) -> GeocodingResult:
+    return make_result(
+        f"Spaltenweg {i}, Berlin",
+        address_id=f"addr-columnar-{i}",
+        lat=52.5 + i / 1000,
+        geocoder_raw={"place_id": i},
+        components={"road": ["Spaltenweg"], "house_number": [str(i)]},
+    )
+
+
+def test_io_schema():
+    schema = get_schema(GeocodingResult)
+    assert schema.field("lon").type == pa.float64()
+    assert schema.field("original_line").type == pa.string()
+    assert schema.field("geocoder_raw").type == pa.string()
+
+
+@pytest.mark.parametrize("format", ["parquet", "arrow"])
+def test_io_columnar(tmp_path, format, make_result):
+    results = [_make_result(make_result, i) for i in range(25)]
+    path = tmp_path / f"results.{format}"
+    with BatchWriter(path, format, get_schema(GeocodingResult), batch_size=10) as w:
+        for result in results:
+            w.write(result)
+    assert w.count == 25
+    batches = stream_batches(path, format, batch_size=10)
+    assert [len(b) for b in batches] == [10, 10, 5]
+    loaded = list(stream_models(path, GeocodingResult, format))
+    assert loaded == results
+    assert loaded[3].components["house_number"] == ["3"]
+
+    # schema inferred from the first batch
+    path = tmp_path / f"rows.{format}"
+    with get_writer(path, format, fieldnames=["extra"]) as writer:
+        writer.write({"original_line": "Spaltenweg 1", "country": None})
+        writer.write({"original_line": "Spaltenweg 2", "country": "de", "n": 1})
+    rows = list(stream_models(path, PostalRow, format))
+    assert rows[0].country is None
+    assert rows[1].country == "de"
+    assert rows[1].n == 1
+    assert rows[0].extra is None
+
+    # later columns or types that don't fit the inferred schema
+    with pytest.raises(ValueError):
+        with get_writer(tmp_path / f"invalid.{format}", format) as writer:
+            writer.write({"original_line": "Spaltenweg 1"})
+            writer.flush()
+            writer.write({"original_line": "Spaltenweg 2", "country": "de"})
+    with pytest.raises(ValueError):
+        with BatchWriter(tmp_path / f"invalid.{format}", format, batch_size=1) as w:
+            w.write({"original_line": "Spaltenweg 1", "lat": None})
+            w.write({"original_line": "Spaltenweg 2", "lat": 52.5})
+
+    # passed through columns besides the model fields
+    path = tmp_path / f"passthrough.{format}"
+    writer = get_writer(path, format, (PostalRow, LatLonRow), passthrough=True)
+    with writer:
+        writer.write({"original_line": "Spaltenweg 1", "id": 1})
+        writer.flush()
+        writer.write({"original_line": "Spaltenweg 2", "id": 2, "lat": 52.5})
+    rows = [row for rows in stream_batches(path, format) for row in rows]
+    assert rows[0] == {
+        "original_line": "Spaltenweg 1",
+        "formatted_line": None,
+        "country": None,
+        "language": None,
+        "lat": None,
+        "lon": None,
+        "id": 1,
+    }
+    assert rows[1]["lat"] == 52.5
+
+    # empty output still has a schema
+    path = tmp_path / f"empty.{format}"
+    with get_writer(path, format, GeocodingResult):
+        pass
+    assert list(stream_batches(path, format)) == []
+
+
+def test_io_cli(tmp_path, make_result):
+    results = [_make_result(make_result, i) for i in range(100, 110)]
+    cache.put_many({r.cache_key: r for r in results})
+    in_path, out_path = tmp_path / "in.parquet", tmp_path / "out.arrow"
+    with get_writer(in_path, "parquet") as writer:
+        for result in results:
+            writer.write({"original_line": result.original_line, "country": "de"})
+
+    args = ["geocode", "-i", str(in_path), "--input-format", "parquet"]
+    args += ["-o", str(out_path), "--output-format", "arrow", "--cache-only"]
+    res = CliRunner().invoke(cli, args)
+    assert res.exit_code == 0, res.output
+    geocoded = list(stream_models(out_path, GeocodingResult, "arrow"))
+    assert [r.address_id for r in geocoded] == [r.address_id for r in results]
+
+
+def test_io_nuts_columns(tmp_path, nuts_codes):
+    batch = pa.RecordBatch.from_pylist(
+        [
+            {"id": 1, "lon": 13.4, "lat": 52.5, "nuts3_id": "XX"},
+            {"id": 2, "lon": 2.3, "lat": 48.9, "nuts3_id": None},
+            {"id": 3, "lon": 13.5, "lat": 52.4, "nuts3_id": None},
+        ]
+    )
+    batch = add_nuts_columns(batch)
+    assert batch.column("id").to_pylist() == [1, 3]
+    assert batch.column("nuts3_id").to_pylist() == ["DE300", "DE300"]
+    assert batch.column("nuts1_id").to_pylist() == ["DE3", "DE3"]
+    assert batch.column("path").to_pylist() == ["DE/DE3/DE30/DE300"] * 2
+
+    in_path = tmp_path / "points.parquet"
+    with get_writer(in_path, "parquet") as writer:
+        for i in range(10):
+            writer.write({"id": i, "lon": 12.5 + i / 10, "lat": 52.5})
+    for format in ("arrow", "csv"):
+        out_path = tmp_path / f"nuts.{format}"
+        args = ["apply-nuts", "-i", str(in_path), "--input-format", "parquet"]
+        args += ["-o", str(out_path), "--output-format", format]
+        res = CliRunner().invoke(cli, args)
+        assert res.exit_code == 0, res.output
+    rows = [
+        row for rows in stream_batches(tmp_path / "nuts.arrow", "arrow") for row in rows
+    ]
+    assert [r["id"] for r in rows] == [6, 7, 8, 9]
+    assert {r["nuts2_id"] for r in rows} == {"DE30"}
+    lines = (tmp_path / "nuts.csv").read_text().splitlines()
+    assert lines[0].startswith("id,lon,lat,nuts1")
+    assert len(lines) == 5
+
+
+def test_io_cache_iterate(tmp_path, make_result, nuts_codes):
+    results = [_make_result(make_result, i) for i in range(200, 210)]
+    results[0] = results[0].model_copy(
+        update={"nuts1_id": "DE1", "nuts2_id": "DE11", "nuts3_id": "DE111"}
+    )
+    cache.put_many({r.cache_key: r for r in results})
+    out_path = tmp_path / "cached.parquet"
+    args = ["cache", "iterate", "-o", str(out_path), "--output-format", "parquet"]
+    res = CliRunner().invoke(cli, args + ["--apply-nuts"])
+    assert res.exit_code == 0, res.output
+    exported = sorted(
+        stream_models(out_path, GeocodingResult, "parquet"), key=lambda r: r.lat
+    )
+    assert [r.address_id for r in exported] == [r.address_id for r in results]
+    assert exported[0].nuts3_id == "DE111"
+    assert {r.nuts3_id for r in exported[1:]} == {"DE300"}
+    assert exported[5].geocoder_raw == {"place_id": 205}
+    assert exported[5].components == results[5].components
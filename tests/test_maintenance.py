@@ -0,0 +1,123 @@
+from datetime import datetime, timedelta
+
+from ftm_geocode import cache, maintenance
+from ftm_geocode.settings import GEOCODERS
+from ftm_geocode.util import parse_duration
+
+YEAR = timedelta(days=365)
+
+
+def _ago(days: int) -> datetime:
+    return datetime.now() - timedelta(days=days)
+
+
+def _put(store, *results, key: str | None = None) -> None:
+    for result in results:
+        store.put(key or result.lookup_key, cache.dump_result(result))
+
+
+def test_maintenance_parse_duration():
+    assert parse_duration("90d") == timedelta(days=90)
+    assert parse_duration("12h") == timedelta(hours=12)
+    assert parse_duration("60") == timedelta(minutes=1)
+
+
+def test_maintenance_stats(monkeypatch, store, make_result):
+    monkeypatch.setattr(cache.settings, "cache_miss_ttl", 60)
+    old = make_result("Altstraße 1, Berlin", _ago(400))
+    new = make_result("Neustraße 1, Berlin", _ago(1))
+    undated = make_result("Ohnestraße 1, Berlin")
+    _put(store, old, new, undated)
+    _put(store, make_result("Umzugstraße 1, Berlin", _ago(2)), key="addr-de-legacy")
+    unkeyed = make_result("Altbau 1, Berlin", _ago(3), input_line=None)
+    _put(store, unkeyed, key="addr-de-unkeyed")
+    cache.put_miss("nominatim", "addr-de-missing")
+
+    stats = maintenance.get_stats()
+    assert stats.results == 5
+    assert stats.geocoders == {"nominatim": 5}
+    assert stats.undated == 1
+    assert stats.outdated_keys == 1
+    assert stats.unkeyed == 1
+    assert stats.outdated_encoding == 0
+    assert stats.misses == 1
+    assert stats.oldest == old.ts
+    assert stats.newest == new.ts
+
+
+def test_maintenance_compact(store, make_result):
+    # arcgis results are queried with the country name appended
+    arcgis = make_result(
+        "Hauptstraße 1, Wien",
+        _ago(1),
+        original_line="Hauptstraße 1, Wien, Austria",
+        country="at",
+        input_country="at",
+        geocoder=GEOCODERS.arcgis.value,
+    )
+    current = make_result("Neustraße 1, Berlin", _ago(1))
+    _put(store, arcgis, current)
+    # stored under keys of an older key normalization
+    moved = make_result("Umzugstraße 1, Berlin", _ago(2))
+    _put(store, moved, key="addr-de-legacy")
+    _put(store, make_result("Neustraße 1, Berlin", _ago(5)), key="addr-de-outdated")
+    unkeyed = make_result("Altbau 1, Berlin", _ago(3), input_line=None)
+    _put(store, unkeyed, key="addr-de-unkeyed")
+
+    report = maintenance.compact(dry_run=True)
+    assert report.model_dump() == {"rewritten": 0, "rekeyed": 1, "superseded": 1}
+    assert store.exists("addr-de-legacy")
+
+    report = maintenance.compact()
+    assert report.model_dump() == {"rewritten": 0, "rekeyed": 1, "superseded": 1}
+    keys = {arcgis.lookup_key, current.lookup_key, moved.lookup_key}
+    assert set(store.iterate_keys()) == keys | {"addr-de-unkeyed"}
+    assert maintenance.compact().model_dump() == {
+        "rewritten": 0,
+        "rekeyed": 0,
+        "superseded": 0,
+    }
+
+    # all results can still be looked up by their input
+    for result in (arcgis, current, moved):
+        key = cache.make_cache_key(result.input_line, country=result.input_country)
+        assert cache.get_cache().get(key) == result
+
+
+def test_maintenance_refresh(monkeypatch, store, make_result):
+    old = make_result("Altstraße 1, Berlin", _ago(400))
+    new = make_result("Neustraße 1, Berlin", _ago(1))
+    unkeyed = make_result("Altbau 1, Berlin", _ago(400), input_line=None)
+    _put(store, old, new)
+    _put(store, unkeyed, key="addr-de-unkeyed")
+
+    calls = []
+
+    def _geocode_provider(geocoder, value, use_cache, **ctx):
+        calls.append((geocoder, value, ctx))
+        return make_result(value, datetime.now(), lat=52.6)
+
+    monkeypatch.setattr(maintenance, "_geocode_provider", _geocode_provider)
+    assert maintenance.refresh(YEAR, dry_run=True) == 1
+    assert not calls
+    assert maintenance.refresh(YEAR) == 1
+    assert calls == [(GEOCODERS.nominatim, old.input_line, {"country": "de"})]
+    refreshed = cache.get_cache().get(old.lookup_key)
+    assert refreshed.lat == 52.6
+    assert len(list(store.iterate_keys())) == 3
+
+
+def test_maintenance_prune(store, make_result):
+    old = make_result("Altstraße 1, Berlin", _ago(400))
+    new = make_result("Neustraße 1, Berlin", _ago(1))
+    undated = make_result("Ohnestraße 1, Berlin")
+    _put(store, old, new, undated)
+
+    assert maintenance.prune(YEAR, dry_run=True) == 1
+    assert store.exists(old.lookup_key)
+    assert maintenance.prune(YEAR) == 1
+    assert not store.exists(old.lookup_key)
+    assert store.exists(new.lookup_key)
+    assert store.exists(undated.lookup_key)
+    assert maintenance.prune(YEAR, undated=True) == 1
+    assert set(store.iterate_keys()) == {new.lookup_key}
@@ -0,0 +1,75 @@
+import orjson
+
+from ftm_geocode import geocode, metrics
+from ftm_geocode.settings import GEOCODERS
+from tests.mock_server import MockGeocodingServer
+
+
+def _get_stage(report: metrics.MetricsReport, name: str, **labels):
+    for stage in report.stages:
+        if stage.name == name and stage.labels == labels:
+            return stage
+
+
+def _get_counter(report: metrics.MetricsReport, name: str, **labels) -> float:
+    for counter in report.counters:
+        if counter.name == name and counter.labels == labels:
+            return counter.value
+    return 0
+
+
+def test_metrics_disabled():
+    registry = metrics.Metrics()
+    with registry.timer("test"):
+        registry.count("test")
+    assert registry.get_report() == metrics.MetricsReport()
+
+
+def test_metrics(monkeypatch, tmp_path):
+    with MockGeocodingServer(error_rate=0.5, seed=2) as server:
+        monkeypatch.setattr(
+            geocode.settings, "geocoder_urls", {GEOCODERS.nominatim: server.url}
+        )
+        monkeypatch.setattr(geocode.settings, "min_delay_seconds", 0)
+        monkeypatch.setattr(geocode.settings, "max_retries", 0)
+        geocode.registry.close()
+        metrics.metrics.reset()
+        metrics.enable()
+        try:
+            lines = [f"Metrikweg {i}, Berlin" for i in range(10)]
+            results = [geocode.geocode_line([GEOCODERS.nominatim], x) for x in lines]
+            found = [x for x, r in zip(lines, results) if r is not None]
+            for line in found:
+                geocode.geocode_line([GEOCODERS.nominatim], line)
+        finally:
+            metrics.enable(False)
+            geocode.registry.close()
+
+    report = metrics.get_report()
+    assert _get_stage(report, "provider", geocoder="nominatim").calls == 10
+    assert _get_stage(report, "cache_key").calls >= 10
+    assert _get_counter(report, "hot_hits") == len(found)
+    errors = _get_counter(
+        report, "provider_errors", geocoder="nominatim", error="GeocoderTimedOut"
+    )
+    assert errors == server.errors > 0
+    matches = _get_counter(report, "provider_matches", geocoder="nominatim")
+    assert matches == len(found) == 10 - errors
+
+    # disabled again
+    geocode.geocode_line([GEOCODERS.nominatim], "Metrikweg 1, Berlin")
+    assert metrics.get_report() == report
+
+    text = metrics.to_prometheus(report)
+    assert "# TYPE ftmgeo_stage_seconds_total counter" in text
+    assert 'ftmgeo_stage_calls_total{stage="provider",geocoder="nominatim"} 10' in text
+    assert 'ftmgeo_provider_errors_total{error="GeocoderTimedOut"' in text
+
+    path = tmp_path / "metrics.json"
+    metrics.write_report(path, report)
+    assert metrics.MetricsReport(**orjson.loads(path.read_bytes())) == report
+    path = tmp_path / "ftmgeo.prom"
+    metrics.write_report(path, report)
+    assert path.read_text() == text
+    assert not list(tmp_path.glob(".*.tmp"))
+    metrics.metrics.reset()
@@ -1,8 +1,12 @@
-from unittest import TestCase
+import sys
+import tempfile
+import threading
+from pathlib import Path
+from unittest import TestCase, mock
 
 from followthemoney.proxy import EntityProxy
 
-from ftm_geocode import model
+from ftm_geocode import logic, model
 from ftm_geocode.settings import Settings
 
 
@@ -87,3 +91,52 @@ class ModelTestCase(TestCase):
                     "city": "Cambridge",
                 },
             )
+
+    def test_model_result_components(self):
+        line = "Cowley Road, Cambridge, CB4 0WS, United Kingdom"
+        result = model.GeocodingResult(
+            address_id="addr-test",
+            original_line=line,
+            result_line=line,
+            country="gb",
+            lon=0.1,
+            lat=52.2,
+            geocoder="nominatim",
+        )
+        self.assertIsNone(result.components)
+        expected = model.Address.from_postal(
+            model.PostalAddress.from_string(line, country="gb")
+        )
+        address = model.Address.from_result(result)
+        if model.USE_LIBPOSTAL:
+            self.assertIsNotNone(result.components)
+        else:  # no components without libpostal
+            self.assertIsNone(result.components)
+        self.assertEqual(address.street, expected.street)
+        self.assertEqual(address.country, expected.country)
+        self.assertEqual(address.to_proxy().id, result.to_proxy().id)
+
+        # stored components are used without parsing
+        data = result.model_dump(mode="json")
+        data["components"] = {**result.get_components(), "city": ["Parsed Before"]}
+        result = model.GeocodingResult(**data)
+        self.assertEqual(model.Address.from_result(result).city, ["Parsed Before"])
+
+    def test_model_postal_warmup(self):
+        # stub libpostal to count the loads
+        parser, expand = mock.MagicMock(), mock.MagicMock()
+        postal = {"postal": mock.MagicMock(parser=parser, expand=expand)}
+        postal.update({"postal.parser": parser, "postal.expand": expand})
+        with (
+            tempfile.TemporaryDirectory() as tmp,
+            mock.patch.dict(sys.modules, postal),
+            mock.patch.object(logic, "_ready", threading.Event()),
+            mock.patch.object(logic.settings, "ready_file", Path(tmp) / "ready"),
+        ):
+            self.assertFalse(logic.is_ready())
+            logic.warmup()
+            self.assertTrue(logic.is_ready())
+            self.assertTrue(logic.settings.ready_file.exists())
+            logic.warmup()  # no-op
+            parser.parse_address.assert_called_once()
+            expand.expand_address.assert_called_once()
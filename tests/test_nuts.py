@@ -1,6 +1,11 @@
+import tempfile
+from pathlib import Path
 from unittest import TestCase
 
+import geopandas as gpd
+import numpy as np
 from ftmq.util import make_proxy
+from shapely.geometry import Point, box
 
 from ftm_geocode import geocode, nuts
 from ftm_geocode.model import get_coords
@@ -112,3 +117,105 @@ class NutsTestCase(TestCase):
         self.assertEqual(nuts.get_nuts_name("DE30"), "Berlin")
         self.assertEqual(nuts.get_nuts_name("DE300"), "Berlin")
         self.assertEqual(nuts.get_nuts_path("DE300"), "DE/DE3/DE30/DE300")
+
+    def test_nuts_index(self):
+        # spatial index lookups give the same results as a linear scan over all
+        # polygons (see `test_benchmark_nuts_index` for the timing)
+        rng = np.random.default_rng(42)
+        lons = rng.uniform(-10, 30, 200).round(6)
+        lats = rng.uniform(36, 60, 200).round(6)
+        df = nuts.get_nuts_data()
+        df = df[df["LEVL_CODE"] == 3]
+        index = nuts.get_nuts_index()
+        self.assertEqual(len(index), len(df))
+
+        expected = []
+        for lon, lat in zip(lons, lats):
+            res = df[df.contains(Point(lon, lat))]
+            expected.append(res["NUTS_ID"].iloc[0] if len(res) == 1 else None)
+        result = [index.lookup(lon, lat) for lon, lat in zip(lons, lats)]
+        self.assertListEqual(result, expected)
+        self.assertTrue(any(result))
+
+    def test_nuts_batch(self):
+        lons = [13.413215, 0.121817, 8.62814, -75.54, "invalid"]
+        lats = [52.521918, 52.235226, 52.00716, 39.74, 1]
+        with self.assertRaises(ValueError):
+            nuts.get_nuts_batch(lons, lats)
+        lons, lats = lons[:4], lats[:4]
+        res = nuts.get_nuts_batch(lons, lats)
+        self.assertEqual(len(res), 4)
+        self.assertEqual(res[0].nuts3_id, "DE300")
+        self.assertIsNone(res[3])
+        for lon, lat, n3 in zip(lons, lats, res):
+            self.assertEqual(nuts.get_nuts(lon, lat), n3)
+
+    def test_nuts_compiled(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = nuts.compile_nuts(Path(tmp) / "nuts3")
+            compiled = nuts.load_compiled_nuts(path)
+            self.assertEqual(compiled.names, nuts.get_nuts_names())
+            self.assertEqual(compiled.names["DE3"], "Berlin")
+            df = compiled.to_data()
+            self.assertTrue((df["LEVL_CODE"] == 3).all())
+            index = compiled.to_index()
+            self.assertEqual(len(index), len(nuts.get_nuts_index()))
+            self.assertEqual(index.lookup(13.413215, 52.521918), "DE300")
+            self.assertIsNone(index.lookup(-75.54, 39.74))
+
+    def test_nuts_compiled_lazy(self):
+        # small synthetic data, runs without the shapefile
+        df = gpd.GeoDataFrame(
+            {
+                "LEVL_CODE": [0, 1, 2, 3, 3, 3],
+                "NUTS_ID": ["XX", "XX1", "XX10", "XX101", "XX102", "XX103"],
+                "NUTS_NAME": ["Land", "Nord", "Nord", "Eins", "Zwei", "Drei"],
+            },
+            geometry=[
+                box(0, 0, 3, 1),
+                box(0, 0, 3, 1),
+                box(0, 0, 3, 1),
+                box(0, 0, 1, 1),
+                box(1, 0, 2, 1),
+                box(2, 0, 3, 1),
+            ],
+            crs="EPSG:4326",
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            in_path = Path(tmp) / "nuts.geojson"
+            df.to_file(in_path, driver="GeoJSON")
+            path = nuts.compile_nuts(Path(tmp) / "nuts3", in_path=in_path)
+            compiled = nuts.load_compiled_nuts(path)
+            self.assertIs(compiled, nuts.load_compiled_nuts(path))
+            self.assertIsInstance(compiled.codes, np.memmap)
+            self.assertEqual(compiled.names["XX1"], "Nord")
+
+            index = compiled.to_index()
+            self.assertEqual(len(index), 3)
+            self.assertFalse(compiled.geometries._loaded.any())
+            self.assertEqual(index.lookup(0.5, 0.5), "XX101")
+            self.assertIsInstance(index.lookup(0.5, 0.5), str)
+            # only the candidates are decoded
+            self.assertEqual(compiled.geometries._loaded.tolist(), [True, False, False])
+            self.assertIsNone(index.lookup(5, 5))
+            result = index.lookup_many([0.5, 2.5, 5], [0.5, 0.5, 5])
+            self.assertEqual(result.tolist(), ["XX101", "XX103", None])
+            self.assertFalse(compiled.geometries._loaded[1])
+
+            data = compiled.to_data()
+            self.assertTrue((data["LEVL_CODE"] == 3).all())
+            self.assertEqual(data["NUTS_NAME"].tolist(), ["Eins", "Zwei", "Drei"])
+            self.assertTrue(compiled.geometries._loaded.all())
+
+    def test_nuts_cache(self):
+        lon, lat = 13.3777, 52.5163
+        before = nuts.get_nuts_cache_stats()
+        n3 = nuts.get_nuts(lon, lat)
+        self.assertEqual(n3, nuts.get_nuts(lon, lat))
+        res = nuts.get_nuts_batch([lon, lon], [lat, lat])
+        self.assertEqual(res, [n3, n3])
+        stats = nuts.get_nuts_cache_stats()
+        self.assertEqual(stats.hits - before.hits, 3)
+        # returned objects are not shared
+        n3.nuts3 = "changed"
+        self.assertEqual(nuts.get_nuts(lon, lat).nuts3, "Berlin")
@@ -0,0 +1,143 @@
+import math
+
+from ftmq.util import make_proxy
+
+from ftm_geocode import cache, geocode, reverse
+from ftm_geocode.model import GeocodingResult
+
+
+def _make_result(make_result, name: str, lon: float, lat: float) -> GeocodingResult:
+    return make_result(
+        f"Rückwärtsweg {name}, Berlin",
+        address_id=f"addr-reverse-{name}",
+        result_line=f"Rückwärtsweg {name}, 10117 Berlin, Deutschland",
+        lon=lon,
+        lat=lat,
+    )
+
+
+def test_reverse_haversine():
+    # 1 degree latitude ~ 111km
+    assert round(reverse.haversine(13, 52, 13, 53) / 1000) == 111
+    assert reverse.haversine(13, 52, 13, 52) == 0
+    # across the antimeridian
+    assert round(reverse.haversine(179.9, 0, -179.9, 0) / 1000) == 22
+
+
+def test_reverse_index():
+    index = reverse.ReverseIndex(["a", "b"], [[13.0, 52.0], [13.01, 52.0]])
+    index.add("c", 2.35, 48.85)
+    assert len(index) == 3
+    assert "c" in index
+
+    key, distance = index.lookup(13.002, 52.0)
+    assert key == "a"
+    assert 100 < distance < 200
+    assert index.lookup(13.002, 52.0, max_distance=100) is None
+    assert index.lookup(2.35, 48.86, max_distance=2000)[0] == "c"
+    # unbounded
+    assert index.lookup(0, 0)[0] == "c"
+
+    keys, distances = index.lookup_many([13.009, 2.35, 100], [52.0, 48.85, 0], 1000)
+    assert list(keys) == ["b", "c", None]
+    assert distances[1] == 0
+    assert math.isnan(distances[2])
+
+    # high latitudes: a longitude degree is much shorter
+    index.add("d", 20.0, 80.0)
+    assert index.lookup(20.05, 80.0, max_distance=10_000)[0] == "d"
+
+    assert index.retain(["a", "c"]) == 2
+    assert "b" not in index
+    assert index.lookup(13.01, 52.0, max_distance=1000)[0] == "a"
+
+    assert reverse.ReverseIndex().lookup(13.0, 52.0) is None
+
+
+def test_reverse_index_persist(tmp_path):
+    index = reverse.ReverseIndex(["a"], [[13.0, 52.0]])
+    index.add("b", 2.35, 48.85)
+    index.save(tmp_path)
+    loaded = reverse.ReverseIndex.load(tmp_path)
+    assert len(loaded) == 2
+    assert loaded.lookup(2.35, 48.85)[0] == "b"
+    loaded.add("c", 0, 0)
+    loaded.save(tmp_path)
+    assert len(reverse.ReverseIndex.load(tmp_path)) == 3
+
+
+def test_reverse_geocode(monkeypatch, tmp_path, make_result):
+    monkeypatch.setattr(reverse.settings, "reverse_index", tmp_path / "index")
+    first = _make_result(make_result, "1", -150.0, -60.0)
+    second = _make_result(make_result, "2", -150.0, -61.0)
+    cache.put_many({first.cache_key: first})
+
+    index = reverse.build_index()
+    assert first.cache_key in index
+    assert reverse.get_index() is index
+
+    # incremental update of the persisted index
+    cache.put_many({second.cache_key: second})
+    monkeypatch.setattr(reverse, "_index", None)
+    assert second.cache_key not in reverse.get_index()
+    index = reverse.build_index()
+    assert second.cache_key in index
+    assert len(reverse.ReverseIndex.load(tmp_path / "index")) == len(index)
+
+    result = reverse.reverse_geocode(-150.001, -60.0)
+    assert result.address_id == first.address_id
+    assert 0 < result.distance < 100
+    assert reverse.reverse_geocode(-150.1, -60.0) is None
+    assert reverse.reverse_geocode(-150.1, -60.0, max_distance=10_000) is not None
+
+    results = reverse.reverse_geocode_many([-150.0, -150.0], [-61.0, -65.0])
+    assert results[0].address_id == second.address_id
+    assert results[1] is None
+
+    # newly cached results are added to the loaded index
+    third = _make_result(make_result, "3", -150.0, -62.0)
+    geocode.index_result(third.cache_key, third)
+    assert third.cache_key in reverse.get_index()
+
+
+def test_reverse_geocode_proxy(monkeypatch, make_result):
+    result = _make_result(make_result, "4", -140.0, -60.0)
+    cache.put_many({result.cache_key: result})
+    monkeypatch.setattr(reverse, "_index", reverse.ReverseIndex())
+    reverse.index_result(result.cache_key, result)
+
+    proxy = make_proxy(
+        {
+            "id": "estate",
+            "schema": "RealEstate",
+            "properties": {"latitude": ["-60.0001"], "longitude": ["-140.0"]},
+        }
+    )
+    address, proxy = reverse.reverse_geocode_proxy(proxy)
+    assert address.schema.name == "Address"
+    assert proxy.first("addressEntity") == address.id
+    assert "Rückwärtsweg 4" in proxy.first("address")
+
+    address = make_proxy(
+        {
+            "id": "addr",
+            "schema": "Address",
+            "properties": {"latitude": ["-60.0001"], "longitude": ["-140.0"]},
+        }
+    )
+    (address,) = reverse.reverse_geocode_proxy(address)
+    assert address.id == "addr"
+    assert address.first("full") == result.result_line
+    assert address.get("latitude") == ["-60.0001"]
+
+    # nothing within reach or already with an address
+    far = make_proxy(
+        {
+            "id": "far",
+            "schema": "Address",
+            "properties": {"latitude": ["-50"], "longitude": ["-140.0"]},
+        }
+    )
+    assert list(reverse.reverse_geocode_proxy(far)) == [far]
+    assert not far.first("full")
+    assert list(reverse.reverse_geocode_proxy(address)) == [address]
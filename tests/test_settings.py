@@ -10,4 +10,5 @@ def test_settings():
     assert settings.max_retries == 5
     assert settings.cache.uri == "memory:"
     assert settings.nuts_data.name == "NUTS_RG_01M_2021_4326.shp.zip"
+    assert settings.nuts_compiled.name == "NUTS_RG_01M_2021_4326.nuts3"
     assert settings.geocoders == [GEOCODERS.nominatim]
@@ -0,0 +1,110 @@
+import random
+import time
+
+from followthemoney.util import make_entity_id
+from ftmq.util import get_country_code
+from rigour.addresses import normalize_address
+
+from ftm_geocode import util
+
+
+def test_util_chunked():
+    assert list(util.chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(util.chunked([], 2)) == []
+
+
+def test_util_ordered_map():
+    def _slow(value: int) -> int:
+        time.sleep((10 - value) / 1000)
+        return value * 2
+
+    values = list(range(10))
+    expected = [v * 2 for v in values]
+    assert list(util.ordered_map(_slow, values)) == expected
+    assert list(util.ordered_map(_slow, iter(values), workers=4)) == expected
+
+
+def _double(value: int) -> int:
+    return value * 2
+
+
+def test_util_process_map():
+    values = list(range(25))
+    expected = [v * 2 for v in values]
+    assert list(util.process_map(_double, values)) == expected
+    res = util.process_map(_double, iter(values), processes=2, chunk_size=3)
+    assert list(res) == expected
+
+
+def test_util_lru_cache():
+    cache = util.LRUCache(2)
+    assert cache.get("a", util.MISSING) is util.MISSING
+    cache.put("a", None)
+    cache.put("b", 2)
+    assert cache.get("a", util.MISSING) is None
+    cache.put("c", 3)  # evicts "b"
+    assert cache.get("b") is None
+    assert len(cache) == 2
+    assert cache.hits == 1
+    assert cache.misses == 2
+    assert cache.hit_rate == 1 / 3
+
+
+def test_util_single_flight():
+    flight = util.SingleFlight()
+    calls = []
+
+    def _resolve() -> str:
+        calls.append(1)
+        time.sleep(0.05)
+        return "result"
+
+    results = list(
+        util.ordered_map(lambda _: flight.do("key", _resolve), range(4), workers=4)
+    )
+    assert results == ["result"] * 4
+    assert len(calls) == 1
+    assert flight.shared == 3
+    # not in flight anymore
+    assert flight.do("key", lambda: "new") == "new"
+
+
+def test_util_address_keys():
+    # memoized cache keys for a corpus with recurring addresses, see
+    # `test_benchmark_address_keys` for the throughput
+    streets = ["Hauptstraße", "Cowley Road", "Rue de la Paix", "Via Roma", "Main St"]
+    cities = [
+        ("10115 Berlin", "de"),
+        ("CB4 0WS Cambridge", "United Kingdom"),
+        ("75002 Paris", "France"),
+        ("00184 Roma", "it"),
+        ("Springfield, IL 62701", None),
+    ]
+    rng = random.Random(42)
+    unique = [
+        (f"{rng.choice(streets)} {number}, {city}", country)
+        for number in range(1, 201)
+        for city, country in cities
+    ]
+    corpus = [rng.choice(unique) for _ in range(10_000)]
+
+    def _make_address_id(line: str, country: str | None) -> str:
+        value = make_entity_id(normalize_address(line))
+        ccode = get_country_code(country)
+        return f"addr-{ccode}-{value}" if ccode else f"addr-{value}"
+
+    util._make_address_id.cache_clear()
+    util.normalize_line.cache_clear()
+    result = [util.make_address_id(line, country=country) for line, country in corpus]
+    assert result == [_make_address_id(line, country) for line, country in corpus]
+    keys = util._make_address_id.cache_info()
+    assert keys.misses == len(set(corpus))
+    assert keys.hits == len(corpus) - keys.misses
+    lines = util.normalize_line.cache_info()
+    assert lines.misses == len({line for line, _ in corpus})
+    assert lines.hits == 0
+
+    # the normalized line is shared across countries
+    line, _ = corpus[0]
+    assert util.make_address_id(line, country="Germany").startswith("addr-de-")
+    assert util.normalize_line.cache_info().hits == 1